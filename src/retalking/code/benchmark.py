@@ -0,0 +1,946 @@
+"""
+benchmark.py
+
+    Description:
+        Offline CPU benchmark of the retalking pipeline. A synthetic talking head clip
+        and a speech-like audio track of configurable length and resolution are
+        generated, then lip synced by a RetalkingEngine whose networks are replaced by
+        tiny deterministic stand-ins with the same interfaces (face3d net, DNet,
+        LNet/ENet, GPEN, GFPGAN, the face parser and the face/landmark detectors). No
+        checkpoint is read and no GPU is needed, only the upstream video-retalking code
+        (src/scripts/install_retalking.sh).
+
+        Everything around the networks is the production code: decoding, cropping,
+        alignment, the pipelines, compositing, blending and encoding. The stand-ins are
+        far cheaper than the real networks, so the numbers track the CPU side of the
+        pipeline and how it changes between commits, not the endpoint throughput.
+
+        Every repeat starts with an empty preprocessing cache, so Steps 1-3 are
+        measured too. The per step timings and memory peaks of instrumentation.py are
+        summarized (median over the repeats) into a JSON baseline, and two baselines
+        can be compared, e.g. the last release and the current commit.
+
+        `drift` lip syncs the clip once in fp32 and once per precision and memory
+        format mode (see precision.py) and reports how far the output frames of each
+        mode are from fp32. It fails when a mode drifts further than --min_psnr, or
+        when the device supports none of the compared modes. It runs on cuda when
+        available, fp16 is not supported on cpu.
+
+        `equivalence` checks the batched and vectorized steps against the per-frame
+        code of upstream inference_retalking.py they replace. It compares the Step 3
+        driving coefficients, and the 3DMM coefficients of the batched Step 2 with one
+        face at a time in the main thread. It then lip syncs the clip with the options
+        of OUTPUT_CHECKS and reports how far their output frames are from the
+        reference options, e.g. the batched GPEN enhancement from one face at a time.
+
+    Usage:
+        python benchmark.py run --seconds 4 --resolution 640x360 --repeat 3 --output benchmarks/current.json
+        python benchmark.py run --option stream_window=32 --option output_preset=veryfast --output tuned.json
+        python benchmark.py run --option preset=draft --output draft.json
+        python benchmark.py compare benchmarks/baseline.json benchmarks/current.json --tolerance 0.1
+        python benchmark.py drift --device cuda --precision fp16 bf16 --channels_last
+        python benchmark.py equivalence
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy.io import wavfile
+
+from engine import RetalkingEngine
+from third_part.GPEN.gpen_face_enhancer import FaceEnhancement
+from utils.inference_utils import find_crop_norm_ratio, transform_semantic
+from align_faces import get_reference_facial_points
+from frame_io import FrameReader
+from instrumentation import report_path
+from precision import check as check_precision
+from preprocess_cache import PreprocessCache
+from retalking_options import build_options
+from stages import crop_norm_ratios, stabilization_coeffs
+from video_writer import FFmpegWriter
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_RATE = 16000
+BASELINE_VERSION = 1
+
+# 5 point standard 3D landmarks (eyes, nose, mouth corners), stands in for checkpoints/BFM
+LM3D_STD = np.array([[-0.31, 0.29, 0.13], [0.31, 0.29, 0.13], [0., 0.03, 0.48],
+                     [-0.24, -0.34, 0.16], [0.24, -0.34, 0.16]], dtype=np.float32)
+
+# 5 point template of a 512x512 aligned face, as used by the GFPGAN face helper
+FACE_TEMPLATE_512 = np.array([[192.98138, 239.94708], [318.90277, 240.1936], [256.63416, 314.01935],
+                              [201.26117, 371.41043], [313.08905, 371.15118]], dtype=np.float32)
+
+# face parsing labels of the synthetic face
+SKIN_LABEL, MOUTH_LABEL, LIP_LABEL = 1, 11, 12
+
+# outputs compared by `equivalence`: name, reference options, compared options and the PSNR under which
+# the check fails
+OUTPUT_CHECKS = [
+    # batched GPEN reference enhancement against FaceEnhancement.process per frame
+    ('gpen batching', {'enhance_batch_size': 1}, {'enhance_batch_size': 8}, 45.),
+    # native resolution blend of the ROI against the upstream 512x512 blend of the full frame
+    ('roi compositing', {'composite_roi_pad': 0.}, {'composite_roi_pad': 0.5}, 30.),
+]
+
+
+def _unit_landmarks():
+    """
+    68 point landmarks of the synthetic face in unit face box coordinates (y down)
+    """
+    def ellipse(cx, cy, rx, ry, angles):
+        return np.stack([cx + rx * np.cos(angles), cy - ry * np.sin(angles)], 1)
+
+    jaw = ellipse(0.5, 0.4, 0.45, -0.55, np.linspace(np.pi, 0, 17))
+    brows = np.concatenate([np.stack([np.linspace(0.15, 0.42, 5), np.full(5, 0.3)], 1),
+                            np.stack([np.linspace(0.58, 0.85, 5), np.full(5, 0.3)], 1)])
+    nose = np.concatenate([np.stack([np.full(4, 0.5), np.linspace(0.38, 0.58, 4)], 1),
+                           np.stack([np.linspace(0.42, 0.58, 5), np.full(5, 0.63)], 1)])
+    eye_angles = np.array([np.pi, 2 * np.pi / 3, np.pi / 3, 0, -np.pi / 3, -2 * np.pi / 3])
+    eyes = np.concatenate([ellipse(0.32, 0.4, 0.07, 0.03, eye_angles), ellipse(0.68, 0.4, 0.07, 0.03, eye_angles)])
+    mouth = np.concatenate([ellipse(0.5, 0.78, 0.16, 0.06, np.pi - np.arange(12) * np.pi / 6),
+                            ellipse(0.5, 0.78, 0.1, 0.03, np.pi - np.arange(8) * np.pi / 4)])
+    return np.concatenate([jaw, brows, nose, eyes, mouth]).astype(np.float32)
+
+
+UNIT_LANDMARKS = _unit_landmarks()
+
+
+def face_box(width, height):
+    """
+    Box (x1, y1, x2, y2) of the synthetic face in a full frame
+    """
+    size = 0.45 * min(width, height)
+    cx, cy = width / 2., 0.48 * height
+    return int(cx - size / 2), int(cy - size / 2), int(cx + size / 2), int(cy + size / 2)
+
+
+def crop_face_box(width, height):
+    """
+    Box of the face in a face crop, where it fills most of the image
+    """
+    return int(0.1 * width), int(0.05 * height), int(0.9 * width), int(0.95 * height)
+
+
+def landmarks(box):
+    """
+    68 point landmarks of the synthetic face in a box (x1, y1, x2, y2)
+    """
+    x1, y1, x2, y2 = box
+    return UNIT_LANDMARKS * np.array([x2 - x1, y2 - y1], dtype=np.float32) + np.array([x1, y1], dtype=np.float32)
+
+
+def five_points(lm):
+    """
+    Eyes, nose tip and mouth corners of 68 point landmarks
+    """
+    return np.stack([lm[36:42].mean(0), lm[42:48].mean(0), lm[30], lm[48], lm[54]])
+
+
+def speech_envelope(seconds, rate):
+    """
+    Loudness of the synthetic speech sampled at `rate`, syllables at 4 Hz with a
+    short pause every 2 seconds
+    """
+    t = np.arange(int(seconds * rate)) / float(rate)
+    envelope = np.abs(np.sin(np.pi * 4 * t)) ** 0.5
+    envelope[(t % 2.) > 1.7] = 0.
+    return envelope.astype(np.float32)
+
+
+def synthetic_speech(path, seconds, seed=0):
+    """
+    Writes a 16 kHz speech-like wav file: a harmonic voice under the syllable envelope
+    """
+    t = np.arange(int(seconds * SAMPLE_RATE)) / float(SAMPLE_RATE)
+    f0 = 120. + 20. * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / SAMPLE_RATE
+    voice = sum(np.sin(k * phase) / k for k in range(1, 9))
+    noise = np.random.RandomState(seed).randn(len(t)) * 0.05
+    wav = (voice + noise) * speech_envelope(seconds, SAMPLE_RATE)
+    wav = 0.5 * wav / max(float(np.abs(wav).max()), 1e-8)
+    wavfile.write(path, SAMPLE_RATE, (wav * 32767).astype(np.int16))
+    return path
+
+
+def synthetic_clip(path, seconds, width, height, fps, seed=0):
+    """
+    Writes a synthetic talking head video: a drawn face swaying slightly, with the
+    mouth opening on the syllables of synthetic_speech
+    """
+    rng = np.random.RandomState(seed)
+    gradient = np.linspace(60, 160, width, dtype=np.float32)[None, :, None]
+    background = np.clip(gradient + rng.randn(height, width, 3) * 8, 0, 255).astype(np.uint8)
+    envelope = speech_envelope(seconds, fps)
+
+    with FFmpegWriter(path, fps, (width, height), codec='libx264', crf=18, preset='ultrafast') as writer:
+        for idx, opening in enumerate(envelope):
+            frame = background.copy()
+            sway = int(0.01 * width * np.sin(2 * np.pi * idx / (3. * fps)))
+            x1, y1, x2, y2 = face_box(width, height)
+            x1, x2 = x1 + sway, x2 + sway
+            size = x2 - x1
+            lm = landmarks((x1, y1, x2, y2))
+            cv2.ellipse(frame, ((x1 + x2) // 2, (y1 + y2) // 2), (int(0.45 * size), int(0.55 * size)), 0, 0, 360,
+                        (140, 170, 210), -1)
+            for eye in (lm[36:42], lm[42:48]):
+                center = tuple(int(v) for v in eye.mean(0))
+                cv2.ellipse(frame, center, (int(0.07 * size), int(0.03 * size)), 0, 0, 360, (245, 245, 245), -1)
+                cv2.circle(frame, center, max(1, int(0.02 * size)), (40, 30, 30), -1)
+            for brow in (lm[17:22], lm[22:27]):
+                cv2.polylines(frame, [brow.astype(np.int32)], False, (60, 70, 90), max(1, size // 60))
+            cv2.polylines(frame, [lm[27:31].astype(np.int32)], False, (110, 130, 170), max(1, size // 80))
+            mouth = tuple(int(v) for v in lm[48:60].mean(0))
+            cv2.ellipse(frame, mouth, (int(0.16 * size), max(1, int((0.01 + 0.07 * opening) * size))), 0, 0, 360,
+                        (70, 60, 160), -1)
+            writer.write(frame)
+    return path
+
+
+def _init_weights(module, seed, scale=0.05):
+    generator = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        for param in module.parameters():
+            param.copy_(torch.randn(param.shape, generator=generator) * scale)
+    return module.eval()
+
+
+class StubImageNet(torch.nn.Module):
+    """
+    Two small convolutions added to the input image, the stand-in of the image to
+    image networks (GPEN, GFPGAN). Inputs and outputs are in [-1, 1].
+    """
+    def __init__(self, seed=0, width=8):
+        super(StubImageNet, self).__init__()
+        self.conv1 = torch.nn.Conv2d(3, width, 3, padding=1)
+        self.conv2 = torch.nn.Conv2d(width, 3, 3, padding=1)
+        _init_weights(self, seed)
+
+    def forward(self, x, *args, **kwargs):
+        out = torch.clamp(x + 0.1 * torch.tanh(self.conv2(torch.relu(self.conv1(x)))), -1, 1)
+        return out, None
+
+
+class StubFace3DNet(torch.nn.Module):
+    """
+    face3d reconstruction stand-in, (B, 3, 224, 224) faces to (B, 257) coefficients
+    """
+    def __init__(self, seed=1):
+        super(StubFace3DNet, self).__init__()
+        self.fc = torch.nn.Linear(3 * 8 * 8, 257)
+        _init_weights(self, seed)
+
+    def forward(self, x):
+        return self.fc(F.adaptive_avg_pool2d(x, 8).flatten(1))
+
+
+class StubDNet(torch.nn.Module):
+    """
+    DNet stand-in, re-renders the source face under the driving coefficients
+    """
+    def __init__(self, seed=2, width=8):
+        super(StubDNet, self).__init__()
+        self.conv1 = torch.nn.Conv2d(3, width, 3, padding=1)
+        self.conv2 = torch.nn.Conv2d(width, 3, 3, padding=1)
+        self.fc = torch.nn.Linear(1, 3)
+        _init_weights(self, seed)
+
+    def forward(self, source, coeff):
+        shift = self.fc(coeff.mean((1, 2))[:, None])[:, :, None, None]
+        out = source + 0.1 * torch.tanh(self.conv2(torch.relu(self.conv1(source))) + shift)
+        return {'fake_image': torch.clamp(out, -1, 1)}
+
+
+class StubLNet(torch.nn.Module):
+    """
+    LNet and ENet stand-in, paints the mouth of the reference under the mel chunk.
+    Images are in [0, 1], the prediction has the size of the input faces.
+    """
+    def __init__(self, seed=3, width=8):
+        super(StubLNet, self).__init__()
+        self.conv1 = torch.nn.Conv2d(6, width, 3, padding=1)
+        self.conv2 = torch.nn.Conv2d(width, 3, 3, padding=1)
+        self.fc = torch.nn.Linear(80, 3)
+        _init_weights(self, seed)
+
+    def forward(self, mel, img, reference):
+        audio = self.fc(mel.mean((1, 3)))[:, :, None, None]
+        pred = torch.clamp(reference + 0.1 * torch.tanh(self.conv2(torch.relu(self.conv1(img))) + audio), 0, 1)
+        return pred, F.interpolate(pred, scale_factor=0.25, mode='bilinear', align_corners=False)
+
+
+class StubParserNet(torch.nn.Module):
+    """
+    Face parser stand-in: a fixed layout of the synthetic face (skin, mouth and lips)
+    perturbed by a small convolution, 19 label logits at the input resolution
+    """
+    def __init__(self, seed=4, resolution=64):
+        super(StubParserNet, self).__init__()
+        self.resolution = resolution
+        self.conv = torch.nn.Conv2d(3, 19, 3, padding=1)
+        _init_weights(self, seed, scale=0.01)
+
+        ys, xs = np.mgrid[0:resolution, 0:resolution] / float(resolution)
+        prior = np.zeros((19, resolution, resolution), dtype=np.float32)
+        prior[0] = 0.5
+        prior[SKIN_LABEL] = (((xs - 0.5) / 0.45) ** 2 + ((ys - 0.5) / 0.5) ** 2 < 1)
+        mouth = ((xs - 0.5) / 0.16) ** 2 + ((ys - 0.78) / 0.07) ** 2
+        prior[LIP_LABEL] = 2 * (mouth < 1)
+        prior[MOUTH_LABEL] = 3 * (mouth < 0.3)
+        self.register_buffer('prior', torch.from_numpy(prior)[None])
+
+    def forward(self, x):
+        size = x.shape[-2:]
+        logits = self.conv(F.adaptive_avg_pool2d(x, self.resolution)) + self.prior
+        return F.interpolate(logits, size=size, mode='bilinear', align_corners=False), None
+
+
+class StubCroper(object):
+    """
+    Croper stand-in, crops around the synthetic face
+    """
+    def get_landmark(self, img_np):
+        height, width = img_np.shape[:2]
+        return landmarks(face_box(width, height))
+
+    def align_face(self, img, lm, output_size=1024):
+        width, height = img.size
+        x1, y1, x2, y2 = face_box(width, height)
+        pad = (x2 - x1) // 4
+        clx, cly, crx, cry = max(0, x1 - pad), max(0, y1 - pad), min(width, x2 + pad), min(height, y2 + pad)
+        return (clx, cly, crx, cry), (x1 - clx, y1 - cly, x2 - clx, y2 - cly)
+
+
+class StubKeypointExtractor(object):
+    """
+    KeypointExtractor stand-in, landmarks of the synthetic face on face crops
+    """
+    def extract_keypoint(self, images, name=None, info=True):
+        if isinstance(images, list):
+            keypoints = np.array([self.extract_keypoint(image) for image in images])
+            if name is not None:
+                np.savetxt(os.path.splitext(name)[0] + '.txt', keypoints.reshape(-1))
+            return keypoints
+        width, height = images.size
+        return landmarks(crop_face_box(width, height))
+
+
+class StubFaceDetector(object):
+    """
+    face_detection.FaceAlignment stand-in, finds the synthetic face in full frames
+    """
+    def get_detections_for_batch(self, images):
+        height, width = images.shape[1:3]
+        return [face_box(width, height) for _ in images]
+
+
+class StubRetinaFace(object):
+    """
+    GPEN face detector stand-in, the synthetic face in a face crop
+    """
+    def detect(self, img):
+        height, width = img.shape[:2]
+        box = crop_face_box(width, height)
+        points = five_points(landmarks(box))
+        return np.array([list(box) + [0.99]], dtype=np.float32), np.concatenate([points[:, 0], points[:, 1]])[None]
+
+
+class StubFaceGAN(object):
+    """
+    GPEN FaceGAN stand-in, same tensor conversions and process() as the upstream class
+    """
+    def __init__(self, device, resolution=512):
+        self.device = device
+        self.resolution = resolution
+        self.model = StubImageNet(seed=5).to(device)
+
+    def process(self, img):
+        img_t = self.img2tensor(cv2.resize(img, (self.resolution, self.resolution)))
+        with torch.no_grad():
+            out, __ = self.model(img_t)
+        return self.tensor2img(out)
+
+    def img2tensor(self, img):
+        img_t = (torch.from_numpy(img).to(self.device) / 255. - 0.5) / 0.5
+        return img_t.permute(2, 0, 1).unsqueeze(0).flip(1)  # BGR -> RGB
+
+    def tensor2img(self, img_t, pmax=255.0, imtype=np.uint8):
+        img_t = (img_t * 0.5 + 0.5).squeeze(0).permute(1, 2, 0).flip(2)  # RGB -> BGR
+        return (np.clip(img_t.float().cpu().numpy(), 0, 1) * pmax).astype(imtype)
+
+
+class StubFaceParse(object):
+    """
+    GPEN FaceParse stand-in
+    """
+    def __init__(self, device, size=512):
+        self.device = device
+        self.size = size
+        self.faceparse = StubParserNet().to(device)
+
+    def img2tensor(self, img):
+        img = img[..., ::-1] / 255.
+        return torch.from_numpy(img.transpose(2, 0, 1).copy()).unsqueeze(0).float().to(self.device)
+
+    def tenor2mask(self, tensor, masks):
+        labels = tensor.argmax(dim=1).cpu().numpy()
+        lookup = np.array(masks, dtype=np.uint8)
+        return [lookup[label] for label in labels]
+
+    def process(self, im, masks):
+        imt = self.img2tensor(cv2.resize(im, (self.size, self.size)))
+        with torch.no_grad():
+            pred_mask, sr_img_tensor = self.faceparse(imt)
+        return self.tenor2mask(pred_mask, masks)[0], sr_img_tensor
+
+
+class StubFaceEnhancement(FaceEnhancement):
+    """
+    GPEN FaceEnhancement over the stand-in detector, GAN and parser. Only __init__,
+    which loads the checkpoints, is replaced: process() and mask_postprocess() are
+    the upstream code, the per-frame reference of BatchedFaceEnhancement and the
+    Poisson blending of Step 6.
+    """
+    def __init__(self, device, size=512):
+        self.use_sr = False
+        self.size = size
+        self.threshold = 0.9
+        self.facedetector = StubRetinaFace()
+        self.facegan = StubFaceGAN(device, size)
+        self.faceparser = StubFaceParse(device, size)
+        self.reference_5pts = get_reference_facial_points((size, size), 0.25, (0, 0), True)
+        self.kernel = np.array(([0.0625, 0.125, 0.0625], [0.125, 0.25, 0.125], [0.0625, 0.125, 0.0625]),
+                               dtype='float32')
+
+
+class StubFaceHelper(object):
+    """
+    facexlib FaceRestoreHelper stand-in. All the per image state lives in instance
+    attributes and clean_all() rebinds them, as BatchedGFPGANer expects.
+    """
+    def __init__(self, face_size=512):
+        self.face_size = face_size
+        self.clean_all()
+
+    def clean_all(self):
+        self.input_img = None
+        self.all_landmarks_5 = []
+        self.affine_matrices = []
+        self.inverse_affine_matrices = []
+        self.cropped_faces = []
+        self.restored_faces = []
+
+    def read_image(self, img):
+        self.input_img = img
+
+    def get_face_landmarks_5(self, only_center_face=False, eye_dist_threshold=None):
+        height, width = self.input_img.shape[:2]
+        self.all_landmarks_5 = [five_points(landmarks(face_box(width, height)))]
+        return len(self.all_landmarks_5)
+
+    def align_warp_face(self):
+        for landmark in self.all_landmarks_5:
+            affine = cv2.estimateAffinePartial2D(landmark, FACE_TEMPLATE_512, method=cv2.LMEDS)[0]
+            self.affine_matrices.append(affine)
+            self.cropped_faces.append(cv2.warpAffine(self.input_img, affine, (self.face_size, self.face_size),
+                                                     borderMode=cv2.BORDER_CONSTANT, borderValue=(135, 133, 132)))
+
+    def add_restored_face(self, face):
+        self.restored_faces.append(face)
+
+    def get_inverse_affine(self, upsample_img=None):
+        self.inverse_affine_matrices = [cv2.invertAffineTransform(affine) for affine in self.affine_matrices]
+
+    def paste_faces_to_input_image(self, upsample_img=None):
+        height, width = self.input_img.shape[:2]
+        img = self.input_img.astype(np.float32)
+        for restored_face, inverse_affine in zip(self.restored_faces, self.inverse_affine_matrices):
+            inv_restored = cv2.warpAffine(restored_face, inverse_affine, (width, height))
+            mask = cv2.warpAffine(np.ones((self.face_size, self.face_size), np.float32), inverse_affine, (width, height))
+            mask = cv2.erode(mask, np.ones((5, 5), np.uint8))
+            mask = cv2.GaussianBlur(mask, (0, 0), 5)[:, :, None]
+            img = mask * inv_restored + (1 - mask) * img
+        return img.astype(np.uint8)
+
+
+class StubGFPGANer(object):
+    """
+    GFPGANer stand-in with the attributes BatchedGFPGANer uses
+    """
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.face_helper = StubFaceHelper()
+        self.gfpgan = StubImageNet(seed=6).to(self.device)
+
+    def enhance(self, img, has_aligned=False, only_center_face=False, paste_back=True):
+        helper = self.face_helper
+        helper.clean_all()
+        helper.read_image(img)
+        helper.get_face_landmarks_5(only_center_face=only_center_face, eye_dist_threshold=5)
+        helper.align_warp_face()
+        for cropped_face in helper.cropped_faces:
+            face_t = torch.from_numpy(cropped_face[..., ::-1].transpose(2, 0, 1).copy()).float() / 127.5 - 1
+            with torch.no_grad():
+                output = self.gfpgan(face_t[None].to(self.device), return_rgb=False)[0][0]
+            restored = (output.clamp(-1, 1).cpu().numpy().transpose(1, 2, 0)[..., ::-1] + 1) * 127.5
+            helper.add_restored_face(restored.astype(np.uint8))
+        helper.get_inverse_affine(None)
+        return helper.cropped_faces, helper.restored_faces, helper.paste_faces_to_input_image()
+
+
+class StubRetalkingEngine(RetalkingEngine):
+    """
+    RetalkingEngine with the stand-in networks, no checkpoint is read
+    """
+    def load_networks(self):
+        device = self.device
+        self.enhancer = StubFaceEnhancement(device)
+        self.restorer = StubGFPGANer(device)
+        self.croper = StubCroper()
+        self.kp_extractor = StubKeypointExtractor()
+        self.detector = StubFaceDetector()
+        self.net_recon = StubFace3DNet().to(device)
+        self.lm3d_std = LM3D_STD
+        self.D_Net = StubDNet().to(device)
+        self.model = StubLNet().to(device)
+        expression = np.random.RandomState(7).randn(1, 64).astype(np.float32) * 0.1
+        self.expressions = {'expression_center': expression, 'expression_mouth': expression * 2}
+
+
+def environment():
+    """
+    Describes the machine and the code the benchmark ran on
+    """
+    def git(*command):
+        try:
+            return subprocess.check_output(['git'] + list(command), cwd=CODE_DIR,
+                                           stderr=subprocess.DEVNULL).decode('utf-8').strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    status = git('status', '--porcelain')
+    return {
+        "commit": git('rev-parse', 'HEAD'),
+        "dirty": bool(status) if status is not None else None,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+    }
+
+
+def summarize(reports):
+    """
+    Median timings and maximum memory peaks over the reports of the repeats
+    """
+    steps = {}
+    for report in reports:
+        for stats in report['steps']:
+            steps.setdefault(stats['name'], []).append(stats)
+
+    summary = {}
+    for name, runs in steps.items():
+        seconds = float(np.median([stats['seconds'] for stats in runs]))
+        frames = int(np.median([stats['frames'] for stats in runs]))
+        summary[name] = {
+            "frames": frames,
+            "seconds": round(seconds, 4),
+            "fps": round(frames / seconds, 3) if seconds > 0 and frames else None,
+            "peak_rss_mb": max(stats['peak_rss_mb'] for stats in runs),
+        }
+    wall_seconds = float(np.median([report['wall_seconds'] for report in reports]))
+    output_frames = summary.get('encode', {}).get('frames', 0)
+    return {
+        "wall_seconds": round(wall_seconds, 4),
+        "output_frames": output_frames,
+        "fps": round(output_frames / wall_seconds, 3) if wall_seconds > 0 else None,
+        "peak_rss_mb": max(report['peak_rss_mb'] for report in reports),
+        "steps": summary,
+    }
+
+
+def parse_option(text):
+    """
+    Parses a --option key=value, the value as JSON when possible
+    """
+    key, sep, value = text.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError('Expected key=value, got {}'.format(text))
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def run(args):
+    """
+    Runs the benchmark and writes the baseline to args.output
+    """
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    width, height = [int(value) for value in args.resolution.lower().split('x')]
+    options = dict(args.option)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='retalking_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+
+    try:
+        video = synthetic_clip(os.path.join(work_dir, 'clip.mp4'), args.seconds, width, height, args.fps)
+        audio = synthetic_speech(os.path.join(work_dir, 'speech.wav'), args.seconds)
+        print('[Benchmark] {}x{} clip, {:.1f}s at {} fps'.format(width, height, args.seconds, args.fps))
+
+        started = time.time()
+        engine = StubRetalkingEngine(build_options(), device='cpu')
+        load_seconds = time.time() - started
+        # the defaults check the option names before anything runs
+        engine.options(video, audio, '', options)
+
+        reports = []
+        for idx in range(args.warmup + args.repeat):
+            run_dir = os.path.join(work_dir, 'run_{}'.format(idx))
+            os.makedirs(run_dir, exist_ok=True)
+            run_options = dict(options, tmp_dir=run_dir, cache_dir=os.path.join(run_dir, 'cache'), profile_report=True)
+            outfile = os.path.join(run_dir, 'out.mp4')
+            engine.run(video, audio, outfile, run_options)
+            with open(report_path(outfile)) as f:
+                report = json.load(f)
+            if idx >= args.warmup:
+                reports.append(report)
+            shutil.rmtree(run_dir, ignore_errors=True)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = {
+        "version": BASELINE_VERSION,
+        "created": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "environment": environment(),
+        "config": {"seconds": args.seconds, "width": width, "height": height, "fps": args.fps,
+                   "repeat": args.repeat, "warmup": args.warmup, "options": options},
+        "load_seconds": round(load_seconds, 4),
+        "summary": summarize(reports),
+        "runs": reports,
+    }
+    if os.path.dirname(args.output):
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(baseline, f, indent=2)
+
+    summary = baseline['summary']
+    for name, stats in summary['steps'].items():
+        print('[Benchmark] {}: {:.3f}s, {} fps, peak RSS {:.0f} MB'.format(
+            name, stats['seconds'], stats['fps'] or '-', stats['peak_rss_mb']))
+    print('[Benchmark] total: {:.2f}s, {} output fps, peak RSS {:.0f} MB, written to {}'.format(
+        summary['wall_seconds'], summary['fps'], summary['peak_rss_mb'], args.output))
+    return baseline
+
+
+def compare(baseline, current, tolerance=0.1):
+    """
+    Compares two benchmark results step by step
+
+    Args:
+        baseline (dict): Reference result, e.g. of the last release
+        current (dict): Result to check
+        tolerance (float): Relative slowdown or memory growth reported as a regression
+
+    Returns:
+        list: Names of the regressed steps, 'total' for the whole run
+    """
+    for key in ['seconds', 'width', 'height', 'fps', 'options']:
+        if baseline['config'].get(key) != current['config'].get(key):
+            print('[Compare] Warning: {} differs ({} vs {}), the results are not comparable'.format(
+                key, baseline['config'].get(key), current['config'].get(key)))
+    for key in ['cpu_count', 'torch_threads', 'torch']:
+        if baseline['environment'].get(key) != current['environment'].get(key):
+            print('[Compare] Warning: {} differs ({} vs {})'.format(
+                key, baseline['environment'].get(key), current['environment'].get(key)))
+
+    old_summary, new_summary = baseline['summary'], current['summary']
+    rows = [(name, old_summary['steps'].get(name), new_summary['steps'].get(name))
+            for name in list(old_summary['steps']) + [name for name in new_summary['steps']
+                                                      if name not in old_summary['steps']]]
+    rows.append(('total', old_summary, new_summary))
+
+    print('{:<16}{:>12}{:>12}{:>9}{:>12}{:>12}{:>9}'.format('step', 'base s', 'current s', 'time', 'base MB',
+                                                          'current MB', 'memory'))
+    regressions = []
+    for name, old, new in rows:
+        if old is None or new is None:
+            print('{:<16}{}'.format(name, 'only in the current run' if old is None else 'only in the baseline'))
+            continue
+        old_seconds = old.get('seconds', old.get('wall_seconds'))
+        new_seconds = new.get('seconds', new.get('wall_seconds'))
+        time_change = new_seconds / old_seconds - 1 if old_seconds > 0 else 0.
+        memory_change = new['peak_rss_mb'] / old['peak_rss_mb'] - 1 if old['peak_rss_mb'] > 0 else 0.
+        regressed = time_change > tolerance or memory_change > tolerance
+        if regressed:
+            regressions.append(name)
+        print('{:<16}{:>12.3f}{:>12.3f}{:>+8.1f}%{:>12.0f}{:>12.0f}{:>+8.1f}%{}'.format(
+            name, old_seconds, new_seconds, 100 * time_change, old['peak_rss_mb'], new['peak_rss_mb'],
+            100 * memory_change, '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def frame_drift(reference_path, path):
+    """
+    Mean absolute error, maximum error and PSNR of the frames of a video against a
+    reference video
+    """
+    squared, absolute, maximum, count = 0., 0., 0, 0
+    for reference, frame in zip(FrameReader(reference_path).read(), FrameReader(path).read()):
+        diff = np.abs(reference.astype(np.int16) - frame.astype(np.int16))
+        squared += float(np.square(diff, dtype=np.float64).mean())
+        absolute += float(diff.mean())
+        maximum = max(maximum, int(diff.max()))
+        count += 1
+    mse = squared / max(count, 1)
+    return {
+        "frames": count,
+        "mean_abs_error": round(absolute / max(count, 1), 4),
+        "max_error": maximum,
+        "psnr": round(10 * np.log10(255. ** 2 / mse), 2) if mse > 0 else float('inf'),
+    }
+
+
+def lip_sync_lossless(engine, video, audio, run_dir, options):
+    """
+    Lip syncs the clip into run_dir with a lossless encode, the codec would hide
+    small differences. Returns the output video.
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    options = dict(options, tmp_dir=run_dir, cache_dir=os.path.join(run_dir, 'cache'), output_crf=0,
+                   output_preset='ultrafast', profile_report=False)
+    return engine.run(video, audio, os.path.join(run_dir, 'out.mp4'), options)[0]
+
+
+def drift(args):
+    """
+    Compares the output of every precision and memory format mode to fp32
+
+    Returns:
+        list: Names of the modes under args.min_psnr, or a failure when every mode was skipped
+    """
+    width, height = [int(value) for value in args.resolution.lower().split('x')]
+    modes = [(precision, args.channels_last) for precision in args.precision]
+    if args.channels_last and ('fp32', True) not in modes:
+        modes.insert(0, ('fp32', True))
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='retalking_drift_')
+    os.makedirs(work_dir, exist_ok=True)
+
+    failures = []
+    compared = 0
+    try:
+        video = synthetic_clip(os.path.join(work_dir, 'clip.mp4'), args.seconds, width, height, args.fps)
+        audio = synthetic_speech(os.path.join(work_dir, 'speech.wav'), args.seconds)
+        engine = StubRetalkingEngine(build_options(), device=args.device)
+
+        def lip_sync(name, precision, channels_last):
+            return lip_sync_lossless(engine, video, audio, os.path.join(work_dir, name),
+                                     dict(args.option, precision=precision, channels_last=channels_last))
+
+        reference = lip_sync('fp32', 'fp32', False)
+        print('{:<24}{:>8}{:>12}{:>10}{:>10}'.format('mode', 'frames', 'mean error', 'max', 'PSNR'))
+        for precision, channels_last in modes:
+            name = precision + ('+channels_last' if channels_last else '')
+            try:
+                check_precision(precision, args.device)
+            except ValueError as error:
+                print('{:<24}skipped, {}'.format(name, error))
+                continue
+            compared += 1
+            stats = frame_drift(reference, lip_sync(name, precision, channels_last))
+            failed = stats['psnr'] < args.min_psnr
+            if failed:
+                failures.append(name)
+            print('{:<24}{:>8}{:>12.3f}{:>10}{:>10.2f}{}'.format(name, stats['frames'], stats['mean_abs_error'],
+                                                              stats['max_error'], stats['psnr'],
+                                                              '  DRIFT' if failed else ''))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if not compared:
+        print('No mode compared, {} supports none of {}'.format(args.device, ', '.join(args.precision)))
+        failures.append('no mode compared')
+    return failures
+
+
+def stabilization_error(num_frames=60, one_shot=False, seed=0):
+    """
+    Largest difference between the Step 3 driving coefficients of stabilization_coeffs
+    and the per-frame find_crop_norm_ratio and transform_semantic of upstream, inf when
+    their shapes differ
+    """
+    rng = np.random.RandomState(seed)
+    # id, exp, tex, angle, gamma, trans (257) and the align_img params w0, h0, s, tx, ty
+    semantic_npy = (rng.randn(num_frames, 262) * 0.1).astype(np.float32)
+    semantic_npy[:, 257:262] = np.array([256., 256., 1., 128., 128.], dtype=np.float32) + \
+                               (rng.rand(num_frames, 5) * 0.1).astype(np.float32)
+    expression = torch.from_numpy(rng.randn(64).astype(np.float32))
+
+    reference = []
+    for idx in range(num_frames):
+        source = semantic_npy[0:1] if one_shot else semantic_npy[idx:idx + 1]
+        coeff = transform_semantic(semantic_npy, idx, find_crop_norm_ratio(source, semantic_npy)).numpy()
+        coeff[:64] = expression[:64, None].numpy()
+        reference.append(coeff)
+    reference = np.array(reference)
+
+    coeffs = stabilization_coeffs(semantic_npy, expression, crop_norm_ratios(semantic_npy, one_shot))
+    if coeffs.shape != reference.shape:
+        print('[Equivalence] stabilization: shape {} instead of {}'.format(coeffs.shape, reference.shape))
+        return float('inf')
+    return float(np.abs(coeffs - reference).max())
+
+
+def preprocessed_coeffs(engine, video, audio, run_dir, options):
+    """
+    Runs Steps 0-3 into run_dir and returns the 3DMM coefficients they cached
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    options = dict(options, tmp_dir=run_dir, cache_dir=os.path.join(run_dir, 'cache'), preprocess_only=True,
+                   profile_report=False)
+    engine.run(video, audio, '', options)
+    args = engine.options(video, audio, '', options)
+    cache = PreprocessCache.from_args(args)
+    return cache.load(cache.video_key(args), 'coeffs.npy')
+
+
+def equivalence(args):
+    """
+    Runs the equivalence checks
+
+    Returns:
+        list: Names of the failed checks
+    """
+    failures = []
+    for one_shot in (False, True):
+        name = 'stabilization' + (' one-shot' if one_shot else '')
+        error = stabilization_error(one_shot=one_shot)
+        failed = error > args.max_coeff_error
+        if failed:
+            failures.append(name)
+        print('[Equivalence] {}: max coefficient error {:.3g}{}'.format(name, error, '  FAILED' if failed else ''))
+
+    width, height = [int(value) for value in args.resolution.lower().split('x')]
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='retalking_equivalence_')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        video = synthetic_clip(os.path.join(work_dir, 'clip.mp4'), args.seconds, width, height, args.fps)
+        audio = synthetic_speech(os.path.join(work_dir, 'speech.wav'), args.seconds)
+        engine = StubRetalkingEngine(build_options(), device='cpu')
+
+        # Step 2 one face at a time in the main thread, like upstream, against the batched defaults
+        reference = preprocessed_coeffs(engine, video, audio, os.path.join(work_dir, '3dmm_reference'),
+                                        {'face3d_batch_size': 1, 'face3d_workers': 0})
+        coeffs = preprocessed_coeffs(engine, video, audio, os.path.join(work_dir, '3dmm'), {})
+        error = float(np.abs(coeffs - reference).max()) if coeffs.shape == reference.shape else float('inf')
+        failed = error > args.max_3dmm_error
+        if failed:
+            failures.append('3dmm batching')
+        print('[Equivalence] 3dmm batching: {} frames, max coefficient error {:.3g}{}'.format(
+            len(reference), error, '  FAILED' if failed else ''))
+
+        for idx, (name, reference_options, options, min_psnr) in enumerate(OUTPUT_CHECKS):
+            reference = lip_sync_lossless(engine, video, audio, os.path.join(work_dir, '{}_reference'.format(idx)),
+                                          reference_options)
+            stats = frame_drift(reference, lip_sync_lossless(engine, video, audio,
+                                                             os.path.join(work_dir, str(idx)), options))
+            failed = stats['psnr'] < min_psnr
+            if failed:
+                failures.append(name)
+            print('[Equivalence] {}: {} frames, mean error {:.3f}, max {}, PSNR {:.2f} (min {}){}'.format(
+                name, stats['frames'], stats['mean_abs_error'], stats['max_error'], stats['psnr'], min_psnr,
+                '  FAILED' if failed else ''))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline CPU benchmark of the retalking pipeline')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('--seconds', type=float, default=4., help='Length of the synthetic clip')
+    run_parser.add_argument('--resolution', type=str, default='640x360', help='WIDTHxHEIGHT of the synthetic clip')
+    run_parser.add_argument('--fps', type=float, default=25., help='Frame rate of the synthetic clip')
+    run_parser.add_argument('--repeat', type=int, default=3, help='Measured runs, the summary is their median')
+    run_parser.add_argument('--warmup', type=int, default=1, help='Runs before the measured ones')
+    run_parser.add_argument('--threads', type=int, default=0, help='torch CPU threads, 0 keeps the torch default')
+    run_parser.add_argument('--option', type=parse_option, action='append', default=[], metavar='KEY=VALUE',
+                            help='Retalking option of every run, e.g. stream_window=32. Can be repeated')
+    run_parser.add_argument('--work_dir', type=str, default='',
+                            help='Keep the synthetic inputs here instead of a temporary directory')
+    run_parser.add_argument('--output', type=str, default='benchmark.json', help='Result JSON')
+
+    compare_parser = subparsers.add_parser('compare')
+    compare_parser.add_argument('baseline', help='Reference result JSON')
+    compare_parser.add_argument('current', help='Result JSON to check')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1,
+                                help='Relative slowdown or memory growth reported as a regression')
+
+    drift_parser = subparsers.add_parser('drift')
+    drift_parser.add_argument('--seconds', type=float, default=2., help='Length of the synthetic clip')
+    drift_parser.add_argument('--resolution', type=str, default='640x360', help='WIDTHxHEIGHT of the synthetic clip')
+    drift_parser.add_argument('--fps', type=float, default=25., help='Frame rate of the synthetic clip')
+    drift_parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                              help='Torch device of the stand-in networks, cuda when available')
+    drift_parser.add_argument('--precision', type=str, nargs='+', default=['fp16', 'bf16'],
+                              help='Precisions compared to fp32')
+    drift_parser.add_argument('--channels_last', action='store_true',
+                              help='Run the compared modes, and fp32, with channels last weights')
+    drift_parser.add_argument('--min_psnr', type=float, default=40.,
+                              help='PSNR against the fp32 frames under which a mode fails')
+    drift_parser.add_argument('--option', type=parse_option, action='append', default=[], metavar='KEY=VALUE',
+                              help='Retalking option of every run. Can be repeated')
+    drift_parser.add_argument('--work_dir', type=str, default='',
+                              help='Keep the inputs and outputs here instead of a temporary directory')
+
+    equivalence_parser = subparsers.add_parser('equivalence')
+    equivalence_parser.add_argument('--seconds', type=float, default=2., help='Length of the synthetic clip')
+    equivalence_parser.add_argument('--resolution', type=str, default='640x360',
+                                    help='WIDTHxHEIGHT of the synthetic clip')
+    equivalence_parser.add_argument('--fps', type=float, default=25., help='Frame rate of the synthetic clip')
+    equivalence_parser.add_argument('--work_dir', type=str, default='',
+                                    help='Keep the inputs and outputs here instead of a temporary directory')
+    equivalence_parser.add_argument('--max_coeff_error', type=float, default=1e-5,
+                                    help='Largest difference of the Step 3 driving coefficients of the equivalent paths')
+    equivalence_parser.add_argument('--max_3dmm_error', type=float, default=1e-4,
+                                    help='Largest difference of the batched 3DMM coefficients, batched convolutions '
+                                         'do not round like single images')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'drift':
+        if drift(args):
+            sys.exit(1)
+    elif args.command == 'equivalence':
+        if equivalence(args):
+            sys.exit(1)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        if compare(baseline, current, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""
+compositor.py
+
+    Description:
+        Step 6 compositing. Pastes the LNet predictions into their frames, restores
+        the mouth region with GFPGAN and blends the result back into the original
+        frames. GFPGAN and the face parser run once per LNet batch. By default only a
+        padded region around the face is processed, at native resolution, and faded
+        back into the untouched frame.
+
+        The mouth blends are CPU bound and can run on a BlendPool of worker
+        processes, which map the images of a batch from shared memory.
+"""
+import atexit
+import multiprocessing
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from utils.inference_utils import Laplacian_Pyramid_Blending_with_mask
+
+from enhancement import MOUTH_LABELS
+from instrumentation import step
+
+
+# pyramid depth of the mouth blend at native resolution, the ROI is padded to a multiple of 2 ** (levels - 1)
+ROI_BLEND_LEVELS = 6
+
+
+def roi_box(coords, frame_shape, pad):
+    """
+    Face box (y1, y2, x1, x2) grown by `pad` times its size on every side, clipped to the frame
+    """
+    y1, y2, x1, x2 = coords
+    height, width = frame_shape[:2]
+    pad_y, pad_x = int((y2 - y1) * pad), int((x2 - x1) * pad)
+    return max(0, y1 - pad_y), min(height, y2 + pad_y), max(0, x1 - pad_x), min(width, x2 + pad_x)
+
+
+def feather_weights(roi, frame_shape, margin):
+    """
+    Paste back weights of a ROI: 1 inside, ramping down to 0 over `margin` pixels
+    towards the ROI edges that are inside the frame
+
+    Returns:
+        np.ndarray: (H, W, 1) float32 weights
+    """
+    ry1, ry2, rx1, rx2 = roi
+    height, width = frame_shape[:2]
+    margin = max(1, margin)
+    ys = np.full(ry2 - ry1, np.inf, dtype=np.float32)
+    xs = np.full(rx2 - rx1, np.inf, dtype=np.float32)
+    if ry1 > 0: ys = np.minimum(ys, np.arange(len(ys)) + 1)
+    if ry2 < height: ys = np.minimum(ys, len(ys) - np.arange(len(ys)))
+    if rx1 > 0: xs = np.minimum(xs, np.arange(len(xs)) + 1)
+    if rx2 < width: xs = np.minimum(xs, len(xs) - np.arange(len(xs)))
+    return np.clip(np.minimum(ys[:, None], xs[None, :]) / margin, 0, 1)[:, :, np.newaxis].astype(np.float32)
+
+
+def blend_native(restored_img, ff, mask, levels=ROI_BLEND_LEVELS):
+    """
+    Laplacian pyramid blend at the image resolution, the images are reflect padded
+    to the size the pyramid needs
+
+    Returns:
+        np.ndarray: Blended float image, same size as the inputs
+    """
+    height, width = ff.shape[:2]
+    multiple = 2 ** (levels - 1)
+    pad_y, pad_x = -height % multiple, -width % multiple
+    if pad_y or pad_x:
+        restored_img, ff, mask = [cv2.copyMakeBorder(x, 0, pad_y, 0, pad_x, cv2.BORDER_REFLECT)
+                                  for x in (restored_img, ff, mask)]
+    img = Laplacian_Pyramid_Blending_with_mask(restored_img, ff, mask, levels)
+    return img[:height, :width]
+
+
+def blend_mouth(restored_img, ff, mask, native=True, levels=0):
+    """
+    Blends the restored mouth region into the frame with the LNet prediction
+
+    Args:
+        restored_img (np.ndarray): GFPGAN output
+        ff (np.ndarray): Frame with the LNet prediction pasted in
+        mask (np.ndarray): (H, W) float32 mouth mask
+        native (bool): Blend at the image resolution, else at 512x512 like upstream
+        levels (int): Pyramid depth, 0 for ROI_BLEND_LEVELS natively and 10 at 512x512
+
+    Returns:
+        np.ndarray: uint8 image of the size of ff
+    """
+    if native:
+        return np.uint8(np.clip(blend_native(restored_img, ff, mask, levels or ROI_BLEND_LEVELS), 0, 255))
+    height, width = ff.shape[:2]
+    restored_img, ff, mask = [cv2.resize(x, (512, 512)) for x in (restored_img, ff, mask)]
+    img = Laplacian_Pyramid_Blending_with_mask(restored_img, ff, mask, levels or 10)
+    return np.uint8(cv2.resize(np.clip(img, 0 ,255), (width, height)))
+
+
+# shared memory the worker process is attached to
+_worker_arena = None
+
+
+def _array(buf, spec):
+    offset, shape, dtype = spec
+    return np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+
+
+def _blend_job(task):
+    """
+    BlendPool task: blends the images at the given places of the arena in place
+    """
+    global _worker_arena
+    name, specs, native, levels = task
+    if _worker_arena is None or _worker_arena.name != name:
+        if _worker_arena is not None:
+            _worker_arena.close()
+        _worker_arena = shared_memory.SharedMemory(name=name)
+    restored_img, ff, mask, out = [_array(_worker_arena.buf, spec) for spec in specs]
+    out[...] = blend_mouth(restored_img, ff, mask, native, levels)
+
+
+class BlendPool(object):
+    """
+    Worker processes for the mouth blends of composite_batch. The images of a batch
+    are packed into one shared memory arena, grown as needed and reused between
+    batches. The workers write the blended images back into it, so no image is
+    pickled. Jobs of a batch run in parallel and come back in order.
+
+    Args:
+        workers (int): Number of worker processes
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        # spawned, the parent holds CUDA contexts and threads that fork would copy
+        self.pool = multiprocessing.get_context('spawn').Pool(workers)
+        self.arena = None
+        atexit.register(self.close)
+
+    def _reserve(self, size):
+        if self.arena is not None and self.arena.size >= size:
+            return
+        self._release_arena()
+        # some headroom, batch sizes vary with the face size
+        self.arena = shared_memory.SharedMemory(create=True, size=int(size * 1.25) + 1)
+
+    def _release_arena(self):
+        if self.arena is not None:
+            self.arena.close()
+            self.arena.unlink()
+            self.arena = None
+
+    def blend(self, jobs, native=True, levels=0):
+        """
+        Runs blend_mouth over (restored_img, ff, mask) jobs
+
+        Returns:
+            list: uint8 blended images, in the order of the jobs
+        """
+        layout, size = [], 0
+        for restored_img, ff, mask in jobs:
+            specs = []
+            for shape, dtype in [(x.shape, x.dtype.str) for x in (restored_img, ff, mask)] + [(ff.shape, '|u1')]:
+                specs.append((size, shape, dtype))
+                # 64 byte aligned
+                size += -(-int(np.prod(shape)) * np.dtype(dtype).itemsize // 64) * 64
+            layout.append(specs)
+        self._reserve(size)
+
+        for (restored_img, ff, mask), specs in zip(jobs, layout):
+            for x, spec in zip((restored_img, ff, mask), specs):
+                _array(self.arena.buf, spec)[...] = x
+        self.pool.map(_blend_job, [(self.arena.name, specs, native, levels) for specs in layout], chunksize=1)
+        return [_array(self.arena.buf, specs[3]).copy() for specs in layout]
+
+    def close(self):
+        """
+        Stops the workers and frees the shared memory
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self._release_arena()
+
+
+def composite_batch(pred, full_frames, coords, face_restorer, face_enhancer, roi_pad=0., blend_pool=None,
+                    blend_levels=0, poisson_blending=True):
+    """
+    Composites one LNet batch into output frames
+
+    Args:
+        pred (np.ndarray): LNet predictions, (B, H, W, 3) in [0, 255]
+        full_frames (list): Original BGR frames
+        coords (list): Face box (y1, y2, x1, x2) of every frame
+        face_restorer (BatchedGFPGANer): GFPGAN restorer, None blends the LNet prediction as it is
+        face_enhancer (BatchedFaceEnhancement): GPEN enhancer, used for parsing and Poisson blending
+        roi_pad (float): Restore and blend only the face box grown by `roi_pad` times its
+            size on every side, at native resolution, and leave every other pixel of the
+            frame untouched. 0 or less runs on the full frames, resized to 512x512 for the
+            mouth blend.
+        blend_pool (BlendPool): Worker processes for the mouth blends, None blends in
+            the calling thread
+        blend_levels (int): Depth of the mouth blend pyramid, see blend_mouth
+        poisson_blending (bool): Finish with GPEN's Poisson blending of the face
+
+    Returns:
+        list: Output BGR frames, in order
+    """
+    if roi_pad > 0:
+        rois = [roi_box(c, xf.shape, roi_pad) for xf, c in zip(full_frames, coords)]
+        frames = [xf[ry1:ry2, rx1:rx2] for xf, (ry1, ry2, rx1, rx2) in zip(full_frames, rois)]
+        boxes = [(y1 - ry1, y2 - ry1, x1 - rx1, x2 - rx1) for (y1, y2, x1, x2), (ry1, _, rx1, _) in zip(coords, rois)]
+    else:
+        frames, boxes = full_frames, coords
+
+    ffs = []
+    for p, xf, (y1, y2, x1, x2) in zip(pred, frames, boxes):
+        p = cv2.resize(p.astype(np.uint8), (x2 - x1, y2 - y1))
+        ff = xf.copy()
+        ff[y1:y2, x1:x2] = p
+        ffs.append(ff)
+
+    if face_restorer is not None:
+        # month region enhancement by GFPGAN
+        with step('restore', len(ffs)):
+            restored_imgs = face_restorer.enhance(ffs, only_center_face=True)
+
+    with step('blend', len(ffs)):
+        if face_restorer is None:
+            # without the restored mouth there is nothing to blend, the prediction stays as pasted
+            blended = ffs
+        else:
+            tmp_masks = face_enhancer.parse_faces([restored_img[y1:y2, x1:x2] for restored_img, (y1, y2, x1, x2)
+                                                   in zip(restored_imgs, boxes)], MOUTH_LABELS)
+
+            jobs = []
+            for restored_img, ff, (y1, y2, x1, x2), tmp_mask in zip(restored_imgs, ffs, boxes, tmp_masks):
+                mouse_mask = np.zeros_like(restored_img)
+                mouse_mask[y1:y2, x1:x2]= cv2.resize(tmp_mask, (x2 - x1, y2 - y1))[:, :, np.newaxis] / 255.
+                jobs.append((restored_img, ff, np.float32(mouse_mask[:, :, 0])))
+            if blend_pool is not None:
+                blended = blend_pool.blend(jobs, native=roi_pad > 0, levels=blend_levels)
+            else:
+                blended = [blend_mouth(restored_img, ff, mask, native=roi_pad > 0, levels=blend_levels)
+                           for restored_img, ff, mask in jobs]
+
+        out_frames = []
+        for idx, (pp, xf, c) in enumerate(zip(blended, frames, boxes)):
+            y1, y2, x1, x2 = c
+            if poisson_blending:
+                pp, orig_faces, enhanced_faces = face_enhancer.enhancer.process(pp, xf, bbox=c, face_enhance=False, possion_blending=True)
+
+            if roi_pad > 0:
+                # the ROI is faded into the untouched frame over the outer half of its padding
+                ry1, ry2, rx1, rx2 = rois[idx]
+                weights = feather_weights(rois[idx], full_frames[idx].shape, int(roi_pad * min(y2 - y1, x2 - x1) / 2))
+                out = full_frames[idx].copy()
+                out[ry1:ry2, rx1:rx2] = np.uint8(np.clip(pp * weights + xf * (1 - weights) + 0.5, 0, 255))
+                pp = out
+            out_frames.append(pp)
+    return out_frames
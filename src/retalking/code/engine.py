@@ -0,0 +1,450 @@
+"""
+engine.py
+
+    Description:
+        Resident retalking engine. Every network of the pipeline (GPEN, GFPGAN, the
+        face detector, the landmark and face3d networks, DNet, LNet and ENet) is loaded
+        once when the engine is built, each request then only pays for its own frames.
+        Used by the SageMaker handler (built in model_fn), the Cog predictor and the
+        inference_retalking.py command line.
+"""
+import os
+import sys
+import argparse
+import threading
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+from tqdm import tqdm
+from PIL import Image
+from scipy.io import loadmat
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(CODE_DIR, 'third_part'))
+sys.path.insert(0, os.path.join(CODE_DIR, 'third_part/GPEN'))
+sys.path.insert(0, os.path.join(CODE_DIR, 'third_part/GFPGAN'))
+
+# 3dmm extraction
+from third_part.face3d.util.preprocess import align_img
+from third_part.face3d.util.load_mats import load_lm3d
+from third_part.face3d.extract_kp_videos import KeypointExtractor
+# face enhancement
+from third_part.GPEN.gpen_face_enhancer import FaceEnhancement
+from third_part.GFPGAN.gfpgan import GFPGANer
+# expression control
+from third_part.ganimation_replicate.model.ganimation import GANimationModel
+
+from third_part import face_detection
+
+from utils import audio
+from utils.ffhq_preprocess import Croper
+from utils.inference_utils import load_model, split_coeff, load_face3d_net
+
+from compositor import BlendPool, composite_batch
+from enhancement import BatchedFaceEnhancement, BatchedGFPGANer
+from frame_io import FrameReader, FrameStore, cycle_frames
+from frame_planner import speech_activity, plan_frames, blend_planned
+from instrumentation import Profiler, step, report_path
+from onnx_backend import BACKENDS, OnnxBackend, OnnxNetwork
+from pipeline import Pipeline, Stage
+from precision import activate as activate_precision, set_memory_format
+from presets import apply_preset, cost
+from preprocess_cache import PreprocessCache, is_expression_image, rects_to_array, array_to_rects
+from retalking_options import build_options, default_extra_options
+from stages import FaceRegion, LandmarkService, analyse_video, stabilize_video, face_boxes, iter_frame_items, \
+                   datagen, run_lnet, build_reference_store, iter_stored_frame_items, load_mel_chunks
+from video_writer import FFmpegWriter
+
+
+class RetalkingEngine(object):
+    """
+    Keeps the retalking networks loaded between requests
+
+    Args:
+        args (argparse.Namespace): Default options of every request, see build_options.
+            The model paths are read once here, requests cannot change them.
+        device (str): Torch device, defaults to cuda when available
+    """
+    def __init__(self, args=None, device=None):
+        self.args = args if args is not None else build_options()
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        # one request at a time, the networks and the GPU memory are shared
+        self.lock = threading.Lock()
+        # expression editing is rarely used, loaded on the first request asking for it
+        self.instance = None
+        # mouth blend worker processes, started on the first request using them and kept for the next ones
+        self.blend_pool = None
+        # memory format the network weights are in, see precision.set_memory_format
+        self.channels_last = False
+        # ONNX Runtime graphs of the networks, loaded on the first request using them
+        self.onnx = None
+        print('[Info] Using {} for inference.'.format(self.device))
+        self.load_networks()
+
+    def load_networks(self):
+        """
+        Loads the checkpoints of every network, relative to the code directory
+        """
+        device = self.device
+        self.enhancer = FaceEnhancement(base_dir='checkpoints', size=512, model='GPEN-BFR-512', use_sr=False, \
+                                        sr_model='rrdb_realesrnet_psnr', channel_multiplier=2, narrow=1, device=device)
+        self.restorer = GFPGANer(model_path='checkpoints/GFPGANv1.3.pth', upscale=1, arch='clean', \
+                                 channel_multiplier=2, bg_upsampler=None)
+        self.croper = Croper('checkpoints/shape_predictor_68_face_landmarks.dat')
+        self.kp_extractor = KeypointExtractor()
+        self.detector = face_detection.FaceAlignment(face_detection.LandmarksType._2D, flip_input=False,
+                                                     device=device)
+        self.net_recon = load_face3d_net(self.args.face3d_net_path, device)
+        self.lm3d_std = load_lm3d('checkpoints/BFM')
+        # load DNet, model(LNet and ENet)
+        self.D_Net, self.model = load_model(self.args, device)
+        # expression templates of --exp_img smile and of the default neutral expression
+        self.expressions = loadmat('checkpoints/expression.mat')
+
+    def options(self, video_path, audio_path, out_path, options=None):
+        """
+        Returns the options of one request: the engine defaults, overridden by `options`,
+        then the options of --preset that are still at their default value
+
+        Args:
+            options (dict or argparse.Namespace): Options of the request, the same names
+                as the inference_retalking.py command line flags
+        """
+        overrides = vars(options) if isinstance(options, argparse.Namespace) else dict(options or {})
+        unknown = [key for key in overrides if not hasattr(self.args, key)]
+        if unknown:
+            raise ValueError('Unknown retalking options: {}'.format(', '.join(sorted(unknown))))
+
+        args = argparse.Namespace(**vars(self.args))
+        for key, value in overrides.items():
+            setattr(args, key, value)
+        args.face, args.audio, args.outfile = video_path, audio_path, out_path
+        return apply_preset(args, vars(default_extra_options()))
+
+    def run(self, video_path, audio_path, out_path, options=None):
+        """
+        Lip syncs a video to an audio track
+
+        Args:
+            video_path (str): Source video or image
+            audio_path (str): Driving audio
+            out_path (str): Output video
+            options (dict or argparse.Namespace): Per request options, see options()
+
+        Returns:
+            list: Paths of the written videos, one per audio track
+        """
+        args = self.options(video_path, audio_path, out_path, options)
+        with self.lock:
+            if args.channels_last != self.channels_last:
+                # the torch modules, before a backend swaps them
+                set_memory_format(self.networks(), args.channels_last)
+                self.channels_last = args.channels_last
+            profiler = Profiler(os.path.basename(video_path))
+            profiler.metadata = {"video": video_path, "audio": audio_path, "device": self.device,
+                                 "options": {key: value for key, value in vars(args).items()
+                                             if isinstance(value, (str, int, float, bool, list, type(None)))}}
+            try:
+                with profiler.activate(), activate_precision(args.precision, self.device), self.backend(args):
+                    outfiles = self._run(args)
+            finally:
+                profiler.log()
+            print('[Preset] {}: {}'.format(args.preset or 'standard', cost(profiler.report(), args.preset)))
+            if args.profile_report:
+                # one report per run, written next to every output video
+                for outfile in outfiles:
+                    profiler.save(report_path(outfile))
+            return outfiles
+
+    def networks(self):
+        """
+        The torch modules of the pipeline, in the order they run
+        """
+        return [self.net_recon, self.D_Net, self.enhancer.facegan.model, self.enhancer.faceparser.faceparse,
+                self.model, self.restorer.gfpgan]
+
+    def onnx_networks(self, args):
+        """
+        The networks the onnx backend runs, with example inputs of their shapes
+        """
+        enhancer, restorer, size = self.enhancer, self.restorer, args.img_size
+        first = lambda outputs: outputs[0]
+        first_of_two = lambda outputs: (outputs[0], None)
+        return [
+            OnnxNetwork(self, 'net_recon', 'face3d', [args.face3d_net_path], [torch.zeros(1, 3, 224, 224)]),
+            OnnxNetwork(self, 'D_Net', 'DNet', [args.DNet_path], [torch.zeros(1, 3, 256, 256), torch.zeros(1, 73, 27)],
+                        select=lambda outputs: outputs['fake_image'],
+                        pack=lambda outputs: {'fake_image': outputs[0]}),
+            OnnxNetwork(self, 'model', 'LNet', [args.LNet_path, args.ENet_path],
+                        [torch.zeros(1, 1, 80, 16), torch.zeros(1, 6, size, size), torch.zeros(1, 3, size, size)]),
+            OnnxNetwork(enhancer.facegan, 'model', 'GPEN', ['checkpoints/GPEN-BFR-512.pth'],
+                        [torch.zeros(1, 3, enhancer.size, enhancer.size)], select=first, pack=first_of_two),
+            OnnxNetwork(enhancer.faceparser, 'faceparse', 'parser', ['checkpoints/ParseNet-latest.pth'],
+                        [torch.zeros(1, 3, enhancer.faceparser.size, enhancer.faceparser.size)], select=first,
+                        pack=first_of_two),
+            OnnxNetwork(restorer, 'gfpgan', 'GFPGAN', ['checkpoints/GFPGANv1.3.pth'], [torch.zeros(1, 3, 512, 512)],
+                        select=first, pack=first_of_two, kwargs={'return_rgb': False}),
+        ]
+
+    def backend(self, args):
+        """
+        Context manager running the block with the networks of args.backend
+        """
+        if args.backend == 'torch':
+            return nullcontext()
+        if args.backend not in BACKENDS:
+            raise ValueError('Unknown backend {}, expected one of {}'.format(args.backend, ', '.join(BACKENDS)))
+        if self.onnx is None:
+            self.onnx = OnnxBackend(args.onnx_dir)
+        return self.onnx.swap(self.onnx_networks(args), threads=args.onnx_threads)
+
+    def _run(self, args):
+        device = self.device
+        kp_extractor = self.kp_extractor
+        os.makedirs(args.tmp_dir, exist_ok=True)
+
+        base_name = args.face.split('/')[-1]
+        # frames are decoded lazily, each stage only holds args.stream_window frames at once
+        reader = FrameReader(args.face, args.crop, args.fps, args.processing_scale)
+        if reader.static:
+            args.static = True
+        fps = reader.fps
+        first_frame = reader.first_frame()
+
+        print ("[Step 0] Number of frames available for inference: "+str(reader.frame_count))
+        # face detection & cropping, cropping the first frame as the style of FFHQ
+        # like Croper.crop, the first half of the video is searched for a frame with a face
+        region = FaceRegion(self.croper, reader.read(stop=max(1, reader.frame_count // 2)), xsize=512)
+
+        # Step 4 first, the audio decides which frames of the video are needed
+        # one (audio, outfile) pair per dubbed track, all of them share Steps 0-3
+        tracks = []
+        track_args = [(args.audio, args.outfile)] + [tuple(track) for track in args.track]
+        for track_idx, (audio_path, outfile) in enumerate(track_args):
+            audio_path, mel_chunks = load_mel_chunks(audio_path, fps, '{}/temp_{}.wav'.format(args.tmp_dir, track_idx))
+            print("[Step 4] Load audio; Length of mel chunks: {}".format(len(mel_chunks)))
+            tracks.append((audio_path, outfile, mel_chunks))
+        # output frame i shows video frame i % num_frames, video frames past the longest track are never shown
+        needed = max(len(mel_chunks) for _, _, mel_chunks in tracks)
+
+        # the video frames read more than once: the frames of the segment when it does not loop the video,
+        # else every frame from the first one
+        store_start, store_stop = 0, needed
+        if args.frame_range is not None and args.frame_range[1] <= reader.frame_count:
+            store_start, store_stop = max(0, args.frame_range[0]), min(args.frame_range[1], needed)
+        capacity = min(store_stop - store_start, int(args.frame_store_max_gb * (1 << 30)) // first_frame.nbytes)
+        if not reader.static and capacity > 0:
+            store_path = os.path.join(args.tmp_dir, base_name + '_frames.npy')
+            reader = FrameStore(reader, store_path, capacity, offset=store_start)
+            # the mapping keeps the data alive, the file is gone whichever way this run ends
+            os.remove(store_path)
+
+        # preprocessing results are cached by video content, so every dub of a video reuses them
+        cache = PreprocessCache.from_args(args)
+        video_key = cache.video_key(args)
+        lm, semantic_npy, rects, video_frames = None, None, None, None
+        if not args.re_preprocess:
+            # memory mapped, concurrent runs of the same video share the pages
+            lm = cache.load(video_key, 'landmarks.npy', mmap_mode='r')
+            semantic_npy = cache.load(video_key, 'coeffs.npy', mmap_mode='r')
+            rects = cache.load(video_key, 'rects.npy', mmap_mode='r')
+            video_frames = cache.load(video_key, 'frame_count.npy')
+        analysed = len(lm) if lm is not None and semantic_npy is not None and rects is not None else 0
+
+        if analysed and (analysed >= needed or (video_frames is not None and analysed >= int(video_frames))):
+            print('[Step 1-2] Using saved landmarks, coeffs and face detections.')
+        else:
+            # the cache holds the first frames of the video, only the frames after them are analysed
+            print('[Step 1-2] Landmarks, 3DMM and face detection of the frames {} to {}.'.format(analysed, needed))
+            new_lm, new_coeffs, new_rects = analyse_video(reader, region, args.stream_window, self.detector,
+                                                          args.face_det_batch_size, kp_extractor=kp_extractor,
+                                                          net_recon=self.net_recon, lm3d_std=self.lm3d_std,
+                                                          device=device, face3d_batch_size=args.face3d_batch_size,
+                                                          face3d_workers=args.face3d_workers,
+                                                          queue_size=args.pipeline_queue_size,
+                                                          start=analysed, stop=needed,
+                                                          previous_lm=lm[-1] if analysed else None,
+                                                          face_det_stride=args.face_det_stride,
+                                                          face_track_min_score=args.face_track_min_score)
+            if analysed and len(new_lm):
+                lm = np.concatenate([lm, new_lm])
+                semantic_npy = np.concatenate([semantic_npy, new_coeffs])
+                rects = np.concatenate([rects, rects_to_array(new_rects)])
+            elif not analysed:
+                lm, semantic_npy, rects = new_lm, new_coeffs, rects_to_array(new_rects)
+            if len(new_lm) < needed - analysed:
+                # the decode reached the end of the video, its exact length is known
+                cache.save(video_key, 'frame_count.npy', np.array(len(lm)))
+            if len(new_lm):
+                cache.save(video_key, 'landmarks.npy', lm)
+                cache.save(video_key, 'coeffs.npy', semantic_npy)
+                cache.save(video_key, 'rects.npy', rects)
+        num_frames = min(len(lm), needed)
+        semantic_npy = semantic_npy[:num_frames].astype(np.float32)
+        rects = array_to_rects(rects[:num_frames])
+
+        # generate the 3dmm coeff from a single image
+        if is_expression_image(args.exp_img):
+            print('extract the exp from',args.exp_img)
+            exp_pil = Image.open(args.exp_img).convert('RGB')
+            lm3d_std = load_lm3d('third_part/face3d/BFM')
+
+            W, H = exp_pil.size
+            lm_exp = kp_extractor.extract_keypoint([exp_pil], args.tmp_dir + "/" +base_name+'_temp.txt')[0]
+            if np.mean(lm_exp) == -1:
+                lm_exp = (lm3d_std[:, :2] + 1) / 2.
+                lm_exp = np.concatenate(
+                    [lm_exp[:, :1] * W, lm_exp[:, 1:2] * H], 1)
+            else:
+                lm_exp[:, -1] = H - 1 - lm_exp[:, -1]
+
+            trans_params, im_exp, lm_exp, _ = align_img(exp_pil, lm_exp, lm3d_std)
+            trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
+            im_exp_tensor = torch.tensor(np.array(im_exp)/255., dtype=torch.float32).permute(2, 0, 1).to(device).unsqueeze(0)
+            with torch.no_grad():
+                expression = split_coeff(self.net_recon(im_exp_tensor))['exp'][0]
+        elif args.exp_img == 'smile':
+            expression = torch.tensor(self.expressions['expression_mouth'])[0]
+        else:
+            print('using expression center')
+            expression = torch.tensor(self.expressions['expression_center'])[0]
+
+        stabilized_key = cache.stabilized_key(args, video_key, num_frames)
+        stabilized_path = None if args.re_preprocess else cache.get(stabilized_key, 'stabilized.npy')
+        # memory mapped, frames are paged in window by window
+        imgs = None if stabilized_path is None else np.load(stabilized_path, mmap_mode='r')
+        if imgs is not None and len(imgs) == num_frames:
+            print('[Step 3] Using saved stabilized video.')
+        else:
+            imgs = None
+            partial = cache.partial_path(stabilized_key, 'stabilized.npy')
+            stabilize_video(reader, region, args.stream_window, semantic_npy, expression, self.D_Net, device,
+                            partial, one_shot=args.one_shot, batch_size=args.DNet_batch_size,
+                            queue_size=args.pipeline_queue_size)
+            imgs = np.load(cache.put(stabilized_key, 'stabilized.npy', partial), mmap_mode='r')
+        torch.cuda.empty_cache()
+        if args.preprocess_only:
+            print('[Step 3] Preprocessing cached, skipping the lip synthesis.')
+            return []
+
+        # the GPEN face parser and Poisson blending of Step 6 run without the reference enhancement
+        face_enhancer = BatchedFaceEnhancement(self.enhancer, args.enhance_batch_size)
+        reference_enhancer = face_enhancer if args.reference_enhancement else None
+        face_restorer = BatchedGFPGANer(self.restorer, args.restore_batch_size) if args.mouth_restoration else None
+        frame_h, frame_w = first_frame.shape[:-1]
+
+        blend_pool = None
+        # without the mouth restoration there is no blend to run
+        if args.composite_workers > 0 and face_restorer is not None:
+            if self.blend_pool is None or self.blend_pool.workers != args.composite_workers:
+                if self.blend_pool is not None:
+                    self.blend_pool.close()
+                self.blend_pool = BlendPool(args.composite_workers)
+            blend_pool = self.blend_pool
+
+        instance = None
+        if args.up_face != 'original':
+            if self.instance is None:
+                self.instance = GANimationModel()
+                self.instance.initialize()
+                self.instance.setup()
+            instance = self.instance
+
+        # output frames [start, end) of every track, a part of the output when this run is one segment of a
+        # long video
+        ranges = [(0, len(mel_chunks)) if args.frame_range is None else
+                  (max(0, args.frame_range[0]), min(len(mel_chunks), args.frame_range[1]))
+                  for _, _, mel_chunks in tracks]
+        # output frames without speech or without a face keep the source frame, weights[i] blends the others
+        has_face = np.array([rect is not None for rect in rects])
+        plans, needed = [], np.zeros(num_frames, dtype=bool)
+        for (audio_path, _, mel_chunks), (start, end) in zip(tracks, ranges):
+            track_frames = min(num_frames, len(mel_chunks))
+            shown = np.arange(len(mel_chunks)) % track_frames
+            speech = None
+            if args.skip_silence_db > 0:
+                speech = speech_activity(audio.load_wav(audio_path, 16000), mel_chunks, args.skip_silence_db)
+            weights = plan_frames(speech, has_face[shown], int(round(args.skip_min_silence * fps)),
+                                  args.skip_crossfade)[start:end]
+            needed[shown[start:end][weights > 0]] = True
+            print('[Step 6] Lip syncing {} of {} frames, the others keep the source frames'.format(
+                int(np.count_nonzero(weights)), end - start))
+            plans.append(None if np.all(weights >= 1) else weights)
+
+        # the references are the stabilized faces, in the crop the Step 1 landmarks were detected in
+        landmarks = LandmarkService(kp_extractor, lm[:num_frames], args.landmark_verify_stride)
+        references = None
+        if len(tracks) > 1 or ranges[0][1] - ranges[0][0] > num_frames:
+            # Step 5 only depends on the video, run it once for all the tracks and once per frame of looped clips
+            shared_boxes = face_boxes(rects[:num_frames], first_frame.shape, args.pads, args.nosmooth)
+            references = build_reference_store(reader, imgs, shared_boxes, region, reference_enhancer, landmarks,
+                                               args.stream_window, args.img_size,
+                                               args.tmp_dir + "/" + base_name + '_references.npy', needed=needed)
+
+        outfiles = []
+        for (audio_path, outfile, mel_chunks), (start, end), weights in zip(tracks, ranges, plans):
+            track_frames = min(num_frames, len(mel_chunks))
+
+            if references is not None:
+                print('[Step 5] Using the shared reference enhancement')
+                make_items = lambda start=0: iter_stored_frame_items(reader, references, shared_boxes,
+                                                                     args.stream_window, track_frames, start=start)
+            else:
+                print('[Step 5] Reference Enhancement, streamed into Step 6')
+                boxes = face_boxes(rects[:track_frames], first_frame.shape, args.pads, args.nosmooth)
+                make_items = lambda start=0: iter_frame_items(reader, imgs, boxes, region, reference_enhancer,
+                                                              landmarks, args.stream_window, track_frames,
+                                                              start=start, needed=needed)
+            if args.stream_window <= 0 or track_frames <= args.stream_window:
+                # the clip fits in a single window, prepare it once instead of once per loop
+                frame_items = list(make_items())
+                make_items = lambda start=0: iter(frame_items[start:])
+
+            if args.frame_range is not None:
+                print('[Step 6] Segment with the output frames {} to {} of {}'.format(start, end, len(mel_chunks)))
+            gen = datagen(cycle_frames(make_items, end - start, start % track_frames), mel_chunks[start:end],
+                          args.img_size, args.LNet_batch_size, num_buffers=max(1, args.pipeline_queue_size) + 2,
+                          pin_memory=str(device).startswith('cuda'), weights=weights)
+
+            # frames are encoded and muxed with the audio in a single ffmpeg pass, segments are video
+            # only and segmenter.py muxes the full audio track once they are stitched
+            out = FFmpegWriter(outfile, fps, (frame_w, frame_h), audio=None if args.frame_range else audio_path,
+                               codec=args.output_codec, crf=args.output_crf, preset=args.output_preset)
+
+            def lip_sync(batch):
+                img_batch, mel_batch, img_original, coords, f_frames, f_weights = batch
+                pred = None
+                if coords:
+                    pred = run_lnet(img_batch, mel_batch, img_original, self.model, device, args.up_face,
+                                    args.without_rl1, instance)
+                return pred, coords, f_frames, f_weights
+
+            def composite(result):
+                pred, coords, f_frames, f_weights = result
+                synthesized = []
+                if coords:
+                    frames = f_frames if f_weights is None else [ff for ff, w in zip(f_frames, f_weights) if w > 0]
+                    synthesized = composite_batch(pred, frames, coords, face_restorer, face_enhancer,
+                                                  roi_pad=args.composite_roi_pad, blend_pool=blend_pool,
+                                                  blend_levels=args.blend_levels,
+                                                  poisson_blending=args.poisson_blending)
+                return blend_planned(f_frames, synthesized, f_weights)
+
+            def encode(frames):
+                with step('encode', len(frames)):
+                    for pp in frames:
+                        out.write(pp)
+                return len(frames)
+
+            # decode, LNet, compositing and encoding run concurrently
+            pipeline = Pipeline('Step 6', [Stage('LNet', lip_sync), Stage('composite', composite),
+                                           Stage('encode', encode)],
+                                queue_size=args.pipeline_queue_size, source_name='decode and references')
+            with out, tqdm(desc='[Step 6] Lip Synthesis:', total=end - start) as progress:
+                for written in pipeline.run(gen):
+                    progress.update(written)
+
+            print('outfile:', outfile)
+            outfiles.append(outfile)
+        return outfiles
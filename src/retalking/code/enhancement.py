@@ -0,0 +1,231 @@
+"""
+enhancement.py
+
+    Description:
+        Batched face enhancement on top of the GPEN FaceEnhancement and GFPGANer models.
+        The per-image code paths of the upstream classes are kept as the reference
+        implementation, batching only changes how many faces go through each network
+        per forward pass.
+"""
+import cv2
+import numpy as np
+import torch
+from basicsr.utils import img2tensor, tensor2img
+from torchvision.transforms.functional import normalize
+
+from align_faces import warp_and_crop_face
+from precision import autocast
+
+# no ear, no neck, no hair&hat,  only face region
+FACE_REGION_LABELS = [0, 255, 255, 255, 255, 255, 255, 255, 0, 0, 255, 255, 255, 0, 0, 0, 0, 0, 0]
+# mouth, upper lip and lower lip, used for the mouth mask in Step 6
+#               0,   1,   2,   3,   4,   5,   6,   7,   8,  9, 10,  11,  12,
+MOUTH_LABELS = [0,   0,   0,   0,   0,   0,   0,   0,   0,  0, 255, 255, 255, 0, 0, 0, 0, 0, 0]
+
+
+class BatchedFaceEnhancement(object):
+    """
+    Runs FaceEnhancement.process(img, img, face_enhance=True, possion_blending=False)
+    over a list of images, with GPEN and the face parser each running once per batch
+    of faces instead of once per face. Face detection still runs per image, on the
+    256x256 stabilized crops it is cheap next to GPEN and the parser.
+
+    Args:
+        enhancer (FaceEnhancement): Loaded GPEN enhancer
+        batch_size (int): Number of faces per forward pass, 1 or less uses the
+            per-image FaceEnhancement.process as is
+    """
+    def __init__(self, enhancer, batch_size=8):
+        self.enhancer = enhancer
+        self.batch_size = batch_size
+
+    def process_references(self, imgs):
+        """
+        Enhances a list of aligned BGR faces
+
+        Returns:
+            list: Enhanced BGR faces, same size as the inputs
+        """
+        if self.batch_size <= 1:
+            return [self.enhancer.process(img, img, face_enhance=True, possion_blending=False)[0] for img in imgs]
+
+        results = []
+        for i in range(0, len(imgs), self.batch_size):
+            results.extend(self._process_batch(imgs[i:i + self.batch_size]))
+        return results
+
+    def _process_batch(self, imgs):
+        enhancer = self.enhancer
+        faces = []
+        for img_idx, img in enumerate(imgs):
+            facebs, landms = enhancer.facedetector.detect(img.copy())
+            for faceb, facial5points in zip(facebs, landms):
+                if faceb[4] < enhancer.threshold: continue
+                facial5points = np.reshape(facial5points, (2, 5))
+                of, tfm_inv = warp_and_crop_face(img, facial5points, reference_pts=enhancer.reference_5pts,
+                                                 crop_size=(enhancer.size, enhancer.size))
+                faces.append((img_idx, faceb, of, tfm_inv))
+
+        enhanced = self.enhance_faces([of for _, _, of, _ in faces])
+        masks = self.parse_faces(enhanced, FACE_REGION_LABELS)
+
+        results = []
+        for img_idx, img in enumerate(imgs):
+            height, width = img.shape[:2]
+            full_mask = np.zeros((height, width), dtype=np.float32)
+            full_img = np.zeros(img.shape, dtype=np.uint8)
+            mask_sharp = None
+
+            for (face_img_idx, faceb, of, tfm_inv), ef, mask in zip(faces, enhanced, masks):
+                if face_img_idx != img_idx: continue
+                fh, fw = (faceb[3]-faceb[1]), (faceb[2]-faceb[0])
+
+                mask_sharp = mask/255.
+                tmp_mask = enhancer.mask_postprocess(mask_sharp)
+                tmp_mask = cv2.resize(tmp_mask, ef.shape[:2])
+                mask_sharp = cv2.resize(mask_sharp, ef.shape[:2])
+
+                tmp_mask = cv2.warpAffine(tmp_mask, tfm_inv, (width, height), flags=3)
+                mask_sharp = cv2.warpAffine(mask_sharp, tfm_inv, (width, height), flags=3)
+
+                if min(fh, fw)<100: # gaussian filter for small faces
+                    ef = cv2.filter2D(ef, -1, enhancer.kernel)
+                tmp_img = cv2.warpAffine(ef, tfm_inv, (width, height), flags=3)
+
+                mask = tmp_mask - full_mask
+                full_mask[np.where(mask>0)] = tmp_mask[np.where(mask>0)]
+                full_img[np.where(mask>0)] = tmp_img[np.where(mask>0)]
+
+            if mask_sharp is None:
+                # no face above the detection threshold, nothing to blend
+                results.append(img.copy())
+                continue
+
+            # like FaceEnhancement.process, only the mask of the last face is used
+            mask_sharp = cv2.GaussianBlur(mask_sharp, (0,0), sigmaX=1, sigmaY=1, borderType = cv2.BORDER_DEFAULT)
+            full_mask = full_mask[:, :, np.newaxis]
+            mask_sharp = mask_sharp[:, :, np.newaxis]
+
+            out = cv2.convertScaleAbs(img*(1-full_mask) + full_img*full_mask)
+            out = cv2.convertScaleAbs(img*(1-mask_sharp) + full_img*mask_sharp)
+            results.append(out)
+        return results
+
+    def enhance_faces(self, faces):
+        """
+        GPEN over a list of aligned faces in a single forward pass
+        """
+        if not faces:
+            return []
+        facegan = self.enhancer.facegan
+        size = self.enhancer.size
+        img_t = torch.cat([facegan.img2tensor(cv2.resize(face, (size, size))) for face in faces])
+        with torch.no_grad(), autocast():
+            out, __ = facegan.model(img_t)
+        out = out.float()
+        return [facegan.tensor2img(face_t.unsqueeze(0)) for face_t in out]
+
+    def parse_faces(self, faces, labels):
+        """
+        Face parsing over a list of faces in a single forward pass
+
+        Args:
+            faces (list): BGR faces
+            labels (list): Mask value of each of the 19 parsing labels
+
+        Returns:
+            list: uint8 masks at the parser resolution
+        """
+        faceparser = self.enhancer.faceparser
+        if self.batch_size <= 1:
+            return [faceparser.process(face, labels)[0] for face in faces]
+        if not faces:
+            return []
+        imt = torch.cat([faceparser.img2tensor(cv2.resize(face, (faceparser.size, faceparser.size))) for face in faces])
+        with torch.no_grad(), autocast():
+            pred_mask, sr_img_tensor = faceparser.faceparse(imt)
+        return faceparser.tenor2mask(pred_mask.float(), labels)
+
+
+class BatchedGFPGANer(object):
+    """
+    Runs GFPGANer.enhance(img, has_aligned=False, only_center_face=True, paste_back=True)
+    over a list of frames with a single GFPGAN forward pass for all of their faces.
+    Detection, alignment and paste back still go through the GFPGANer face helper,
+    whose per-image state is saved after alignment and restored for the paste back.
+
+    Args:
+        restorer (GFPGANer): Loaded GFPGAN restorer
+        batch_size (int): Number of faces per forward pass, 1 or less uses the
+            per-image GFPGANer.enhance as is
+    """
+    def __init__(self, restorer, batch_size=8):
+        self.restorer = restorer
+        self.batch_size = batch_size
+
+    def enhance(self, imgs, only_center_face=True):
+        """
+        Restores the faces of a list of BGR frames and pastes them back
+
+        Returns:
+            list: Restored frames
+        """
+        if self.batch_size <= 1:
+            return [self.restorer.enhance(img, has_aligned=False, only_center_face=only_center_face,
+                                          paste_back=True)[2] for img in imgs]
+
+        results = []
+        for i in range(0, len(imgs), self.batch_size):
+            results.extend(self._enhance_batch(imgs[i:i + self.batch_size], only_center_face))
+        return results
+
+    def _enhance_batch(self, imgs, only_center_face):
+        face_helper = self.restorer.face_helper
+
+        states = []
+        for img in imgs:
+            face_helper.clean_all()
+            face_helper.read_image(img)
+            face_helper.get_face_landmarks_5(only_center_face=only_center_face, eye_dist_threshold=5)
+            face_helper.align_warp_face()
+            # clean_all() rebinds the helper lists, so a shallow copy keeps this image intact
+            states.append(dict(face_helper.__dict__))
+
+        cropped_faces = [face for state in states for face in state['cropped_faces']]
+        restored_faces = self.restore_faces(cropped_faces)
+
+        results = []
+        offset = 0
+        for state in states:
+            face_helper.clean_all()
+            face_helper.__dict__.update(state)
+            for restored_face in restored_faces[offset:offset + len(state['cropped_faces'])]:
+                face_helper.add_restored_face(restored_face)
+            offset += len(state['cropped_faces'])
+
+            face_helper.get_inverse_affine(None)
+            results.append(face_helper.paste_faces_to_input_image(upsample_img=None))
+        face_helper.clean_all()
+        return results
+
+    def restore_faces(self, cropped_faces):
+        """
+        GFPGAN over a list of aligned 512x512 faces in a single forward pass
+        """
+        if not cropped_faces:
+            return []
+        restorer = self.restorer
+        faces_t = []
+        for cropped_face in cropped_faces:
+            cropped_face_t = img2tensor(cropped_face / 255., bgr2rgb=True, float32=True)
+            normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+            faces_t.append(cropped_face_t)
+
+        try:
+            with torch.no_grad(), autocast():
+                output = restorer.gfpgan(torch.stack(faces_t).to(restorer.device), return_rgb=False)[0].float()
+            restored_faces = [tensor2img(face_t, rgb2bgr=True, min_max=(-1, 1)) for face_t in output]
+        except RuntimeError as error:
+            print(f'\tFailed inference for GFPGAN: {error}.')
+            restored_faces = cropped_faces
+        return [restored_face.astype('uint8') for restored_face in restored_faces]
@@ -0,0 +1,265 @@
+"""
+frame_io.py
+
+    Description:
+        Lazy frame decoding for the retalking pipeline. Frames are decoded from the
+        source video on demand and handed to the pipeline stages in bounded windows,
+        so peak memory depends on the window size instead of the length of the clip.
+"""
+import os
+import time
+import threading
+
+import cv2
+import numpy as np
+
+from instrumentation import record
+
+IMAGE_EXTENSIONS = ['jpg', 'png', 'jpeg']
+
+
+class FrameReader(object):
+    """
+    Decodes the frames of a video (or a single still image) on demand.
+
+    Args:
+        path (str): Path to the video or image file
+        crop (list): Region kept from every frame (top, bottom, left, right), -1 means full size
+        fps (float): Frame rate to use when the input is a still image
+        scale (float): Resize factor applied to the frames after the crop
+    """
+    def __init__(self, path, crop=(0, -1, 0, -1), fps=25., scale=1.):
+        if not os.path.isfile(path):
+            raise ValueError('--face argument must be a valid path to video/image file')
+
+        self.path = path
+        self.crop = crop
+        self.scale = scale
+        self.static = os.path.splitext(path)[1][1:].lower() in IMAGE_EXTENSIONS
+
+        if self.static:
+            self.fps = fps
+            self.frame_count = 1
+        else:
+            video_stream = cv2.VideoCapture(path)
+            self.fps = video_stream.get(cv2.CAP_PROP_FPS)
+            # Container estimate, the exact count is only known after a full decode
+            self.frame_count = int(video_stream.get(cv2.CAP_PROP_FRAME_COUNT))
+            video_stream.release()
+
+    def crop_frame(self, frame):
+        """
+        Applies the configured crop to a decoded frame
+        """
+        y1, y2, x1, x2 = self.crop
+        if x2 == -1: x2 = frame.shape[1]
+        if y2 == -1: y2 = frame.shape[0]
+        return self.resize_frame(frame[y1:y2, x1:x2])
+
+    def resize_frame(self, frame):
+        """
+        Applies the configured scale to a frame
+        """
+        if self.scale == 1:
+            return frame
+        return cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+
+    def first_frame(self):
+        """
+        Returns the first frame of the input
+        """
+        for frame in self.read(stop=1):
+            return frame
+        raise ValueError('No frames could be decoded from {}'.format(self.path))
+
+    def read(self, start=0, stop=None):
+        """
+        Yields the BGR frames in [start, stop) one at a time. Every call starts a new
+        decode, nothing is kept in memory between calls.
+        """
+        if self.static:
+            if start == 0 and (stop is None or stop > 0):
+                yield self.resize_frame(cv2.imread(self.path))
+            return
+
+        video_stream = cv2.VideoCapture(self.path)
+        try:
+            # grab() skips without converting frames and stays frame accurate,
+            # unlike seeking with CAP_PROP_POS_FRAMES
+            for _ in range(start):
+                if not video_stream.grab():
+                    return
+            idx = start
+            while stop is None or idx < stop:
+                started = time.perf_counter()
+                still_reading, frame = video_stream.read()
+                if not still_reading:
+                    break
+                frame = self.crop_frame(frame)
+                record('decode', time.perf_counter() - started, 1)
+                yield frame
+                idx += 1
+        finally:
+            video_stream.release()
+
+
+class FrameStore(object):
+    """
+    Keeps the frames decoded from a FrameReader in a memory mapped .npy array, so the
+    later passes over the video (stabilization, references, lip synthesis and every
+    loop of a short clip) read them back instead of decoding them again. The frames
+    [offset, offset + capacity) are stored in order, when a decode passes the first
+    one missing. Reads starting past it decode from where they start, other frames
+    are decoded on every read. Has the FrameReader interface.
+
+    Args:
+        reader (FrameReader): Source video
+        path (str): .npy file backing the store
+        capacity (int): Number of frames the store holds at most
+        offset (int): First frame of the store
+    """
+    def __init__(self, reader, path, capacity, offset=0):
+        self.reader = reader
+        self.path = path
+        self.static = reader.static
+        self.fps = reader.fps
+        self.frame_count = reader.frame_count
+        self.crop = reader.crop
+
+        first = reader.first_frame()
+        self.frames = np.lib.format.open_memmap(path, mode='w+', dtype=first.dtype, shape=(capacity,) + first.shape)
+        self.offset = offset
+        # frames [offset, offset + stored) are in the store
+        self.stored = 0
+        # number of frames of the video, known once a decode reached its end
+        self.length = None
+        self.lock = threading.Lock()
+
+    def crop_frame(self, frame):
+        return self.reader.crop_frame(frame)
+
+    def first_frame(self):
+        for frame in self.read(stop=1):
+            return frame
+        raise ValueError('No frames could be decoded from {}'.format(self.reader.path))
+
+    def view(self, start, stop):
+        """
+        Read only view of the stored frames [start, stop), without a copy
+        """
+        if start < self.offset or stop > self.offset + self.stored:
+            raise ValueError('Frames {} to {} are not stored, {} to {} are'.format(start, stop, self.offset,
+                                                                                  self.offset + self.stored))
+        frames = self.frames[start - self.offset:stop - self.offset]
+        frames.flags.writeable = False
+        return frames
+
+    def read(self, start=0, stop=None):
+        """
+        Yields the BGR frames in [start, stop), read only views for the stored ones
+        """
+        if self.length is not None:
+            stop = self.length if stop is None else min(stop, self.length)
+        idx = start
+        if idx >= self.offset:
+            while (stop is None or idx < stop) and idx < self.offset + self.stored:
+                yield self.view(idx, idx + 1)[0]
+                idx += 1
+            if stop is not None and idx >= stop:
+                return
+
+        # decoded from idx, the frames are stored when the decode passes the first one missing from the store
+        position = idx
+        for frame in self.reader.read(start=position, stop=stop):
+            with self.lock:
+                if position == self.offset + self.stored and self.stored < len(self.frames):
+                    self.frames[self.stored] = frame
+                    self.stored += 1
+            yield frame
+            position += 1
+        if stop is None or position < stop:
+            self.length = position
+
+
+class FrameBuffer(object):
+    """
+    Preallocated (capacity, height, width, channels) array frames are written into in
+    place, handed out as views of the filled part. Reused with clear() instead of
+    building a list of frames and stacking it for every batch.
+
+    Args:
+        capacity (int): Number of frames the buffer holds
+        height (int): Frame height
+        width (int): Frame width
+        channels (int): Number of channels
+        dtype: Element type
+    """
+    def __init__(self, capacity, height, width, channels=3, dtype=np.uint8):
+        self.data = np.empty((capacity, height, width, channels), dtype=dtype)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def full(self):
+        return self.size >= len(self.data)
+
+    def clear(self):
+        self.size = 0
+
+    def append(self, frame):
+        """
+        Copies a frame of the buffer size into the next slot
+        """
+        self.data[self.size] = frame
+        self.size += 1
+
+    def append_resized(self, image):
+        """
+        Resizes an image straight into the next slot
+        """
+        height, width = self.data.shape[1:3]
+        cv2.resize(image, (width, height), dst=self.data[self.size])
+        self.size += 1
+
+    def view(self):
+        """
+        The filled frames, without a copy
+        """
+        return self.data[:self.size]
+
+
+def iter_windows(iterable, window):
+    """
+    Groups an iterable into lists of at most `window` items. A window of 0 or less
+    returns everything as a single list.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if window > 0 and len(batch) >= window:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def cycle_frames(make_iter, total, start=0):
+    """
+    Yields `total` items from `make_iter(start)`, starting a new iterator with
+    `make_iter(0)` every time the previous one runs out. This mirrors the
+    `i % len(frames)` looping of short clips without keeping the clip in memory,
+    `start` is the index of the first item, for runs over a part of the output.
+    """
+    produced = 0
+    while produced < total:
+        exhausted = True
+        for item in make_iter(start):
+            exhausted = False
+            yield item
+            produced += 1
+            if produced >= total:
+                return
+        if exhausted:
+            return
+        start = 0
@@ -0,0 +1,125 @@
+"""
+frame_planner.py
+
+    Description:
+        Decides which output frames go through the lip synthesis of Step 6. Frames
+        where the dubbed audio is silent, or where no face was detected, keep the
+        pixels of the source video and skip LNet, restoration and blending. Every
+        frame gets a weight of the synthesized face over the source frame, 1 inside
+        speech, 0 for the frames that are passed through, and a short linear ramp at
+        the region boundaries so the mouth does not pop in and out.
+
+        Speech is found with an energy based voice activity detection over the same
+        audio window as the mel chunk of the frame.
+"""
+import cv2
+import numpy as np
+
+# audio samples per mel frame, hop size of utils.audio.melspectrogram at 16 kHz
+MEL_HOP = 200
+
+
+def speech_activity(wav, mel_chunks, threshold_db=40., floor_db=-60.):
+    """
+    Voice activity of every output frame
+
+    Args:
+        wav (np.ndarray): Dubbed audio at 16 kHz
+        mel_chunks (MelChunks): Mel chunks of the output frames
+        threshold_db (float): Frames quieter than the loud speech of the track by more
+            than this are silent
+        floor_db (float): Frames under this level (dBFS) are always silent
+
+    Returns:
+        np.ndarray: True where the frame has speech
+    """
+    starts = np.minimum(mel_chunks.starts * MEL_HOP, len(wav))
+    ends = np.minimum(starts + mel_chunks.step_size * MEL_HOP, len(wav))
+    energy = np.concatenate([[0.], np.cumsum(np.square(wav, dtype=np.float64))])
+    rms = np.sqrt((energy[ends] - energy[starts]) / np.maximum(ends - starts, 1))
+    # loud speech of the track, robust to a few clicks
+    reference = np.percentile(rms, 95) if len(rms) else 0.
+    level = max(reference * 10 ** (-threshold_db / 20.), 10 ** (floor_db / 20.))
+    return rms > level
+
+
+def fill_gaps(mask, max_gap):
+    """
+    Sets the runs of False shorter than `max_gap` to True
+    """
+    mask = np.array(mask, dtype=bool)
+    # run boundaries, the padding makes the False runs start at -1 and end at +1
+    edges = np.flatnonzero(np.diff(np.concatenate([[1], mask.astype(np.int8), [1]])))
+    for start, end in zip(edges[::2], edges[1::2]):
+        if end - start < max_gap:
+            mask[start:end] = True
+    return mask
+
+
+def distance_to(mask):
+    """
+    Distance in frames from every frame to the closest True frame, inf without any
+    """
+    positions = np.flatnonzero(mask)
+    if not len(positions):
+        return np.full(len(mask), np.inf)
+    frames = np.arange(len(mask))
+    right = np.searchsorted(positions, frames)
+    after = positions[np.minimum(right, len(positions) - 1)]
+    before = positions[np.maximum(right - 1, 0)]
+    return np.minimum(np.abs(after - frames), np.abs(frames - before)).astype(np.float32)
+
+
+def plan_frames(speech, has_face, min_silence=12, crossfade=3):
+    """
+    Blend weight of the synthesized face of every output frame
+
+    Args:
+        speech (np.ndarray): Voice activity of every output frame, None to lip sync
+            every frame with a face
+        has_face (np.ndarray): Whether the video frame shown by every output frame
+            has a usable face
+        min_silence (int): Shorter pauses are lip synced, skipping them would only
+            be crossfades
+        crossfade (int): Frames of the ramp at the region boundaries
+
+    Returns:
+        np.ndarray: float32 weights in [0, 1], 0 frames are passed through
+    """
+    has_face = np.asarray(has_face, dtype=bool)
+    if speech is None:
+        weights = np.ones(len(has_face), dtype=np.float32)
+    else:
+        speech = fill_gaps(speech, min_silence)
+        # the ramp leaves the speech, the mouth closes in the frames after a word
+        weights = np.clip(1. - distance_to(speech) / (crossfade + 1), 0., 1.)
+    # and stays inside the frames with a face
+    weights = np.minimum(weights, np.clip(distance_to(~has_face) / (crossfade + 1), 0., 1.))
+    return weights.astype(np.float32)
+
+
+def blend_planned(frames, synthesized, weights):
+    """
+    The output frames of a batch: the source frame, the synthesized frame or a
+    crossfade of both
+
+    Args:
+        frames (list): Source frames of the batch
+        synthesized (list): Synthesized frames of the frames with a weight above 0, in order
+        weights (np.ndarray): Weight of every frame, None when every frame was synthesized
+
+    Returns:
+        list: Output frames
+    """
+    if weights is None:
+        return synthesized
+    synthesized = iter(synthesized)
+    output = []
+    for frame, weight in zip(frames, weights):
+        if weight <= 0:
+            output.append(frame)
+        elif weight >= 1:
+            output.append(next(synthesized))
+        else:
+            output.append(cv2.addWeighted(next(synthesized), float(weight), frame, 1. - float(weight), 0))
+    return output
@@ -3,22 +3,33 @@ import os
 import logging
 import json
 import tempfile
-import subprocess
 import boto3
 
 logger = logging.getLogger(__name__)
 
+CODE_DIR = '/opt/ml/model/code'
+
+# Preprocessing cache shared by the requests of this endpoint, see preprocess_cache.py
+CACHE_DIR = os.environ.get('RETALKING_CACHE_DIR', '/tmp/retalking_cache')
+CACHE_MAX_GB = os.environ.get('RETALKING_CACHE_MAX_GB', '20')
+CACHE_S3_URI = os.environ.get('RETALKING_CACHE_S3_URI')
+
 class DefaultPytorchInferenceHandler(object):
     def default_model_fn(self, model_dir):
         """
-        Placeholder, does nothing
+        Loads every retalking network once, the engine is reused by all the requests
         """
         
         logger.info('Loading models')
+        # the checkpoints are loaded with paths relative to the code directory
+        os.chdir(CODE_DIR)
         logger.info('Current working directory %s', os.getcwd())
-        logger.info('Checkpoints found %s', os.listdir('/opt/ml/model/code/checkpoints'))
-        
-        return None
+        logger.info('Checkpoints found %s', os.listdir(os.path.join(CODE_DIR, 'checkpoints')))
+
+        from engine import RetalkingEngine
+        engine = RetalkingEngine()
+        logger.info('Models loaded')
+        return engine
 
     def default_predict_fn(self, input_data, model):
         
@@ -42,50 +53,98 @@ class DefaultPytorchInferenceHandler(object):
             s3.download_file(input_video_bucket, input_video_key, input_video_filepath)
             logger.info("Downloaded input video.")
             
-            # Input Audio
-            input_audio_bucket = self.get_bucket(input_data['input_audio_s3_uri'])
-            input_audio_key = self.get_key(input_data['input_audio_s3_uri'])
-            input_audio_filename = self.get_object_name(input_data['input_audio_s3_uri'])
-            input_audio_filepath =  os.path.join(tmpDir, input_audio_filename)
-            
-            logger.info('Downloading input audio from s3://%s/%s to %s', input_audio_bucket,
-                        input_audio_key, input_audio_filepath)
-            
-            s3.download_file(input_audio_bucket, input_audio_key, input_audio_filepath)
-            logger.info("Downloaded input audio")
-            
-            # Output video
-            output_video_bucket = self.get_bucket(input_data['output_video_s3_uri'])
-            output_video_key =  self.get_key(input_data['output_video_s3_uri'])
-            output_video_filename = self.get_object_name(input_data['output_video_s3_uri'])
-            output_video_filepath = os.path.join(tmpDir, output_video_filename)
-            
+            # Input audio and output video of every track, the first one is passed as --audio/--outfile
+            tracks = []
+            for track_idx, track in enumerate(input_data['tracks']):
+                input_audio_bucket = self.get_bucket(track['input_audio_s3_uri'])
+                input_audio_key = self.get_key(track['input_audio_s3_uri'])
+                input_audio_filename = self.get_object_name(track['input_audio_s3_uri'])
+                input_audio_filepath = os.path.join(tmpDir, f"track_{track_idx}_{input_audio_filename}")
+
+                logger.info('Downloading input audio from s3://%s/%s to %s', input_audio_bucket,
+                            input_audio_key, input_audio_filepath)
+
+                s3.download_file(input_audio_bucket, input_audio_key, input_audio_filepath)
+                logger.info("Downloaded input audio")
+
+                # Output video
+                output_video_bucket = self.get_bucket(track['output_video_s3_uri'])
+                output_video_key = self.get_key(track['output_video_s3_uri'])
+                output_video_filename = self.get_object_name(track['output_video_s3_uri'])
+                output_video_filepath = os.path.join(tmpDir, f"track_{track_idx}_{output_video_filename}")
+
+                tracks.append((input_audio_filepath, output_video_filepath, output_video_bucket, output_video_key))
+
+            options = {
+                "tmp_dir": tmpDir,
+                "cache_dir": CACHE_DIR,
+                "cache_max_gb": float(CACHE_MAX_GB),
+                "cache_s3_uri": CACHE_S3_URI,
+                "track": [[input_audio_filepath, output_video_filepath]
+                          for input_audio_filepath, output_video_filepath, _, _ in tracks[1:]],
+            }
+
+            # Segments of a long video, see segmenter.py. The outputs have no audio and are
+            # stitched with `segmenter.py stitch` once every segment is done.
+            inference_params = input_data.get('inference_params', {})
+            preprocess_only = bool(inference_params.get('preprocess_only', False))
+            options["preprocess_only"] = preprocess_only
+            if 'frame_range' in inference_params:
+                start_frame, end_frame = inference_params['frame_range']
+                options["frame_range"] = [int(start_frame), int(end_frame)]
+            # speed/quality preset, see presets.py
+            if inference_params.get('preset'):
+                options["preset"] = inference_params['preset']
+            # runtime of the networks, see onnx_backend.py
+            if 'backend' in inference_params:
+                options["backend"] = inference_params['backend']
+            if 'onnx_threads' in inference_params:
+                options["onnx_threads"] = int(inference_params['onnx_threads'])
+
             logger.info("Starting inference")
-            command = ["python", "inference_retalking.py", 
-                    "--face", input_video_filepath , 
-                    "--audio", input_audio_filepath, 
-                    "--outfile", output_video_filepath,
-                    "--tmp_dir", tmpDir
-            ] 
-            logger.info('Running command: %s', command)
-            result = subprocess.run(command, capture_output=True, cwd="/opt/ml/model/code")
+            logger.info('Running with options: %s', options)
+            try:
+                model.run(input_video_filepath, tracks[0][0], tracks[0][1], options)
+            except Exception:
+                logger.exception("Inference failed")
+                raise
             logger.info("Inference complete")
             
-            print(result)
-            
-            # Check if output file exists
-            if not os.path.exists(output_video_filepath) or result.returncode != 0:
-                logging.error("Output video file not found or inference failed: %s", output_video_filepath)
-                raise ValueError(f"Output video file not found: {output_video_filepath}")
-            
-            # Upload file
-            logger.info('Uploading output video from %s to s3://%s/%s', output_video_filepath,
-                        output_video_bucket, output_video_key)
-            s3.upload_file(output_video_filepath, output_video_bucket, output_video_key)
-            logger.info("Successfully uploaded output video")
-            
+            if preprocess_only:
+                return {"output_video_s3_uri": None, "output_video_s3_uris": [], "cost": None}
+
+            from instrumentation import report_path
+            from presets import cost
+            run_cost = None
+            output_video_s3_uris = []
+            for _, output_video_filepath, output_video_bucket, output_video_key in tracks:
+                # Check if output file exists
+                if not os.path.exists(output_video_filepath):
+                    logging.error("Output video file not found or inference failed: %s", output_video_filepath)
+                    raise ValueError(f"Output video file not found: {output_video_filepath}")
+
+                # Upload file
+                logger.info('Uploading output video from %s to s3://%s/%s', output_video_filepath,
+                            output_video_bucket, output_video_key)
+                s3.upload_file(output_video_filepath, output_video_bucket, output_video_key)
+                logger.info("Successfully uploaded output video")
+                output_video_s3_uris.append(f"s3://{output_video_bucket}/{output_video_key}")
+
+                # per step timing and memory report of the run, next to the output video
+                profile_filepath = report_path(output_video_filepath)
+                if os.path.exists(profile_filepath):
+                    if run_cost is None:
+                        # one report per run, the same for every track
+                        with open(profile_filepath) as f:
+                            run_cost = cost(json.load(f), options.get("preset"))
+                    profile_key = os.path.splitext(output_video_key)[0] + ".profile.json"
+                    s3.upload_file(profile_filepath, output_video_bucket, profile_key)
+                    logger.info("Uploaded profile report to s3://%s/%s", output_video_bucket, profile_key)
+
         return {
-            "output_video_s3_uri": f"s3://{output_video_bucket}/{output_video_key}"
+            "output_video_s3_uri": output_video_s3_uris[0],
+            "output_video_s3_uris": output_video_s3_uris,
+            "cost": run_cost
         }
 
         
@@ -99,6 +158,13 @@ class DefaultPytorchInferenceHandler(object):
                 input_video_s3_uri (str): The S3 URI of the input video
                 input_audio_s3_uri (str): The S3 URI of the input audio to lip sync with
                 output_video_s3_uri (str): The S3 URI of where the new video will be outputted to
+                tracks (list): Optional, replaces the two fields above to lip sync the video to
+                    several audio tracks in one request. A list of objects with an
+                    input_audio_s3_uri and an output_video_s3_uri
+                inference_params (dict): Optional, frame_range [start, end) renders one
+                    segment of a long video, preprocess_only fills the preprocessing cache,
+                    preset is draft, standard or final (see presets.py), backend is torch
+                    or onnx and onnx_threads the ONNX Runtime threads per network
                 
             
             request_content_type (str): The request content type
@@ -118,18 +184,46 @@ class DefaultPytorchInferenceHandler(object):
         
         logger.info('Processing input')
         # Extract and validate required fields
-        required_fields = ["input_video_s3_uri", "input_audio_s3_uri", "output_video_s3_uri"]
+        if "tracks" in request:
+            required_fields = ["input_video_s3_uri", "tracks"]
+        else:
+            required_fields = ["input_video_s3_uri", "input_audio_s3_uri", "output_video_s3_uri"]
         missing_fields = [field for field in required_fields if field not in request]
         if missing_fields:
             logger.error("Missing required fields: %s", ", ".join(missing_fields))
             raise ValueError(f"Missing required fields: {', '.join(missing_fields)}")
+
+        if "tracks" in request:
+            tracks = request["tracks"]
+            if not tracks or any("input_audio_s3_uri" not in track or "output_video_s3_uri" not in track
+                                 for track in tracks):
+                raise ValueError("tracks must be a non empty list of input_audio_s3_uri and output_video_s3_uri")
+        else:
+            tracks = [{
+                "input_audio_s3_uri": request["input_audio_s3_uri"],
+                "output_video_s3_uri": request["output_video_s3_uri"],
+            }]
         
+        from onnx_backend import BACKENDS
+        from presets import PRESETS
+        inference_params = request.get("inference_params", {})
+        if inference_params.get("preset") and inference_params["preset"] not in PRESETS:
+            raise ValueError(f"Unknown preset {inference_params['preset']}, expected one of {', '.join(PRESETS)}")
+        if "backend" in inference_params and inference_params["backend"] not in BACKENDS:
+            raise ValueError(f"Unknown backend {inference_params['backend']}, expected one of {', '.join(BACKENDS)}")
+        if "onnx_threads" in inference_params:
+            onnx_threads = inference_params["onnx_threads"]
+            if isinstance(onnx_threads, bool) or not isinstance(onnx_threads, int) or onnx_threads < 0:
+                raise ValueError("onnx_threads must be an integer, 0 or more")
+
         logger.info('Input processing completed.')
         return {
             "input_video_s3_uri": request["input_video_s3_uri"],
-            "input_audio_s3_uri": request["input_audio_s3_uri"],
-            "output_video_s3_uri": request["output_video_s3_uri"],
-            "inference_params": request.get("inference_params", {}),
+            "tracks": [{
+                "input_audio_s3_uri": track["input_audio_s3_uri"],
+                "output_video_s3_uri": track["output_video_s3_uri"],
+            } for track in tracks],
+            "inference_params": inference_params,
         }
 
     def default_output_fn(self, response_body, response_content_type):
@@ -141,7 +235,9 @@ class DefaultPytorchInferenceHandler(object):
         logger.info('Returning response')
         return {
             "statusCode": 200,
-            "output_video_s3_uri": response_body['output_video_s3_uri']
+            "output_video_s3_uri": response_body['output_video_s3_uri'],
+            "output_video_s3_uris": response_body['output_video_s3_uris'],
+            "cost": response_body.get('cost')
         }
 
     def get_bucket(self, uri):
@@ -0,0 +1,248 @@
+"""
+instrumentation.py
+
+    Description:
+        Per step timing and memory instrumentation of the retalking pipeline. Code
+        wraps its work in `step(name, frames)`, the active Profiler accumulates the
+        wall time, the number of frames and the peak host (RSS) and device memory seen
+        while the step ran. Without an active Profiler the calls are no-ops, so the
+        pipeline functions can be used on their own.
+
+        Steps may run concurrently (see pipeline.py), their times are measured per
+        thread and memory peaks are sampled in the background and attributed to every
+        step that was active at the time.
+"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+_active = None
+
+# report order, steps not listed here are reported after them
+STEP_ORDER = ['decode', 'crop', 'landmarks', '3DMM', 'face detection', 'stabilize', 'mel', 'enhance', 'references',
+              'LNet', 'restore', 'blend', 'encode', 'mux']
+
+
+def rss_bytes():
+    """
+    Current resident set size of the process, 0 when it cannot be read
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def device_bytes():
+    """
+    Memory currently allocated by torch on the GPU, 0 without CUDA
+    """
+    if torch is not None and torch.cuda.is_available():
+        return torch.cuda.memory_allocated()
+    return 0
+
+
+class _StepStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.frames = 0
+        self.seconds = 0.
+        self.peak_rss = 0
+        self.peak_device = 0
+        self.active = 0
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "calls": self.calls,
+            "frames": self.frames,
+            "seconds": round(self.seconds, 4),
+            "fps": round(self.frames / self.seconds, 3) if self.seconds > 0 and self.frames else None,
+            "peak_rss_mb": round(self.peak_rss / 2 ** 20, 1),
+            "peak_device_mb": round(self.peak_device / 2 ** 20, 1),
+        }
+
+
+class Profiler(object):
+    """
+    Collects the step statistics of one run
+
+    Args:
+        name (str): Name of the run in the report
+        sample_interval (float): Seconds between two memory samples
+    """
+    def __init__(self, name='retalking', sample_interval=0.05):
+        self.name = name
+        self.sample_interval = sample_interval
+        self.steps = {}
+        self.pipelines = []
+        self.metadata = {}
+        self.lock = threading.Lock()
+        self.started = None
+        self.finished = None
+        self.peak_rss = 0
+        self.peak_device = 0
+        self._stop = threading.Event()
+        self._sampler = None
+
+    @contextmanager
+    def activate(self):
+        """
+        Makes this profiler the one step() calls report to, for the duration of the block
+        """
+        global _active
+        previous = _active
+        _active = self
+        self.started = time.time()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        try:
+            yield self
+        finally:
+            self._stop.set()
+            self._sampler.join()
+            self.finished = time.time()
+            _active = previous
+
+    def _stats(self, name):
+        stats = self.steps.get(name)
+        if stats is None:
+            stats = self.steps[name] = _StepStats(name)
+        return stats
+
+    def _sample(self):
+        while True:
+            self._update_peaks(rss_bytes(), device_bytes())
+            if self._stop.wait(self.sample_interval):
+                return
+
+    def _update_peaks(self, rss, device):
+        with self.lock:
+            self.peak_rss = max(self.peak_rss, rss)
+            self.peak_device = max(self.peak_device, device)
+            for stats in self.steps.values():
+                if stats.active:
+                    stats.peak_rss = max(stats.peak_rss, rss)
+                    stats.peak_device = max(stats.peak_device, device)
+
+    def enter(self, name):
+        with self.lock:
+            self._stats(name).active += 1
+        # short steps can finish between two samples
+        self._update_peaks(rss_bytes(), device_bytes())
+
+    def exit(self, name, seconds, frames):
+        self._update_peaks(rss_bytes(), device_bytes())
+        with self.lock:
+            stats = self._stats(name)
+            stats.active -= 1
+            stats.calls += 1
+            stats.frames += frames
+            stats.seconds += seconds
+
+    def record(self, name, seconds, frames=0):
+        """
+        Adds a measurement taken by the caller, for hot loops where a context manager
+        per item would cost too much. Memory peaks come from the background sampler.
+        """
+        with self.lock:
+            stats = self._stats(name)
+            stats.calls += 1
+            stats.frames += frames
+            stats.seconds += seconds
+
+    def add_pipeline(self, pipeline):
+        """
+        Adds the stage utilisation of a finished Pipeline to the report
+        """
+        with self.lock:
+            self.pipelines.append({"name": pipeline.name, "wall_seconds": round(pipeline.wall_time, 4),
+                                   "stages": pipeline.stats()})
+
+    def report(self):
+        """
+        Returns the report as a dictionary
+        """
+        order = {name: idx for idx, name in enumerate(STEP_ORDER)}
+        steps = sorted(self.steps.values(), key=lambda stats: order.get(stats.name, len(order)))
+        finished = self.finished or time.time()
+        return {
+            "name": self.name,
+            "metadata": self.metadata,
+            "wall_seconds": round(finished - self.started, 4) if self.started else None,
+            "peak_rss_mb": round(self.peak_rss / 2 ** 20, 1),
+            "peak_device_mb": round(self.peak_device / 2 ** 20, 1),
+            "steps": [stats.as_dict() for stats in steps],
+            "pipelines": self.pipelines,
+        }
+
+    def log(self):
+        """
+        Prints one line per step
+        """
+        report = self.report()
+        for stats in report['steps']:
+            print('[Profile] {}: {:.2f}s, {} frames, {} fps, peak RSS {:.0f} MB, peak device {:.0f} MB'.format(
+                stats['name'], stats['seconds'], stats['frames'],
+                '{:.1f}'.format(stats['fps']) if stats['fps'] else '-', stats['peak_rss_mb'],
+                stats['peak_device_mb']))
+        print('[Profile] total: {:.2f}s, peak RSS {:.0f} MB, peak device {:.0f} MB'.format(
+            report['wall_seconds'] or 0., report['peak_rss_mb'], report['peak_device_mb']))
+
+    def save(self, path):
+        """
+        Writes the report as JSON
+        """
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        return path
+
+
+def report_path(video_path):
+    """
+    Path of the JSON report written next to an output video
+    """
+    return os.path.splitext(video_path)[0] + '.profile.json'
+
+
+def active_profiler():
+    """
+    Returns the active Profiler, None when nothing is being profiled
+    """
+    return _active
+
+
+@contextmanager
+def step(name, frames=0):
+    """
+    Measures the enclosed block as one call of the step `name` over `frames` frames
+    """
+    profiler = _active
+    if profiler is None:
+        yield
+        return
+    profiler.enter(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.exit(name, time.perf_counter() - started, frames)
+
+
+def record(name, seconds, frames=0):
+    """
+    Adds a measurement to the active Profiler, see Profiler.record
+    """
+    profiler = _active
+    if profiler is not None:
+        profiler.record(name, seconds, frames)
@@ -0,0 +1,196 @@
+"""
+onnx_backend.py
+
+    Description:
+        ONNX Runtime backend of the retalking networks, for CPU instances. Each
+        network is exported to ONNX the first time it is used, the graphs are cached
+        next to the checkpoints and keyed by the checkpoint files, the input shapes
+        and the torch version, so later runs and processes only load them.
+
+        The backend is chosen per request: OnnxBackend.swap() puts OnnxModules in
+        place of the torch modules for the duration of a run and puts the torch
+        modules back afterwards. An OnnxModule takes and returns torch tensors with
+        the structure of the module it replaces, the pipeline code is unchanged. A
+        network that cannot be exported (e.g. an op ONNX does not have) stays on
+        torch, the others still run on ONNX Runtime.
+"""
+import os
+import json
+import hashlib
+from contextlib import contextmanager
+
+import torch
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+ONNX_OPSET = 13
+
+# runtimes of the networks, see --backend
+BACKENDS = ['torch', 'onnx']
+
+
+class OnnxNetwork(object):
+    """
+    A network that can be swapped for an OnnxModule
+
+    Args:
+        owner (object): Object holding the torch module
+        attribute (str): Name of the module attribute on `owner`
+        name (str): Name of the graph
+        checkpoints (list): Checkpoint files of the weights, part of the graph key
+        inputs (list): Example input tensors, the first dimension is the batch
+        select (callable): Maps the outputs of the torch module to the exported tensors,
+            None when the module returns a tensor or a tuple of tensors
+        pack (callable): Maps the list of graph outputs back to the outputs of the
+            torch module, None returns the single output or a tuple
+        kwargs (dict): Keyword arguments of the torch module during the export
+    """
+    def __init__(self, owner, attribute, name, checkpoints, inputs, select=None, pack=None, kwargs=None):
+        self.owner = owner
+        self.attribute = attribute
+        self.name = name
+        self.checkpoints = checkpoints
+        self.inputs = inputs
+        self.select = select
+        self.pack = pack
+        self.kwargs = kwargs or {}
+
+
+class _Export(torch.nn.Module):
+    def __init__(self, module, select, kwargs):
+        super(_Export, self).__init__()
+        self.module = module
+        self.select = select
+        self.kwargs = kwargs
+
+    def forward(self, *inputs):
+        outputs = self.module(*inputs, **self.kwargs)
+        return self.select(outputs) if self.select is not None else outputs
+
+
+class OnnxModule(object):
+    """
+    Runs an ONNX graph in place of a torch module
+
+    Args:
+        session (onnxruntime.InferenceSession): Session of the graph
+        pack (callable): See OnnxNetwork
+    """
+    def __init__(self, session, pack=None):
+        self.session = session
+        self.pack = pack
+        self.input_names = [item.name for item in session.get_inputs()]
+
+    def __call__(self, *inputs, **kwargs):
+        device = inputs[0].device
+        feeds = {name: x.detach().cpu().float().contiguous().numpy() for name, x in zip(self.input_names, inputs)}
+        outputs = [torch.from_numpy(output).to(device) for output in self.session.run(None, feeds)]
+        if self.pack is not None:
+            return self.pack(outputs)
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+    def to(self, *args, **kwargs):
+        # the graph has its own layout, see precision.set_memory_format
+        return self
+
+    def eval(self):
+        return self
+
+
+def checkpoint_identity(path):
+    """
+    Name, size and modification time of a checkpoint file, None when it does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [os.path.basename(path), stat.st_size, stat.st_mtime_ns]
+
+
+class OnnxBackend(object):
+    """
+    Exports, caches and loads the ONNX graphs of the networks
+
+    Args:
+        onnx_dir (str): Directory of the exported graphs
+    """
+    def __init__(self, onnx_dir='checkpoints/onnx'):
+        if onnxruntime is None:
+            raise ImportError('The onnx backend needs onnxruntime, pip install onnxruntime')
+        self.onnx_dir = onnx_dir
+        self.sessions = {}
+        # graphs that failed to export, not tried again by this process
+        self.failed = set()
+
+    def graph_path(self, network):
+        """
+        Path of the cached graph of a network
+        """
+        key = json.dumps([network.name, [checkpoint_identity(path) for path in network.checkpoints],
+                          [list(x.shape[1:]) for x in network.inputs], torch.__version__, ONNX_OPSET])
+        return os.path.join(self.onnx_dir, '{}-{}.onnx'.format(network.name, hashlib.sha256(key.encode('utf-8'))
+                                                               .hexdigest()[:16]))
+
+    def export(self, network, path):
+        """
+        Exports the torch module of `network` to `path`, the batch dimension is dynamic
+        """
+        os.makedirs(self.onnx_dir, exist_ok=True)
+        module = getattr(network.owner, network.attribute)
+        input_names = ['input_{}'.format(idx) for idx in range(len(network.inputs))]
+        device = next(module.parameters()).device
+        partial = '{}.{}.partial'.format(path, os.getpid())
+        print('[Info] Exporting {} to ONNX'.format(network.name))
+        with torch.no_grad():
+            torch.onnx.export(_Export(module, network.select, network.kwargs).eval(),
+                              tuple(x.to(device) for x in network.inputs), partial, opset_version=ONNX_OPSET,
+                              input_names=input_names, dynamic_axes={name: {0: 'batch'} for name in input_names},
+                              do_constant_folding=True)
+        # concurrent processes export the same graph, the last one wins
+        os.replace(partial, path)
+
+    def module(self, network, threads=0):
+        """
+        Returns the OnnxModule of a network, None when it cannot be exported
+        """
+        path = self.graph_path(network)
+        if path in self.failed:
+            return None
+        if (path, threads) not in self.sessions:
+            try:
+                if not os.path.isfile(path):
+                    self.export(network, path)
+                options = onnxruntime.SessionOptions()
+                options.intra_op_num_threads = threads
+                self.sessions[(path, threads)] = onnxruntime.InferenceSession(path, options,
+                                                                             providers=['CPUExecutionProvider'])
+            except Exception as error:
+                print('[Info] {} stays on torch, it could not be run with ONNX Runtime: {}'.format(network.name, error))
+                self.failed.add(path)
+                return None
+        return OnnxModule(self.sessions[(path, threads)], network.pack)
+
+    @contextmanager
+    def swap(self, networks, threads=0):
+        """
+        Runs the block with the ONNX graphs in place of the torch modules
+
+        Args:
+            networks (list): OnnxNetworks to swap
+            threads (int): ONNX Runtime intra-op threads, 0 for its default
+        """
+        swapped = []
+        try:
+            for network in networks:
+                module = self.module(network, threads)
+                if module is not None:
+                    swapped.append((network, getattr(network.owner, network.attribute)))
+                    setattr(network.owner, network.attribute, module)
+            yield
+        finally:
+            for network, module in reversed(swapped):
+                setattr(network.owner, network.attribute, module)
@@ -0,0 +1,196 @@
+"""
+pipeline.py
+
+    Description:
+        Small pipeline executor for the retalking script. A source iterator (usually
+        frame decoding) and a chain of stages run in their own threads, connected by
+        bounded queues, so decoding, model inference, CPU compositing and encoding
+        overlap instead of running one after the other. Every stage records how long
+        it was busy, starved of input and blocked on its output, and the pipeline
+        prints the utilisation of each stage when it finishes so the bottleneck shows
+        up in the logs.
+"""
+import time
+import queue
+import threading
+
+from instrumentation import active_profiler
+
+_DONE = object()
+
+
+class _Failure(object):
+    """
+    Carries an exception raised in a stage thread to the consumer
+    """
+    def __init__(self, error):
+        self.error = error
+
+
+class Stage(object):
+    """
+    One step of a Pipeline
+
+    Args:
+        name (str): Name used in the utilisation report
+        fn (callable): Called with every item of the previous stage. Its return value
+            is passed to the next stage, None passes nothing on.
+    """
+    def __init__(self, name, fn):
+        self.name = name
+        self.fn = fn
+        self.items = 0
+        self.busy = 0.
+        self.waiting = 0.
+        self.blocked = 0.
+
+    def stats(self, wall_time):
+        """
+        Returns the utilisation of the stage as a dictionary
+        """
+        wall_time = max(wall_time, 1e-9)
+        return {
+            "name": self.name,
+            "items": self.items,
+            "busy_seconds": self.busy,
+            "busy_pct": 100. * self.busy / wall_time,
+            "waiting_pct": 100. * self.waiting / wall_time,
+            "blocked_pct": 100. * self.blocked / wall_time,
+        }
+
+
+class Pipeline(object):
+    """
+    Runs a source iterator and a chain of stages concurrently
+
+    Args:
+        name (str): Name used in the utilisation report
+        stages (list): Stage objects, in order
+        queue_size (int): Maximum number of items waiting between two stages, this
+            bounds the memory held by the pipeline
+        source_name (str): Name of the source in the utilisation report
+    """
+    def __init__(self, name, stages, queue_size=2, source_name='decode'):
+        self.name = name
+        self.source = Stage(source_name, None)
+        self.stages = stages
+        self.queue_size = max(1, queue_size)
+        self.wall_time = 0.
+
+    def run(self, source):
+        """
+        Runs the pipeline and yields the outputs of the last stage in order. The
+        utilisation report is printed once the pipeline is exhausted or closed.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        stop = threading.Event()
+        threads = [threading.Thread(target=self._run_source, args=(source, queues[0], stop))]
+        for stage, q_in, q_out in zip(self.stages, queues[:-1], queues[1:]):
+            threads.append(threading.Thread(target=self._run_stage, args=(stage, q_in, q_out, stop)))
+
+        start = time.time()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                item = self._get(queues[-1], stop)
+                if item is _DONE:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            self.wall_time = time.time() - start
+            self.report()
+            profiler = active_profiler()
+            if profiler is not None:
+                profiler.add_pipeline(self)
+
+    def consume(self, source):
+        """
+        Runs the pipeline to completion and discards the outputs
+        """
+        for _ in self.run(source):
+            pass
+
+    def stats(self):
+        """
+        Returns the utilisation of the source and every stage
+        """
+        return [stage.stats(self.wall_time) for stage in [self.source] + self.stages]
+
+    def report(self):
+        """
+        Prints the utilisation of every stage and the slowest one
+        """
+        stats = self.stats()
+        for stage in stats:
+            print('[Pipeline {}] {}: {} items, busy {:.1f}%, waiting for input {:.1f}%, blocked on output {:.1f}%'.format(
+                self.name, stage['name'], stage['items'], stage['busy_pct'], stage['waiting_pct'], stage['blocked_pct']))
+        slowest = max(stats, key=lambda stage: stage['busy_seconds'])
+        print('[Pipeline {}] Slowest stage: {} ({:.1f}s of {:.1f}s)'.format(
+            self.name, slowest['name'], slowest['busy_seconds'], self.wall_time))
+
+    def _run_source(self, source, q_out, stop):
+        stage = self.source
+        iterator = iter(source)
+        try:
+            while not stop.is_set():
+                started = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                stage.busy += time.time() - started
+                stage.items += 1
+
+                started = time.time()
+                self._put(q_out, item, stop)
+                stage.blocked += time.time() - started
+        except Exception as error:
+            self._put(q_out, _Failure(error), stop)
+            return
+        self._put(q_out, _DONE, stop)
+
+    def _run_stage(self, stage, q_in, q_out, stop):
+        while not stop.is_set():
+            started = time.time()
+            item = self._get(q_in, stop)
+            stage.waiting += time.time() - started
+            if item is _DONE or isinstance(item, _Failure):
+                self._put(q_out, item, stop)
+                return
+
+            started = time.time()
+            try:
+                result = stage.fn(item)
+            except Exception as error:
+                self._put(q_out, _Failure(error), stop)
+                return
+            stage.busy += time.time() - started
+            stage.items += 1
+
+            if result is not None:
+                started = time.time()
+                self._put(q_out, result, stop)
+                stage.blocked += time.time() - started
+
+    def _put(self, q, item, stop):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q, stop):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
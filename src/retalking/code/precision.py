@@ -0,0 +1,90 @@
+"""
+precision.py
+
+    Description:
+        Numeric precision and memory format of the retalking networks. fp16 and bf16
+        run the forward passes under torch autocast while the weights stay in fp32, so
+        every request can pick its own precision. channels_last converts the 4D
+        weights in place, convolutions then run in NHWC whatever the layout of their
+        inputs.
+
+        Like instrumentation.step, the code running a network wraps it in autocast()
+        and the mode activated for the run applies. Without an active mode the
+        networks run in fp32. Autocast is enabled per thread, autocast() has to be
+        entered in the thread running the network, e.g. inside a pipeline stage.
+
+        benchmark.py drift compares the output of every mode to fp32.
+"""
+from contextlib import contextmanager
+
+import torch
+
+PRECISIONS = ['fp32', 'fp16', 'bf16']
+
+_active = None
+
+
+def _device_type(device):
+    return 'cuda' if str(device).startswith('cuda') else 'cpu'
+
+
+def check(precision, device):
+    """
+    Raises a ValueError when `precision` cannot run on `device` with this torch
+    """
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision {}, expected one of {}'.format(precision, ', '.join(PRECISIONS)))
+    if precision == 'fp32':
+        return
+    # CPU autocast only runs in bf16
+    if precision == 'fp16' and _device_type(device) == 'cpu':
+        raise ValueError('fp16 is not supported on cpu, use bf16 or fp32')
+    # torch < 1.10 only has the CUDA fp16 autocast
+    if not hasattr(torch, 'autocast') and (_device_type(device) != 'cuda' or precision != 'fp16'):
+        raise ValueError('{} on {} needs torch 1.10 or newer, this is torch {}'.format(
+            precision, _device_type(device), torch.__version__))
+
+
+@contextmanager
+def activate(precision, device):
+    """
+    Makes autocast() use `precision` on `device` for the duration of the block
+    """
+    global _active
+    check(precision, device)
+    previous = _active
+    _active = None if precision == 'fp32' else (precision, _device_type(device))
+    try:
+        yield
+    finally:
+        _active = previous
+
+
+@contextmanager
+def autocast():
+    """
+    Runs the enclosed forward passes in the active precision. Outputs may be half
+    precision, callers convert them with .float() before leaving torch.
+    """
+    mode = _active
+    if mode is None:
+        yield
+        return
+    precision, device_type = mode
+    dtype = torch.float16 if precision == 'fp16' else torch.bfloat16
+    if hasattr(torch, 'autocast'):
+        context = torch.autocast(device_type, dtype=dtype)
+    else:
+        context = torch.cuda.amp.autocast()
+    with context:
+        yield
+
+
+def set_memory_format(modules, channels_last):
+    """
+    Converts the 4D weights of `modules` to channels_last, or back to contiguous
+    """
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    for module in modules:
+        if module is not None:
+            module.to(memory_format=memory_format)
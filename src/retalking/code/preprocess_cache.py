@@ -0,0 +1,224 @@
+"""
+preprocess_cache.py
+
+    Description:
+        Persistent cache for the per-video preprocessing of the retalking pipeline
+        (landmarks, 3DMM coefficients, face rects and stabilized faces). Entries are
+        keyed by a content hash of the source video plus the parameters that change
+        the result, so dubbing the same video into several languages runs Steps 1-3
+        only once. The local tier is a directory evicted least recently used first,
+        an optional S3 tier shares entries between endpoint instances.
+"""
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+
+import numpy as np
+
+# entries used this recently are never evicted, another run may be writing or reading them
+ACTIVE_SECONDS = 600
+# unpublished artifacts older than this are left over by a run that died, they are deleted
+STALE_PARTIAL_SECONDS = 24 * 3600
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    Returns the sha256 hex digest of a file's content
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_expression_image(exp_img):
+    """
+    True when the --exp_img option points to an expression template image
+    """
+    return exp_img is not None and ('.png' in exp_img or '.jpg' in exp_img)
+
+
+class PreprocessCache(object):
+    """
+    Two tier cache of preprocessing artifacts, one directory per key
+
+    Args:
+        cache_dir (str): Local cache directory
+        max_bytes (int): Size limit of the local directory, 0 or less disables eviction
+        s3_uri (str): Optional s3://bucket/prefix mirroring the local entries
+    """
+    def __init__(self, cache_dir, max_bytes=0, s3_uri=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.s3_uri = s3_uri
+        self.s3 = None
+        if s3_uri:
+            import boto3
+            self.s3 = boto3.client('s3')
+            self.s3_bucket, _, self.s3_prefix = s3_uri.split('//')[1].partition('/')
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Builds the cache from the --cache_* options, falling back to --tmp_dir
+        """
+        return cls(args.cache_dir or args.tmp_dir, int(args.cache_max_gb * (1 << 30)), args.cache_s3_uri)
+
+    def key(self, *parts):
+        """
+        Returns the cache key of a list of JSON serializable parts
+        """
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def video_key(self, args):
+        """
+        Key of the Step 1-2 artifacts: the video content and the options changing the
+        decoded frames, the 3DMM coefficients or the face rects
+        """
+        fps = args.fps if os.path.splitext(args.face)[1][1:].lower() in ['jpg', 'png', 'jpeg'] else None
+        tracking = [args.face_det_stride, args.face_track_min_score] if args.face_det_stride > 1 else None
+        # only reduced precision, resolution and other runtimes extend the key, so the existing entries
+        # stay valid. The Step 3 key includes this one.
+        precision = [args.precision] if args.precision != 'fp32' else []
+        scale = [['scale', args.processing_scale]] if args.processing_scale != 1 else []
+        backend = [['backend', args.backend]] if args.backend != 'torch' else []
+        return self.key('analysis', file_digest(args.face), list(args.crop), fps, os.path.basename(args.face3d_net_path),
+                        tracking, *precision, *scale, *backend)
+
+    def stabilized_key(self, args, video_key, num_frames):
+        """
+        Key of the Step 3 artifacts: the video key, the expression template, DNet and
+        the number of stabilized frames. The crop norm ratios and the temporal windows
+        depend on all the frames, a longer stabilization is not valid for a prefix.
+        """
+        exp_img = file_digest(args.exp_img) if is_expression_image(args.exp_img) else args.exp_img
+        return self.key('stabilized', video_key, exp_img, args.one_shot, os.path.basename(args.DNet_path),
+                        int(num_frames))
+
+    def path(self, key, name):
+        """
+        Local path of an artifact, whether it exists or not
+        """
+        return os.path.join(self.cache_dir, key, name)
+
+    def partial_path(self, key, name):
+        """
+        New path an artifact is written to before put() publishes it, unique to the
+        caller so concurrent writers of the same artifact do not share a file
+        """
+        os.makedirs(os.path.join(self.cache_dir, key), exist_ok=True)
+        return '{}.{}.{}.partial'.format(self.path(key, name), os.getpid(), uuid.uuid4().hex[:8])
+
+    def get(self, key, name):
+        """
+        Returns the local path of a cached artifact, fetching it from S3 on a local
+        miss, or None when it is not cached
+        """
+        path = self.path(key, name)
+        if not os.path.isfile(path) and not self._download(key, name):
+            return None
+        self._touch(key)
+        return path
+
+    def put(self, key, name, partial):
+        """
+        Publishes the artifact written to `partial`, a partial_path(), mirrors it to S3
+        and evicts old entries. Returns its local path.
+        """
+        path = self.path(key, name)
+        os.replace(partial, path)
+        self._touch(key)
+        if self.s3 is not None:
+            self.s3.upload_file(path, self.s3_bucket, self._s3_key(key, name))
+        self.evict(keep=key)
+        return path
+
+    def load(self, key, name, mmap_mode=None):
+        """
+        Loads a cached array, None when it is not cached
+        """
+        path = self.get(key, name)
+        return None if path is None else np.load(path, mmap_mode=mmap_mode)
+
+    def save(self, key, name, array):
+        """
+        Stores an array under a key
+        """
+        partial = self.partial_path(key, name)
+        with open(partial, 'wb') as f:
+            np.save(f, array)
+        return self.put(key, name, partial)
+
+    def evict(self, keep=None):
+        """
+        Deletes the least recently used entries until the local tier fits max_bytes.
+        Entries another run may be using, being written or used in the last
+        ACTIVE_SECONDS, are kept.
+        """
+        if self.max_bytes <= 0:
+            return
+        now = time.time()
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, key)
+            try:
+                size, writing = 0, False
+                for name in os.listdir(entry):
+                    file_path = os.path.join(entry, name)
+                    if name.endswith('.partial') and now - os.path.getmtime(file_path) > STALE_PARTIAL_SECONDS:
+                        os.remove(file_path)
+                        continue
+                    writing = writing or name.endswith('.partial')
+                    size += os.path.getsize(file_path)
+                entries.append((os.path.getmtime(entry), key, size, writing))
+            except OSError:
+                # not a directory, or removed by a concurrent run
+                continue
+
+        total = sum(size for _, _, size, _ in entries)
+        for modified, key, size, writing in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep or writing or now - modified < ACTIVE_SECONDS:
+                continue
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            total -= size
+
+    def _touch(self, key):
+        os.utime(os.path.join(self.cache_dir, key))
+
+    def _s3_key(self, key, name):
+        return '/'.join(part for part in [self.s3_prefix.strip('/'), key, name] if part)
+
+    def _download(self, key, name):
+        if self.s3 is None:
+            return False
+        from botocore.exceptions import ClientError
+        partial = self.partial_path(key, name)
+        try:
+            self.s3.download_file(self.s3_bucket, self._s3_key(key, name), partial)
+        except ClientError:
+            if os.path.isfile(partial):
+                os.remove(partial)
+            return False
+        os.replace(partial, self.path(key, name))
+        return True
+
+
+def rects_to_array(rects):
+    """
+    Packs the detected rects into an (N, 4) int array, -1 marks a missing face
+    """
+    return np.array([[-1, -1, -1, -1] if rect is None else list(rect) for rect in rects], dtype=np.int64).reshape(-1, 4)
+
+
+def array_to_rects(array):
+    """
+    Inverse of rects_to_array
+    """
+    return [None if row[0] < 0 else tuple(int(v) for v in row) for row in array]
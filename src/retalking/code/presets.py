@@ -0,0 +1,82 @@
+"""
+presets.py
+
+    Description:
+        Named speed/quality presets of the retalking options. `draft` is for previews:
+        it processes the video at half resolution, detects faces on keyframes and
+        tracks them in between, skips the GPEN reference enhancement and the Poisson
+        blending, reuses the Step 1 landmarks of the references, restores and blends
+        only a tight ROI around the face, blends the mouth over a shallower pyramid on
+        worker processes and keeps the source frames where the audio is silent.
+        `final` blends on worker processes and encodes with a slower, higher quality
+        setting. `standard` is the defaults, the approximations of the speed options
+        are only enabled by the presets.
+
+        A preset only changes the options still at their default value, the options
+        given with it take precedence. The cost of a run is read from its profile
+        report, see cost().
+"""
+
+PRESETS = {
+    'draft': {
+        'processing_scale': 0.5,
+        'face_det_stride': 25,
+        'landmark_verify_stride': 64,
+        'reference_enhancement': False,
+        'poisson_blending': False,
+        'blend_levels': 3,
+        'composite_roi_pad': 0.25,
+        'skip_silence_db': 40.,
+        'composite_workers': 2,
+        'output_preset': 'veryfast',
+        'output_crf': 23,
+    },
+    'standard': {},
+    'final': {
+        'composite_workers': 2,
+        'output_preset': 'slow',
+        'output_crf': 16,
+    },
+}
+
+
+def apply_preset(args, defaults):
+    """
+    Sets the options of args.preset that are still at their default value
+
+    Args:
+        args (argparse.Namespace): Options of the run, changed in place
+        defaults (dict): Default value of every option
+
+    Returns:
+        argparse.Namespace: `args`
+    """
+    if args.preset is None:
+        return args
+    if args.preset not in PRESETS:
+        raise ValueError('Unknown preset {}, expected one of {}'.format(args.preset, ', '.join(PRESETS)))
+    for key, value in PRESETS[args.preset].items():
+        if getattr(args, key) == defaults[key]:
+            setattr(args, key, value)
+    return args
+
+
+def cost(report, preset=None):
+    """
+    Measured cost of a run
+
+    Args:
+        report (dict): Profile report of the run, see Profiler.report
+        preset (str): Preset of the run
+
+    Returns:
+        dict: preset, wall_seconds, output_frames and fps of the run
+    """
+    frames = sum(stats['frames'] for stats in report['steps'] if stats['name'] == 'encode')
+    seconds = report['wall_seconds']
+    return {
+        "preset": preset,
+        "wall_seconds": seconds,
+        "output_frames": frames,
+        "fps": round(frames / seconds, 3) if seconds and frames else None,
+    }
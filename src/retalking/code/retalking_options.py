@@ -0,0 +1,154 @@
+"""
+retalking_options.py
+
+    Description:
+        Command line options added on top of the upstream video-retalking options().
+        The upstream parser rejects unknown flags, so the extra flags are parsed first
+        and removed from sys.argv before options() runs.
+"""
+import sys
+import argparse
+
+from utils.inference_utils import options
+
+from onnx_backend import BACKENDS
+from precision import PRECISIONS
+from presets import PRESETS
+
+
+def extra_options_parser():
+    """
+    Returns a parser with the options that are not part of upstream options()
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--preset', type=str, default=None, choices=list(PRESETS),
+                        help='Speed/quality preset, sets the options below that are left at their default. draft '
+                             'previews at half resolution without the enhancement and restoration networks, final '
+                             'detects on every frame and encodes at a higher quality')
+    parser.add_argument('--processing_scale', type=float, default=1.,
+                        help='Resize factor of the video frames after the crop, the output has the processed size')
+    parser.add_argument('--stream_window', type=int, default=64,
+                        help='Number of frames each pipeline stage holds in memory at once. 0 keeps the whole clip in memory')
+    parser.add_argument('--frame_store_max_gb', type=float, default=8.,
+                        help='Size limit of the memory mapped store of decoded frames, the frames that fit are decoded '
+                             'once and read back by the later passes. 0 decodes the video on every pass')
+    parser.add_argument('--face_det_stride', type=int, default=1,
+                        help='Run the face detector on keyframes this many frames apart, on scene changes and when '
+                             'tracking is lost, and track the face in between. 1 detects on every frame')
+    parser.add_argument('--face_track_min_score', type=float, default=0.8,
+                        help='Template matching score under which a tracked frame is detected again')
+    parser.add_argument('--face3d_batch_size', type=int, default=16,
+                        help='Batch size for the 3DMM coefficient extraction')
+    parser.add_argument('--face3d_workers', type=int, default=4,
+                        help='CPU workers aligning faces for the 3DMM extraction. 0 aligns in the main thread')
+    parser.add_argument('--landmark_verify_stride', type=int, default=0,
+                        help='0 detects the landmarks of every enhanced reference in Step 5. N > 0 reuses the Step 1 '
+                             'landmarks and detects every Nth frame to check them, an approximation of the mouth '
+                             'points')
+    parser.add_argument('--DNet_batch_size', type=int, default=8,
+                        help='Batch size for the expression stabilization with DNet')
+    parser.add_argument('--enhance_batch_size', type=int, default=8,
+                        help='Batch size for the GPEN reference enhancement. 1 runs FaceEnhancement.process per frame')
+    parser.add_argument('--restore_batch_size', type=int, default=8,
+                        help='Batch size for the GFPGAN mouth restoration in Step 6. 1 runs GFPGANer.enhance per frame')
+    parser.add_argument('--no_reference_enhancement', dest='reference_enhancement', action='store_false',
+                        help='Skip the GPEN enhancement of the Step 5 references, LNet gets the stabilized faces')
+    parser.add_argument('--no_mouth_restoration', dest='mouth_restoration', action='store_false',
+                        help='Skip the GFPGAN mouth restoration of Step 6, the LNet prediction is pasted as it is')
+    parser.add_argument('--no_poisson_blending', dest='poisson_blending', action='store_false',
+                        help='Skip the Poisson blending of the synthesized face into the frame in Step 6')
+    parser.add_argument('--blend_levels', type=int, default=0,
+                        help='Levels of the Laplacian pyramid blending the restored mouth, 0 for the default depth')
+    parser.add_argument('--composite_roi_pad', type=float, default=0.,
+                        help='Step 6 restores and blends only the face box grown by this fraction of its size on '
+                             'every side, at native resolution, e.g. 0.5. 0 processes the full frames resized to '
+                             '512x512 like upstream')
+    parser.add_argument('--composite_workers', type=int, default=0,
+                        help='Worker processes running the Step 6 mouth blends, while the next LNet batch runs, e.g. 2. '
+                             '0 blends in the compositing thread')
+    parser.add_argument('--skip_silence_db', type=float, default=0.,
+                        help='Output frames whose audio is this many dB quieter than the speech of the track keep the '
+                             'source frame, e.g. 40. Frames without a face always do. 0 lip syncs every frame with a face')
+    parser.add_argument('--skip_min_silence', type=float, default=0.5,
+                        help='Shortest pause in seconds that keeps the source frames, shorter pauses are lip synced')
+    parser.add_argument('--skip_crossfade', type=int, default=3,
+                        help='Frames of the crossfade between lip synced and source frames')
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS,
+                        help='Precision of the network forward passes, fp16 and bf16 run under torch autocast')
+    parser.add_argument('--channels_last', action='store_true',
+                        help='Keep the network weights in the channels last memory format')
+    parser.add_argument('--backend', type=str, default='torch', choices=BACKENDS,
+                        help='Runtime of the networks, onnx runs them with ONNX Runtime on the CPU, for draft renders '
+                             'on instances without a GPU')
+    parser.add_argument('--onnx_threads', type=int, default=0,
+                        help='ONNX Runtime intra-op threads per network, 0 for its default')
+    parser.add_argument('--onnx_dir', type=str, default='checkpoints/onnx',
+                        help='Directory of the exported ONNX graphs, they are exported on first use')
+    parser.add_argument('--pipeline_queue_size', type=int, default=2,
+                        help='Items waiting between two concurrent pipeline stages (decode, inference, compositing, encoding)')
+    parser.add_argument('--output_codec', type=str, default='libx264',
+                        help='ffmpeg video encoder of the output, e.g. libx264 or libx265')
+    parser.add_argument('--output_crf', type=int, default=18,
+                        help='Constant rate factor of the output encoder, lower is larger and better')
+    parser.add_argument('--output_preset', type=str, default='medium',
+                        help='Encoder preset of the output, e.g. ultrafast, veryfast, medium or slow')
+    parser.add_argument('--cache_dir', type=str, default='',
+                        help='Persistent cache of the Step 1-3 preprocessing, keyed by video content. Defaults to --tmp_dir')
+    parser.add_argument('--cache_max_gb', type=float, default=20.,
+                        help='Size limit of the local preprocessing cache, least recently used entries are evicted. 0 disables eviction')
+    parser.add_argument('--cache_s3_uri', type=str, default=None,
+                        help='Optional s3://bucket/prefix shared preprocessing cache tier')
+    parser.add_argument('--track', nargs=2, action='append', default=[], metavar=('AUDIO', 'OUTFILE'),
+                        help='Additional audio track and output video lip synced to the same --face. '
+                             'Can be repeated, Steps 0-3 and the reference enhancement are shared by all tracks')
+    parser.add_argument('--frame_range', type=int, nargs=2, default=None, metavar=('START', 'END'),
+                        help='Only synthesize the output frames [START, END), written without audio. '
+                             'Used by segmenter.py to split long videos into independent segments')
+    parser.add_argument('--preprocess_only', action='store_true',
+                        help='Run Steps 0-3 to fill the preprocessing cache and exit')
+    parser.add_argument('--no_profile_report', dest='profile_report', action='store_false',
+                        help='Do not write the per step timing and memory report next to the output video')
+    return parser
+
+
+def default_extra_options():
+    """
+    Returns the extra options with their default values
+    """
+    return extra_options_parser().parse_args([])
+
+
+def build_options(face='', audio='', **overrides):
+    """
+    Returns the options namespace without reading the command line, with the upstream
+    and extra defaults overridden by `overrides`. Used when the pipeline runs in
+    process, e.g. from the SageMaker handler or the Cog predictor.
+    """
+    argv = sys.argv
+    # options() parses sys.argv and requires --face and --audio
+    sys.argv = argv[:1] + ['--face', face, '--audio', audio]
+    try:
+        args = options()
+    finally:
+        sys.argv = argv
+    for key, value in vars(default_extra_options()).items():
+        setattr(args, key, value)
+
+    unknown = [key for key in overrides if not hasattr(args, key)]
+    if unknown:
+        raise ValueError('Unknown retalking options: {}'.format(', '.join(sorted(unknown))))
+    for key, value in overrides.items():
+        setattr(args, key, value)
+    return args
+
+
+def parse_options():
+    """
+    Parses the upstream options and the extra options into a single namespace
+    """
+    extra, remaining = extra_options_parser().parse_known_args(sys.argv[1:])
+    sys.argv = sys.argv[:1] + remaining
+    args = options()
+    for key, value in vars(extra).items():
+        setattr(args, key, value)
+    return args
@@ -0,0 +1,254 @@
+"""
+segmenter.py
+
+    Description:
+        Splits the lip synthesis of a long video into segments that run as independent
+        inference_retalking.py processes, and stitches their outputs back together.
+
+        Steps 0-3 run once for the whole video and are shared through the preprocessing
+        cache, every segment then synthesizes a range of output frames (--frame_range)
+        with the same crop, face boxes and references as a single run would use. The
+        segments are written without audio and concatenated without re-encoding, the
+        original audio track is muxed once at the end, so there are no seams in the
+        face and no audio drift between segments.
+
+        Segment boundaries are placed near every --segment_seconds, at the quietest
+        point of the audio and optionally at a shot change.
+
+    Usage:
+        python segmenter.py plan --face video.mp4 --audio dub.wav
+        python segmenter.py run --face video.mp4 --audio dub.wav --outfile out.mp4 --workers 2 --devices 0,1
+        python segmenter.py stitch --audio dub.wav --outfile out.mp4 segment_0.mp4 segment_1.mp4
+
+        Unknown options of `run` are passed to every inference_retalking.py process.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(CODE_DIR, 'third_part'))
+
+from frame_io import FrameReader
+
+
+def audio_energy(wav, fps, num_frames, sample_rate=16000):
+    """
+    Returns the RMS of the audio under every output frame
+    """
+    samples_per_frame = sample_rate / fps
+    energy = np.zeros(num_frames, dtype=np.float32)
+    for i in range(num_frames):
+        chunk = wav[int(i * samples_per_frame):int((i + 1) * samples_per_frame)]
+        if len(chunk):
+            energy[i] = np.sqrt(np.mean(np.square(chunk, dtype=np.float32)))
+    return energy
+
+
+def shot_changes(reader, frame_indices, size=64):
+    """
+    Scores how likely each video frame in `frame_indices` starts a new shot, as the
+    histogram distance to the previous frame (0 same content, 1 completely different)
+
+    Returns:
+        dict: frame index -> score
+    """
+    frame_indices = set(frame_indices)
+    wanted = frame_indices | set(idx - 1 for idx in frame_indices)
+    stop = max(wanted) + 1 if wanted else 0
+    hists, scores = {}, {}
+    for idx, frame in enumerate(reader.read(stop=stop)):
+        if idx not in wanted:
+            continue
+        small = cv2.resize(frame, (size, size))
+        hist = cv2.calcHist([cv2.cvtColor(small, cv2.COLOR_BGR2HSV)], [0, 1], None, [16, 16], [0, 180, 0, 256])
+        hists[idx] = cv2.normalize(hist, hist).flatten()
+        if idx in frame_indices and idx - 1 in hists:
+            scores[idx] = cv2.compareHist(hists[idx - 1], hists[idx], cv2.HISTCMP_BHATTACHARYYA)
+        hists.pop(idx - 2, None)
+    return scores
+
+
+def plan_segments(energy, segment_frames, search_frames, shots=None, num_video_frames=None):
+    """
+    Picks the segment boundaries
+
+    Args:
+        energy (np.ndarray): Audio RMS of every output frame
+        segment_frames (int): Target segment length in frames
+        search_frames (int): How far a boundary can move from its target
+        shots (dict): Optional shot change score of video frames, see shot_changes
+        num_video_frames (int): Length of the video, output frames loop over it
+
+    Returns:
+        list: [start, end) output frame ranges covering every output frame
+    """
+    total = len(energy)
+    if segment_frames <= 0 or total <= segment_frames:
+        return [(0, total)]
+
+    # smooth over a few frames, a boundary in the middle of a word is worse than next to it
+    kernel = np.ones(5, dtype=np.float32) / 5
+    quiet = np.convolve(energy, kernel, mode='same')
+    quiet = quiet / max(float(quiet.max()), 1e-8)
+
+    boundaries, start = [], 0
+    while total - start > segment_frames + search_frames:
+        target = start + segment_frames
+        low, high = max(start + 1, target - search_frames), min(total - 1, target + search_frames)
+        candidates = np.arange(low, high + 1)
+        cost = quiet[candidates].copy()
+        if shots:
+            video_idx = candidates % num_video_frames if num_video_frames else candidates
+            cost -= np.array([shots.get(int(idx), 0.) for idx in video_idx])
+        start = int(candidates[np.argmin(cost)])
+        boundaries.append(start)
+
+    edges = [0] + boundaries + [total]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def plan(face, audio_path, tmp_dir, segment_seconds=120., search_seconds=10., use_shots=False):
+    """
+    Plans the segments of a video and audio pair
+
+    Returns:
+        list: [{"index", "start_frame", "end_frame"}] in output order
+    """
+    from utils import audio
+    from stages import load_mel_chunks
+
+    reader = FrameReader(face)
+    fps = reader.fps
+    audio_path, mel_chunks = load_mel_chunks(audio_path, fps, os.path.join(tmp_dir, 'plan.wav'))
+    energy = audio_energy(audio.load_wav(audio_path, 16000), fps, len(mel_chunks))
+
+    segment_frames, search_frames = int(segment_seconds * fps), int(search_seconds * fps)
+    shots = None
+    if use_shots and not reader.static:
+        coarse = plan_segments(energy, segment_frames, 0)
+        frames = [idx for start, _ in coarse[1:] for idx in range(start - search_frames, start + search_frames + 1)]
+        shots = shot_changes(reader, [idx % max(1, reader.frame_count) for idx in frames])
+    segments = plan_segments(energy, segment_frames, search_frames, shots, reader.frame_count)
+    return [{"index": idx, "start_frame": start, "end_frame": end} for idx, (start, end) in enumerate(segments)]
+
+
+def stitch(segment_paths, audio_path, outfile):
+    """
+    Concatenates the video only segments without re-encoding and muxes the audio
+    """
+    if os.path.dirname(outfile):
+        os.makedirs(os.path.dirname(outfile), exist_ok=True)
+    list_path = outfile + '.segments.txt'
+    with open(list_path, 'w') as f:
+        for path in segment_paths:
+            f.write("file '{}'\n".format(os.path.abspath(path).replace("'", "'\\''")))
+    command = [
+        "ffmpeg",
+        "-loglevel", "error",
+        "-y",
+        "-f", "concat",
+        "-safe", "0",
+        "-i", list_path,
+        "-i", audio_path,
+        "-map", "0:v:0",
+        "-map", "1:a:0",
+        "-c:v", "copy",
+        "-c:a", "aac",
+        "-strict", "-2",
+        outfile
+    ]
+    try:
+        subprocess.run(command, shell=False, check=True)
+    finally:
+        os.remove(list_path)
+
+
+def run(args, extra):
+    """
+    Preprocesses the video once, runs the segments on `args.workers` processes and
+    stitches the result
+    """
+    # inference_retalking.py runs from the code directory, where the checkpoints are
+    face, audio_path, work_dir = os.path.abspath(args.face), os.path.abspath(args.audio), os.path.abspath(args.work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    cache_dir = os.path.abspath(args.cache_dir) if args.cache_dir else os.path.join(work_dir, 'cache')
+    base_command = [sys.executable, "inference_retalking.py", "--face", face, "--audio", audio_path,
+                    "--cache_dir", cache_dir] + extra
+
+    print('[Segmenter] Preprocessing the whole video once')
+    subprocess.run(base_command + ["--outfile", os.path.join(work_dir, 'unused.mp4'), "--tmp_dir", work_dir,
+                                   "--preprocess_only"], shell=False, check=True, cwd=CODE_DIR)
+
+    segments = plan(face, audio_path, work_dir, args.segment_seconds, args.search_seconds, args.use_shots)
+    print('[Segmenter] {} segments: {}'.format(len(segments), [(s['start_frame'], s['end_frame']) for s in segments]))
+
+    devices = [device for device in args.devices.split(',') if device] if args.devices else []
+    segment_paths = [os.path.join(work_dir, 'segment_{}.mp4'.format(s['index'])) for s in segments]
+
+    def run_worker(worker):
+        env = dict(os.environ)
+        if devices:
+            env['CUDA_VISIBLE_DEVICES'] = devices[worker % len(devices)]
+        for segment in segments[worker::args.workers]:
+            tmp_dir = os.path.join(work_dir, 'segment_{}'.format(segment['index']))
+            os.makedirs(tmp_dir, exist_ok=True)
+            command = base_command + ["--outfile", segment_paths[segment['index']], "--tmp_dir", tmp_dir,
+                                      "--frame_range", str(segment['start_frame']), str(segment['end_frame'])]
+            print('[Segmenter] Worker {}: segment {}'.format(worker, segment['index']))
+            subprocess.run(command, shell=False, check=True, env=env, cwd=CODE_DIR)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        # list() re-raises the first failed worker
+        list(pool.map(run_worker, range(min(args.workers, len(segments)))))
+
+    stitch(segment_paths, audio_path, args.outfile)
+    print('outfile:', args.outfile)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Segmented lip synthesis of long videos')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    for name in ['plan', 'run']:
+        sub = subparsers.add_parser(name)
+        sub.add_argument('--face', type=str, required=True, help='Source video')
+        sub.add_argument('--audio', type=str, required=True, help='Dubbed audio')
+        sub.add_argument('--segment_seconds', type=float, default=120., help='Target segment length')
+        sub.add_argument('--search_seconds', type=float, default=10.,
+                         help='How far a boundary can move from its target to find a silence or a shot change')
+        sub.add_argument('--use_shots', action='store_true', help='Prefer shot changes as segment boundaries')
+        sub.add_argument('--work_dir', type=str, default='temp/segments', help='Directory of the segments')
+    run_parser = subparsers.choices['run']
+    run_parser.add_argument('--outfile', type=str, required=True, help='Stitched output video')
+    run_parser.add_argument('--workers', type=int, default=1, help='Segments processed concurrently')
+    run_parser.add_argument('--devices', type=str, default='', help='Comma separated GPUs assigned to the workers')
+    run_parser.add_argument('--cache_dir', type=str, default='', help='Preprocessing cache, defaults to the work dir')
+
+    stitch_parser = subparsers.add_parser('stitch')
+    stitch_parser.add_argument('--audio', type=str, required=True, help='Dubbed audio')
+    stitch_parser.add_argument('--outfile', type=str, required=True, help='Stitched output video')
+    stitch_parser.add_argument('segments', nargs='+', help='Segment videos, in output order')
+
+    args, extra = parser.parse_known_args()
+    if args.command != 'run' and extra:
+        parser.error('unrecognized arguments: {}'.format(' '.join(extra)))
+
+    if args.command == 'plan':
+        os.makedirs(args.work_dir, exist_ok=True)
+        print(json.dumps(plan(args.face, args.audio, args.work_dir, args.segment_seconds, args.search_seconds,
+                              args.use_shots), indent=2))
+    elif args.command == 'run':
+        run(args, extra)
+    else:
+        stitch(args.segments, args.audio, args.outfile)
+
+
+if __name__ == '__main__':
+    main()
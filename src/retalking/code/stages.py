@@ -0,0 +1,918 @@
+"""
+stages.py
+
+    Description:
+        Windowed implementations of the retalking pipeline steps. Every function works
+        on a bounded window of frames so the caller decides how many frames are held in
+        memory at once. Per-frame results that are small (landmarks, 3DMM coefficients,
+        face boxes) are kept for the whole clip, full resolution frames are not.
+"""
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import torch
+from tqdm import tqdm
+from PIL import Image
+
+from third_part.face3d.util.preprocess import align_img
+from utils import audio
+from utils.alignment_stit import compute_transform, crop_faces_by_quads, calc_alignment_coefficients, paste_image
+from utils.inference_utils import split_coeff, trans_image, find_crop_norm_ratio, get_smoothened_boxes, \
+                                  exp_aus_dict, obtain_seq_index
+
+from frame_io import FrameBuffer, iter_windows
+from instrumentation import step
+from precision import autocast
+from pipeline import Pipeline, Stage
+
+
+class FaceRegion(object):
+    """
+    FFHQ style face crop. The crop is computed on the first frame with a face, as
+    Croper.crop does, and then applied to every frame of the video.
+
+    Args:
+        croper (Croper): Croper used to locate the face
+        frames (iterable): BGR frames searched for a face, in order
+        xsize (int): Output size used by the croper
+    """
+    def __init__(self, croper, frames, xsize=512):
+        # Croper.crop only searches a list of frames it holds in memory
+        for frame in frames:
+            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            lm = croper.get_landmark(frame_rgb)
+            if lm is not None:
+                break
+        else:
+            raise ValueError('No face was found in the video, the face crop cannot be computed')
+        crop, quad = croper.align_face(img=Image.fromarray(frame_rgb), lm=lm, output_size=xsize)
+        clx, cly, crx, cry = [int(value) for value in crop]
+        lx, ly, rx, ry = [int(value) for value in quad]
+
+        self.crop = (clx, cly, crx, cry)
+        self.quad = (lx, ly, rx, ry)
+        # Face region in full frame coordinates (oy1, oy2, ox1, ox2)
+        self.box = (cly+ly, min(cly+ry, frame.shape[0]), clx+lx, min(clx+rx, frame.shape[1]))
+
+    def face_image(self, frame, size=256):
+        """
+        Returns the RGB face crop of a full BGR frame as a PIL image
+        """
+        clx, cly, crx, cry = self.crop
+        lx, ly, rx, ry = self.quad
+        face = cv2.cvtColor(frame[cly:cry, clx:crx][ly:ry, lx:rx], cv2.COLOR_BGR2RGB)
+        return Image.fromarray(cv2.resize(face, (size, size)))
+
+
+def extract_landmarks(kp_extractor, images, previous=None):
+    """
+    Runs the 68 point landmark detector over a window of images. Images without a
+    detected face reuse the landmarks of the previous image, like KeypointExtractor does
+    for a whole list.
+
+    Args:
+        kp_extractor (KeypointExtractor): Landmark detector
+        images (list): PIL images
+        previous (np.ndarray): Landmarks of the frame before the window, if any
+    """
+    keypoints = []
+    for image in images:
+        current = kp_extractor.extract_keypoint(image)
+        if np.mean(current) == -1 and previous is not None:
+            current = previous
+        keypoints.append(current)
+        previous = current
+    return np.array(keypoints)
+
+
+class LandmarkService(object):
+    """
+    Landmarks of the enhanced reference faces of Step 5, on the engine's single
+    detector, kept per frame and image variant. The references are the stabilized
+    faces, rendered in the same 256x256 crop as the Step 1 face crops, so the Step 1
+    landmarks are reused as they are. Every `verify_stride`-th frame is detected to
+    check that: a window where the check fails, and frames without Step 1 landmarks,
+    are detected.
+
+    Args:
+        kp_extractor (KeypointExtractor): Landmark detector
+        lm (np.ndarray): Step 1 landmarks of the video, None to detect every frame
+        verify_stride (int): Frames between two checks, 0 or less detects every frame
+        max_error (float): Largest mean distance between the reused and the detected
+            landmarks, relative to the distance between the eyes
+    """
+    def __init__(self, kp_extractor, lm=None, verify_stride=0, max_error=0.1):
+        self.kp_extractor = kp_extractor
+        self.lm = lm
+        self.verify_stride = verify_stride
+        self.max_error = max_error
+        self.cache = {}
+        self.detected = 0
+        self.reused = 0
+
+    def detect(self, variant, indices, images):
+        """
+        Detected landmarks of the frames `indices` of an image variant, each frame
+        is detected once
+        """
+        missing = [(idx, image) for idx, image in zip(indices, images) if (variant, idx) not in self.cache]
+        if missing:
+            for (idx, _), lm in zip(missing, extract_landmarks(self.kp_extractor, [image for _, image in missing])):
+                self.cache[(variant, idx)] = lm
+            self.detected += len(missing)
+        return np.array([self.cache[(variant, idx)] for idx in indices])
+
+    def references(self, indices, images):
+        """
+        Landmarks of a window of enhanced reference faces
+
+        Args:
+            indices (list): Frame indices of the window, in order
+            images (list): The reference faces as PIL images
+        """
+        if self.lm is None or self.verify_stride <= 0:
+            return self.detect('reference', indices, images)
+
+        lms = np.array(self.lm[indices], dtype=np.float32)
+        missing = [k for k, lm in enumerate(lms) if np.mean(lm) == -1]
+        checks = [k for k, idx in enumerate(indices) if idx % self.verify_stride == 0 and k not in missing]
+        detected = self.detect('reference', [indices[k] for k in checks], [images[k] for k in checks])
+        for k, lm in zip(checks, detected):
+            if np.mean(lm) != -1 and self._error(lms[k], lm) > self.max_error:
+                return self.detect('reference', indices, images)
+            if np.mean(lm) != -1:
+                lms[k] = lm
+        if missing:
+            lms[missing] = self.detect('reference', [indices[k] for k in missing], [images[k] for k in missing])
+        self.reused += len(indices) - len(checks) - len(missing)
+        return lms
+
+    @staticmethod
+    def _error(reused, detected):
+        eye_distance = np.linalg.norm(reused[36:42].mean(0) - reused[42:48].mean(0))
+        return np.mean(np.linalg.norm(reused - detected, axis=1)) / max(float(eye_distance), 1e-6)
+
+
+def align_face3d(frame, lm_idx, lm3d_std):
+    """
+    Aligns one 256x256 face crop for the face3d network
+
+    Returns:
+        tuple: (trans_params as float32, aligned image as float32 HWC in [0, 1])
+    """
+    W, H = frame.size
+    lm_idx = lm_idx.reshape([-1, 2]).copy()
+    if np.mean(lm_idx) == -1:
+        lm_idx = (lm3d_std[:, :2]+1) / 2.
+        lm_idx = np.concatenate([lm_idx[:, :1] * W, lm_idx[:, 1:2] * H], 1)
+    else:
+        lm_idx[:, -1] = H - 1 - lm_idx[:, -1]
+
+    trans_params, im_idx, lm_idx, _ = align_img(frame, lm_idx, lm3d_std)
+    trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
+    return trans_params, (np.array(im_idx)/255.).astype(np.float32)
+
+
+def extract_3dmm_coeffs(faces, lm, net_recon, lm3d_std, device, batch_size=16, pool=None):
+    """
+    Extracts the 3DMM coefficients of a window of 256x256 face crops. The faces are
+    aligned on the CPU, on `pool` when given, and sent to the network in batches of
+    `batch_size`, with a single device to host copy per batch.
+
+    Args:
+        faces (list): PIL face crops
+        lm (np.ndarray): Landmarks of the face crops, (N, 68, 2)
+        net_recon (torch.nn.Module): face3d reconstruction network
+        lm3d_std (np.ndarray): Standard 3D landmarks
+        device (str): Torch device
+        batch_size (int): Number of faces per forward pass
+        pool (concurrent.futures.Executor): Worker pool used for the alignment
+
+    Returns:
+        np.ndarray: Coefficients, one row per face
+    """
+    lm3d = [lm3d_std] * len(faces)
+    if pool is not None:
+        aligned = list(pool.map(align_face3d, faces, lm, lm3d))
+    else:
+        aligned = list(map(align_face3d, faces, lm, lm3d))
+
+    video_coeffs = []
+    for i in range(0, len(aligned), batch_size):
+        batch = aligned[i:i + batch_size]
+        trans_params = np.stack([item[0] for item in batch])
+        im_tensor = torch.from_numpy(np.stack([item[1] for item in batch])).permute(0, 3, 1, 2).to(device)
+        with torch.no_grad(), autocast():
+            coeffs = split_coeff(net_recon(im_tensor).float())
+
+        pred_coeff = {key:coeffs[key].cpu().numpy() for key in coeffs}
+        video_coeffs.append(np.concatenate([pred_coeff['id'], pred_coeff['exp'], pred_coeff['tex'], pred_coeff['angle'],\
+                                            pred_coeff['gamma'], pred_coeff['trans'], trans_params], 1))
+    return np.concatenate(video_coeffs, 0)
+
+
+def detect_faces(detector, frames, batch_size):
+    """
+    Runs the face detector over a window of full frames and returns one rect
+    (x1, y1, x2, y2) or None per frame
+    """
+    while True:
+        predictions = []
+        try:
+            for i in range(0, len(frames), batch_size):
+                predictions.extend(detector.get_detections_for_batch(np.array(frames[i:i + batch_size])))
+        except RuntimeError:
+            if batch_size == 1:
+                raise RuntimeError('Image too big to run face detection on GPU. Please use the --resize_factor argument')
+            batch_size //= 2
+            print('Recovering from OOM error; New batch size: {}'.format(batch_size))
+            continue
+        return predictions
+
+
+class FaceTracker(object):
+    """
+    Face rects from keyframe detection. The detector runs on a keyframe every
+    `stride` frames and on scene changes, the face is tracked in between by template
+    matching the keyframe face on small grey frames. Frames where the match score
+    drops below `min_score` are detected again. Keeps its state between the windows
+    of a video, windows have to be passed in order.
+
+    Args:
+        detector: face_detection.FaceAlignment used on the full frames
+        batch_size (int): Batch size for face detection
+        stride (int): Frames between two keyframes
+        min_score (float): Normalized cross correlation under which tracking is lost
+        scene_threshold (float): Histogram distance between two frames starting a new shot
+        track_size (int): Longest side of the frames tracking runs on
+        start (int): Index of the first frame passed, keyframes stay at multiples of `stride` in the video
+    """
+    def __init__(self, detector, batch_size, stride=10, min_score=0.8, scene_threshold=0.3, track_size=320,
+                 start=0):
+        self.detector = detector
+        self.batch_size = batch_size
+        self.stride = max(1, stride)
+        self.min_score = min_score
+        self.scene_threshold = scene_threshold
+        self.track_size = track_size
+        self.index = start
+        self.hist = None
+        # keyframe face template and the last tracked rect, in tracking coordinates
+        self.template = None
+        self.rect = None
+        self.frames = 0
+        self.detections = 0
+
+    def _small(self, frame):
+        scale = min(1., float(self.track_size) / max(frame.shape[:2]))
+        small = cv2.cvtColor(cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA),
+                             cv2.COLOR_BGR2GRAY)
+        return small, scale
+
+    def _scene_change(self, small):
+        hist = cv2.calcHist([small], [0], None, [32], [0, 256])
+        hist = cv2.normalize(hist, hist)
+        previous, self.hist = self.hist, hist
+        return previous is not None and cv2.compareHist(previous, hist, cv2.HISTCMP_BHATTACHARYYA) > self.scene_threshold
+
+    def _set_keyframe(self, small, scale, rect):
+        if rect is None:
+            self.template, self.rect = None, None
+            return
+        x1, y1, x2, y2 = [int(round(value * scale)) for value in rect]
+        x1, y1 = max(0, x1), max(0, y1)
+        x2, y2 = min(small.shape[1], max(x2, x1 + 1)), min(small.shape[0], max(y2, y1 + 1))
+        self.template, self.rect = small[y1:y2, x1:x2].copy(), (x1, y1, x2, y2)
+
+    def _track(self, small):
+        """
+        Returns (score, rect in tracking coordinates) of the template around the last rect
+        """
+        x1, y1, x2, y2 = self.rect
+        th, tw = self.template.shape
+        margin_x, margin_y = tw // 2 + 1, th // 2 + 1
+        sx1, sy1 = max(0, x1 - margin_x), max(0, y1 - margin_y)
+        sx2, sy2 = min(small.shape[1], x2 + margin_x), min(small.shape[0], y2 + margin_y)
+        if sx2 - sx1 < tw or sy2 - sy1 < th:
+            return -1., None
+        scores = cv2.matchTemplate(small[sy1:sy2, sx1:sx2], self.template, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (dx, dy) = cv2.minMaxLoc(scores)
+        return score, (sx1 + dx, sy1 + dy, sx1 + dx + tw, sy1 + dy + th)
+
+    def __call__(self, frames):
+        """
+        Returns one rect (x1, y1, x2, y2) or None per frame of the next window
+        """
+        smalls = [self._small(frame) for frame in frames]
+        scene_changes = [self._scene_change(small) for small, _ in smalls]
+        keyframes = [idx for idx in range(len(frames)) if (self.index + idx) % self.stride == 0 or scene_changes[idx]]
+        rects = [None] * len(frames)
+        for idx, rect in zip(keyframes, detect_faces(self.detector, [frames[idx] for idx in keyframes],
+                                                     self.batch_size)):
+            rects[idx] = rect
+        detections = len(keyframes)
+
+        keyframes = set(keyframes)
+        for idx, (small, scale) in enumerate(smalls):
+            if idx not in keyframes:
+                score, rect = self._track(small) if self.template is not None else (-1., None)
+                if score >= self.min_score:
+                    self.rect = rect
+                    rects[idx] = tuple(int(round(value / scale)) for value in rect)
+                    continue
+                # tracking lost, this frame becomes a keyframe
+                rects[idx] = detect_faces(self.detector, [frames[idx]], 1)[0]
+                detections += 1
+            self._set_keyframe(small, scale, rects[idx])
+
+        self.index += len(frames)
+        self.frames += len(frames)
+        self.detections += detections
+        return rects
+
+
+def face_boxes(rects, frame_shape, pads, nosmooth=False):
+    """
+    Pads and smooths the detected rects the same way face_detect does. Frames
+    without a face are passed through by Step 6, they get the box of the previous
+    face so the smoothing of the others is not disturbed.
+
+    Returns:
+        list: One (y1, y2, x1, x2) box per frame
+    """
+    pady1, pady2, padx1, padx2 = pads
+    height, width = frame_shape[:2]
+
+    last = next((rect for rect in rects if rect is not None), None)
+    if last is None:
+        raise ValueError('Face not detected! Ensure the video contains a face.')
+    results = []
+    for rect in rects:
+        rect = last = last if rect is None else rect
+        results.append([max(0, rect[0] - padx1), max(0, rect[1] - pady1),
+                        min(width, rect[2] + padx2), min(height, rect[3] + pady2)])
+
+    boxes = np.array(results)
+    if not nosmooth: boxes = get_smoothened_boxes(boxes, T=5)
+    return [(y1, y2, x1, x2) for (x1, y1, x2, y2) in boxes]
+
+
+def analyse_video(reader, region, window, detector, face_det_batch_size, kp_extractor=None, saved_lm=None,
+                  net_recon=None, lm3d_std=None, device='cpu', face3d_batch_size=16, face3d_workers=4, queue_size=2,
+                  start=0, stop=None, previous_lm=None, face_det_stride=1, face_track_min_score=0.8):
+    """
+    Step 1 and Step 2 in a single decode pass: landmarks, 3DMM coefficients and face
+    detection on the full frames [start, stop).
+
+    Args:
+        reader (FrameReader): Source video
+        region (FaceRegion): Face crop
+        window (int): Number of frames decoded at once
+        detector: face_detection.FaceAlignment used on the full frames
+        face_det_batch_size (int): Batch size for face detection
+        kp_extractor (KeypointExtractor): Landmark detector, None when saved_lm is used
+        saved_lm (np.ndarray): Landmarks loaded from a previous run
+        net_recon (torch.nn.Module): face3d network, None to skip the 3DMM extraction
+        lm3d_std (np.ndarray): Standard 3D landmarks
+        device (str): Torch device
+        face3d_batch_size (int): Batch size for the face3d network
+        face3d_workers (int): CPU workers aligning faces for the face3d network, 0 aligns inline
+        queue_size (int): Windows waiting between two pipeline stages
+        start (int): First frame to analyse
+        stop (int): Frame after the last one to analyse, None for the end of the video
+        previous_lm (np.ndarray): Landmarks of frame start - 1, reused when no face is found in frame start
+        face_det_stride (int): Run the face detector on keyframes this many frames apart and track the
+            face in between, see FaceTracker. 1 detects on every frame
+        face_track_min_score (float): Tracking score under which a frame is detected again
+
+    Returns:
+        tuple: (landmarks, coefficients or None, detected rects)
+    """
+    pool = ThreadPoolExecutor(max_workers=face3d_workers) if face3d_workers > 0 and net_recon is not None else None
+    previous = previous_lm
+    offset = 0
+
+    def crop_faces(frames):
+        with step('crop', len(frames)):
+            return frames, [region.face_image(frame) for frame in frames]
+
+    def analyse_faces(item):
+        nonlocal previous, offset
+        frames, faces = item
+        if saved_lm is None:
+            with step('landmarks', len(faces)):
+                lm = extract_landmarks(kp_extractor, faces, previous)
+            previous = lm[-1]
+        else:
+            lm = saved_lm[offset:offset + len(frames)]
+        offset += len(frames)
+
+        coeffs = None
+        if net_recon is not None:
+            with step('3DMM', len(faces)):
+                coeffs = extract_3dmm_coeffs(faces, lm, net_recon, lm3d_std, device, batch_size=face3d_batch_size,
+                                             pool=pool)
+        return frames, lm, coeffs
+
+    tracker = None
+    if face_det_stride > 1:
+        tracker = FaceTracker(detector, face_det_batch_size, face_det_stride, face_track_min_score, start=start)
+
+    def detect(item):
+        frames, lm, coeffs = item
+        with step('face detection', len(frames)):
+            if tracker is not None:
+                return lm, coeffs, tracker(frames)
+            return lm, coeffs, detect_faces(detector, frames, face_det_batch_size)
+
+    pipeline = Pipeline('Step 1-2', [Stage('face crop', crop_faces), Stage('landmarks and 3DMM', analyse_faces),
+                                     Stage('face detection', detect)], queue_size=queue_size)
+    lm_windows, coeff_windows, rects = [], [], []
+    total = max(0, (reader.frame_count if stop is None else min(stop, reader.frame_count)) - start)
+    progress = tqdm(total=total, desc='[Step 1-2] Landmarks, 3DMM and Face Detection:')
+    for lm, coeffs, window_rects in pipeline.run(iter_windows(reader.read(start=start, stop=stop), window)):
+        lm_windows.append(lm)
+        if coeffs is not None:
+            coeff_windows.append(coeffs)
+        rects.extend(window_rects)
+        progress.update(len(lm))
+    progress.close()
+    if pool is not None:
+        pool.shutdown()
+    if tracker is not None:
+        print('[Step 1-2] Face detector ran on {} of {} frames'.format(tracker.detections, tracker.frames))
+
+    semantic_npy = np.concatenate(coeff_windows) if coeff_windows else None
+    lm = np.concatenate(lm_windows) if lm_windows else np.zeros((0, 68, 2), dtype=np.float32)
+    return lm, semantic_npy, rects
+
+
+def crop_norm_ratios(semantic_npy, one_shot=False, chunk_size=32):
+    """
+    find_crop_norm_ratio for every frame of the video in one vectorized pass. Each
+    frame is its own source, or frame 0 is the source of every frame in one-shot mode.
+
+    Args:
+        semantic_npy (np.ndarray): 3DMM coefficients of the whole video
+        one_shot (bool): Use frame 0 as the source of every frame
+        chunk_size (int): Number of source frames compared at once, bounds the
+            (chunk_size, N, 64) difference array
+
+    Returns:
+        np.ndarray: One crop norm ratio per frame
+    """
+    if one_shot:
+        return np.repeat(find_crop_norm_ratio(semantic_npy[0:1], semantic_npy), len(semantic_npy))
+
+    # same weighting as find_crop_norm_ratio
+    alpha = 0.3
+    exp, angle = semantic_npy[:, 80:144], semantic_npy[:, 224:227]
+    ratios = np.empty(len(semantic_npy), dtype=semantic_npy.dtype)
+    for start in range(0, len(semantic_npy), chunk_size):
+        source = slice(start, start + chunk_size)
+        exp_diff = np.mean(np.abs(exp[None] - exp[source, None]), 2)
+        angle_diff = np.mean(np.abs(angle[None] - angle[source, None]), 2)
+        index = np.argmin(alpha*exp_diff + (1-alpha)*angle_diff, 1)
+        ratios[source] = semantic_npy[source, -3] / semantic_npy[index, -3]
+    return ratios
+
+
+def stabilization_coeffs(semantic_npy, expression, ratios):
+    """
+    transform_semantic for every frame of the video in one vectorized pass, with the
+    expression template already written into the first 64 coefficients
+
+    Args:
+        semantic_npy (np.ndarray): 3DMM coefficients of the whole video
+        expression (torch.Tensor): Expression template
+        ratios (np.ndarray): Crop norm ratio of every frame, see crop_norm_ratios
+
+    Returns:
+        np.ndarray: float32 DNet driving coefficients, (N, 73, T) with the T frames of
+            the obtain_seq_index window
+    """
+    num_frames = len(semantic_npy)
+    # expression (64), angles (3), translation (3), crop params s, tx, ty (3)
+    coeff_3dmm = np.concatenate([semantic_npy[:, 80:144], semantic_npy[:, 224:227],
+                                 semantic_npy[:, 254:257], semantic_npy[:, 259:262]], 1)
+    # the temporal window of every frame, clipped at the ends of the video
+    index = np.array([obtain_seq_index(idx, num_frames) for idx in range(num_frames)], dtype=np.int64)
+    coeffs = coeff_3dmm[index]
+
+    # transform_semantic skips the scaling when the ratio is 0
+    coeffs[:, :, -3] *= np.where(ratios != 0, ratios, 1)[:, None]
+    coeffs = coeffs.astype(np.float32)
+    # hacking the new expression
+    coeffs[:, :, :64] = expression[:64].cpu().numpy()
+    return np.ascontiguousarray(coeffs.transpose(0, 2, 1))
+
+
+def stabilize_expression(faces, coeffs, D_Net, device, source_face=None, batch_size=8):
+    """
+    Step 3 for a window of face crops, DNet runs on mini-batches of `batch_size`
+
+    Args:
+        faces (list): PIL face crops
+        coeffs (np.ndarray): Driving coefficients of the faces, see stabilization_coeffs
+        D_Net (torch.nn.Module): DNet
+        device (str): Torch device
+        source_face (PIL.Image): One-shot source face, None to use every frame as its own source
+        batch_size (int): Number of faces per forward pass
+
+    Returns:
+        list: Stabilized BGR faces
+    """
+    imgs = []
+    for i in range(0, len(faces), batch_size):
+        batch = faces[i:i + batch_size]
+        if source_face is not None:
+            source_img = trans_image(source_face).unsqueeze(0).repeat(len(batch), 1, 1, 1)
+        else:
+            source_img = torch.stack([trans_image(face) for face in batch])
+        coeff = torch.from_numpy(coeffs[i:i + len(batch)]).to(device)
+
+        with torch.no_grad(), autocast():
+            output = D_Net(source_img.to(device), coeff)
+        img_stablized = np.uint8((output['fake_image'].float().permute(0,2,3,1).cpu().clamp_(-1, 1).numpy() + 1 )/2. * 255)
+        imgs.extend(cv2.cvtColor(img, cv2.COLOR_RGB2BGR) for img in img_stablized)
+    return imgs
+
+
+def stabilize_video(reader, region, window, semantic_npy, expression, D_Net, device, out_path, one_shot=False,
+                    batch_size=8, queue_size=2):
+    """
+    Runs Step 3 over the whole video and writes the stabilized faces to a memory
+    mapped .npy file, so they never have to be held in memory together. The ratios
+    and driving coefficients of all frames are computed up front.
+
+    Returns:
+        np.memmap: Stabilized BGR faces, (N, 256, 256, 3)
+    """
+    stabilized = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.uint8,
+                                           shape=(len(semantic_npy), 256, 256, 3))
+    source_face = region.face_image(reader.first_frame()) if one_shot else None
+    ratios = crop_norm_ratios(semantic_npy, one_shot)
+    coeffs = stabilization_coeffs(semantic_npy, expression, ratios)
+
+    def crop_faces(frames):
+        with step('crop', len(frames)):
+            return [region.face_image(frame) for frame in frames]
+
+    def stabilize(faces):
+        nonlocal start
+        end = start + len(faces)
+        with step('stabilize', len(faces)):
+            imgs = stabilize_expression(faces, coeffs[start:end], D_Net, device, source_face, batch_size)
+        start = end
+        return imgs
+
+    start = 0
+    end = 0
+    pipeline = Pipeline('Step 3', [Stage('face crop', crop_faces), Stage('DNet', stabilize)], queue_size=queue_size)
+    progress = tqdm(total=len(semantic_npy), desc='[Step 3] Stabilize the expression In Video:')
+    for imgs in pipeline.run(iter_windows(reader.read(stop=len(semantic_npy)), window)):
+        stabilized[end:end + len(imgs)] = imgs
+        end += len(imgs)
+        progress.update(len(imgs))
+    progress.close()
+    stabilized.flush()
+    return stabilized
+
+
+def build_references(enhanced, full_frames, boxes, region, landmarks, indices, image_size=256):
+    """
+    Pastes a window of enhanced faces back into their full frames and returns the
+    reference crops LNet is conditioned on
+
+    Args:
+        enhanced (list): Enhanced 256x256 faces
+        full_frames (list): Full resolution BGR frames
+        boxes (list): Face box (y1, y2, x1, x2) of every frame
+        region (FaceRegion): Face crop
+        landmarks (LandmarkService): Landmarks of the enhanced faces
+        indices (list): Frame indices of the window
+        image_size (int): Size of the aligned crops
+    """
+    oy1, oy2, ox1, ox2 = region.box
+    fr_pil = [Image.fromarray(frame) for frame in enhanced]
+    lms = landmarks.references(indices, fr_pil)
+    # frames is the croped version of modified face
+    frames_pil = [(lm, frame) for frame, lm in zip(fr_pil, lms)]
+
+    quads = []
+    for lm, _ in frames_pil:
+        c, x, y = compute_transform(lm, predictor=None, detector=None, scale=1.0, fa=None)
+        quads.append(np.stack([c - x - y, c - x + y, c + x + y, c + x - y]))
+    crops, _ = crop_faces_by_quads(image_size, frames_pil, quads)
+    inverse_transforms = [calc_alignment_coefficients(quad + 0.5, [[0, 0], [0, image_size], [image_size, image_size], [image_size, 0]]) for quad in quads]
+
+    refs = []
+    for inverse_transform, crop, full_frame, (y1, y2, x1, x2) in zip(inverse_transforms, crops, full_frames, boxes):
+        imc_pil = paste_image(inverse_transform, crop, Image.fromarray(
+            cv2.resize(full_frame[int(oy1):int(oy2), int(ox1):int(ox2)], (256, 256))))
+
+        ff = full_frame.copy()
+        ff[int(oy1):int(oy2), int(ox1):int(ox2)] = cv2.resize(np.array(imc_pil.convert('RGB')), (ox2 - ox1, oy2 - oy1))
+        # copy so the full frame copy is released right away
+        refs.append(ff[y1:y2, x1:x2].copy())
+    return refs
+
+
+def iter_frame_items(reader, stabilized, boxes, region, reference_enhancer, landmarks, window, stop, start=0,
+                     needed=None):
+    """
+    Step 5 and the reference preparation of Step 6, streamed over windows of frames.
+    `reference_enhancer` is a BatchedFaceEnhancement, None uses the stabilized faces as
+    they are, `landmarks` a LandmarkService.
+
+    Args:
+        needed (np.ndarray): Whether Step 6 synthesizes each video frame, the frames it
+            passes through get no reference. None prepares every frame.
+
+    Yields:
+        tuple: (full frame, face box, reference crop or None) for every frame in [start, stop)
+    """
+    for frames in iter_windows(reader.read(start=start, stop=stop), window):
+        end = start + len(frames)
+        indices = list(range(start, end)) if needed is None else [idx for idx in range(start, end) if needed[idx]]
+        refs = dict.fromkeys(range(start, end))
+        if indices:
+            if reference_enhancer is not None:
+                with step('enhance', len(indices)):
+                    enhanced = reference_enhancer.process_references(np.array(stabilized[indices]))
+            else:
+                enhanced = list(np.array(stabilized[indices]))
+            with step('references', len(indices)):
+                refs.update(zip(indices, build_references(enhanced, [frames[idx - start] for idx in indices],
+                                                          [boxes[idx] for idx in indices], region, landmarks,
+                                                          indices)))
+        for idx, frame in enumerate(frames, start):
+            yield frame, boxes[idx], refs[idx]
+        start = end
+
+
+def build_reference_store(reader, stabilized, boxes, region, reference_enhancer, landmarks, window, img_size,
+                          out_path, needed=None):
+    """
+    Runs Step 5 once for every frame in [0, len(boxes)) and writes the reference
+    crops, already resized for LNet, to a memory mapped .npy file. Used when several
+    audio tracks are lip synced to the same video, so the references are shared.
+    Frames that are not `needed` by any track are left empty.
+
+    Returns:
+        np.memmap: Reference crops, (N, img_size, img_size, 3)
+    """
+    references = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.uint8,
+                                           shape=(len(boxes), img_size, img_size, 3))
+    items = iter_frame_items(reader, stabilized, boxes, region, reference_enhancer, landmarks, window, len(boxes),
+                             needed=needed)
+    for idx, (_, _, ref) in enumerate(tqdm(items, total=len(boxes), desc='[Step 5] Reference Enhancement:')):
+        if ref is not None:
+            references[idx] = cv2.resize(ref, (img_size, img_size))
+    references.flush()
+    return references
+
+
+def iter_stored_frame_items(reader, references, boxes, window, stop, start=0):
+    """
+    Same items as iter_frame_items, with the references read from build_reference_store
+
+    Yields:
+        tuple: (full frame, face box, reference crop) for every frame in [start, stop)
+    """
+    for frames in iter_windows(reader.read(start=start, stop=stop), window):
+        end = start + len(frames)
+        for item in zip(frames, boxes[start:end], references[start:end]):
+            yield item
+        start = end
+
+
+class MelChunks(object):
+    """
+    The (80, 16) mel chunk of every video frame, as read-only views into the mel
+    spectrogram. Chunk i starts at mel frame int(i * 80 / fps), the last chunk is
+    aligned to the end of the spectrogram.
+
+    Args:
+        mel (np.ndarray): Mel spectrogram, (80, T)
+        starts (np.ndarray): First mel frame of every chunk
+        step_size (int): Mel frames per chunk
+    """
+    def __init__(self, mel, starts, step_size=16):
+        self.mel = mel
+        self.starts = starts
+        self.step_size = step_size
+        # (T - step_size + 1, 80, step_size) view, window j covers the mel frames j to j + step_size
+        self.windows = np.lib.stride_tricks.sliding_window_view(mel, step_size, axis=1).transpose(1, 0, 2)
+
+    @classmethod
+    def plan(cls, mel, fps, step_size=16):
+        """
+        Computes the start of every chunk at once
+
+        Args:
+            mel (np.ndarray): Mel spectrogram, (80, T)
+            fps (float): Frame rate of the video
+            step_size (int): Mel frames per chunk
+
+        Returns:
+            MelChunks: One chunk per video frame
+        """
+        length = mel.shape[1]
+        if length < step_size:
+            raise ValueError('Audio too short, {} mel frames for chunks of {}'.format(length, step_size))
+        mel_idx_multiplier = 80. / fps
+        # every i with int(i * multiplier) + step_size <= length, then one chunk at the end
+        candidates = np.arange(int(np.ceil((length - step_size + 1) / mel_idx_multiplier)) + 1)
+        starts = (candidates * mel_idx_multiplier).astype(np.int64)
+        starts = np.append(starts[starts <= length - step_size], length - step_size)
+        return cls(np.ascontiguousarray(mel, dtype=np.float32), starts, step_size)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return MelChunks(self.mel, self.starts[idx], self.step_size)
+        return self.windows[self.starts[idx]]
+
+    def __iter__(self):
+        for start in self.starts:
+            yield self.windows[start]
+
+    def take(self, indices, out):
+        """
+        Copies the chunks `indices` into `out`, (len(indices), 80, step_size)
+        """
+        return np.take(self.windows, self.starts[indices], axis=0, out=out)
+
+
+def load_mel_chunks(audio_path, fps, wav_path):
+    """
+    Step 4, splits the audio into one mel spectrogram chunk per video frame
+
+    Args:
+        audio_path (str): Driving audio, converted to wav_path first if it is not a wav file
+        fps (float): Frame rate of the video
+        wav_path (str): Where to write the converted audio
+
+    Returns:
+        tuple: (path of the wav audio, MelChunks)
+    """
+    if not audio_path.endswith('.wav'):
+        command = [
+                'ffmpeg',
+                '-loglevel', 'error',
+                '-y',
+                '-i', audio_path,
+                '-strict', '-2',
+                wav_path
+            ]
+        subprocess.call(command, shell=False)
+        audio_path = wav_path
+
+    with step('mel'):
+        wav = audio.load_wav(audio_path, 16000)
+        mel = audio.melspectrogram(wav)
+        if np.isnan(mel.reshape(-1)).sum() > 0:
+            raise ValueError('Mel contains nan! Using a TTS voice? Add a small epsilon noise to the wav file and try again')
+
+        mel_chunks = MelChunks.plan(mel, fps)
+    return audio_path, mel_chunks
+
+
+def run_lnet(img_batch, mel_batch, img_original, model, device, up_face='original', without_rl1=False, instance=None):
+    """
+    LNet and ENet over one datagen batch
+
+    Args:
+        img_batch (torch.Tensor): Masked faces and references, (B, 6, H, W)
+        mel_batch (torch.Tensor): Mel chunks, (B, 1, 80, 16)
+        img_original (np.ndarray): Unmasked faces, (B, H, W, 3)
+        model (torch.nn.Module): LNet and ENet
+        device (str): Torch device
+        up_face (str): Expression editing, 'original' to keep the expression
+        without_rl1 (bool): Keep the original upper face
+        instance (GANimationModel): Expression editor, required unless up_face is 'original'
+
+    Returns:
+        np.ndarray: Predicted faces, (B, H, W, 3) in [0, 255]
+    """
+    with step('LNet', len(img_batch)):
+        # the batches are pinned when running on the GPU, the copies overlap with the host
+        img_batch = img_batch.to(device, non_blocking=True)
+        mel_batch = mel_batch.to(device, non_blocking=True)
+        if up_face != 'original' or without_rl1 is not False:
+            img_original = torch.from_numpy(np.transpose(img_original, (0, 3, 1, 2))).to(device).float()/255. # BGR -> RGB
+
+        with torch.no_grad(), autocast():
+            incomplete, reference = torch.split(img_batch, 3, dim=1)
+            pred, low_res = model(mel_batch, img_batch, reference)
+            pred = torch.clamp(pred.float(), 0, 1)
+
+            if up_face in ['sad', 'angry', 'surprise']:
+                tar_aus = exp_aus_dict[up_face]
+
+            if up_face == 'original':
+                cur_gen_faces = img_original
+            else:
+                test_batch = {'src_img': torch.nn.functional.interpolate((img_original * 2 - 1), size=(128, 128), mode='bilinear'),
+                              'tar_aus': tar_aus.repeat(len(incomplete), 1)}
+                instance.feed_batch(test_batch)
+                instance.forward()
+                cur_gen_faces = torch.nn.functional.interpolate(instance.fake_img.float() / 2. + 0.5, size=(384, 384), mode='bilinear')
+
+            if without_rl1 is not False:
+                incomplete, reference = torch.split(img_batch, 3, dim=1)
+                mask = torch.where(incomplete==0, torch.ones_like(incomplete), torch.zeros_like(incomplete))
+                pred = pred * mask + cur_gen_faces * (1 - mask)
+
+        pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+    torch.cuda.empty_cache()
+    return pred
+
+
+def datagen(frame_items, mels, img_size, batch_size, num_buffers=4, pin_memory=False, weights=None):
+    """
+    Builds the LNet batches from the streamed frame items, one item per mel chunk.
+    Faces, references and mels are written in place into a ring of `num_buffers`
+    preallocated batches, so a yielded batch is only valid until `num_buffers - 1`
+    more batches were built. The consumer has to be done with it by then, e.g. with
+    a Pipeline of queue size `num_buffers - 2` between datagen and run_lnet.
+
+    Frames with a weight of 0 are passed through: they are not part of the LNet
+    inputs and only travel with the batch to keep the output in order.
+
+    Args:
+        frame_items (iterable): (full frame, face coords, reference) per output frame
+        mels (MelChunks): Mel chunks of the output frames
+        img_size (int): LNet input size
+        batch_size (int): Frames per batch
+        num_buffers (int): Batches in the ring
+        pin_memory (bool): Allocate the model inputs in page-locked memory for faster copies to the GPU
+        weights (np.ndarray): Blend weight of every output frame, see frame_planner.plan_frames.
+            None synthesizes every frame
+
+    Yields:
+        tuple: (img_batch, mel_batch, img_original, coords_batch, full_frame_batch, weight_batch), the
+            first four cover the synthesized frames only and are None and empty without any
+    """
+    buffers = [_BatchBuffers(batch_size, img_size, pin_memory) for _ in range(max(1, num_buffers))]
+    batch, first, indices = 0, 0, []
+    coords_batch, full_frame_batch = [], []
+
+    for idx, (full_frame, coords, ref) in zip(range(len(mels)), frame_items):
+        buffer = buffers[batch % len(buffers)]
+        full_frame_batch.append(full_frame)
+        if weights is None or weights[idx] > 0:
+            y1, y2, x1, x2 = coords
+            buffer.faces.append_resized(full_frame[y1:y2, x1:x2])
+            buffer.refs.append_resized(ref)
+            coords_batch.append(coords)
+            indices.append(idx)
+
+        # passed through frames are bounded too, they hold full frames
+        if buffer.faces.full() or len(full_frame_batch) >= 4 * batch_size:
+            yield buffer.batch(mels, indices) + (coords_batch, full_frame_batch,
+                                                 None if weights is None else weights[first:idx + 1])
+            batch, first, indices = batch + 1, idx + 1, []
+            coords_batch, full_frame_batch = [], []
+
+    if full_frame_batch:
+        yield buffers[batch % len(buffers)].batch(mels, indices) + (
+            coords_batch, full_frame_batch, None if weights is None else weights[first:first + len(full_frame_batch)])
+
+
+class _BatchBuffers(object):
+    """
+    Preallocated arrays of one LNet batch. The model inputs are torch tensors in the
+    layout LNet takes, (B, 6, S, S) and (B, 1, 80, 16), filled through numpy views.
+    """
+    def __init__(self, batch_size, img_size, pin_memory=False):
+        self.img_size = img_size
+        self.faces = FrameBuffer(batch_size, img_size, img_size)
+        self.refs = FrameBuffer(batch_size, img_size, img_size)
+        self.inputs = torch.empty((batch_size, 6, img_size, img_size), dtype=torch.float32, pin_memory=pin_memory)
+        self.mels = torch.empty((batch_size, 1, 80, 16), dtype=torch.float32, pin_memory=pin_memory)
+
+    def batch(self, mels, indices):
+        """
+        Returns (img_batch, mel_batch, img_original) and empties the buffers for the
+        next batch: the masked faces and the references scaled to [0, 1], the mel
+        chunks `indices` and the unmasked faces. All None for an empty batch.
+        """
+        count = len(self.faces)
+        if count == 0:
+            return None, None, None
+        faces, refs = self.faces.view(), self.refs.view()
+        inputs = self.inputs.numpy()[:count]
+        np.multiply(faces.transpose(0, 3, 1, 2), 1. / 255., out=inputs[:, :3])
+        # mask the lower half of the face
+        inputs[:, :3, self.img_size//2:] = 0
+        np.multiply(refs.transpose(0, 3, 1, 2), 1. / 255., out=inputs[:, 3:])
+        mels.take(indices, self.mels.numpy()[:count, 0])
+        self.faces.clear()
+        self.refs.clear()
+        return self.inputs[:count], self.mels[:count], faces
@@ -0,0 +1,100 @@
+"""
+video_writer.py
+
+    Description:
+        Output writer for the retalking pipeline. Frames are piped as raw BGR into a
+        single ffmpeg process that also takes the driving audio as a second input, so
+        the result is encoded and muxed in one pass without an intermediate video
+        file on disk.
+"""
+import os
+import subprocess
+
+from instrumentation import step
+
+
+class FFmpegWriter(object):
+    """
+    Encodes BGR frames and muxes them with an audio track through an ffmpeg pipe.
+
+    Args:
+        path (str): Output video file
+        fps (float): Frame rate of the output
+        size (tuple): Frame size (width, height)
+        audio (str): Audio file muxed into the output, None for a silent video
+        codec (str): ffmpeg video encoder, e.g. libx264 or libx265
+        crf (int): Constant rate factor of the encoder, lower is larger and better
+        preset (str): Encoder preset, faster presets trade file size for speed
+        pix_fmt (str): Pixel format of the encoded video
+    """
+    def __init__(self, path, fps, size, audio=None, codec='libx264', crf=18, preset='medium', pix_fmt='yuv420p'):
+        self.path = path
+        self.size = size
+        width, height = size
+
+        output_dir = os.path.dirname(path)
+        if output_dir and not os.path.isdir(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+
+        command = [
+            "ffmpeg",
+            "-loglevel", "error",
+            "-y",
+            "-f", "rawvideo",
+            "-pix_fmt", "bgr24",
+            "-s", "{}x{}".format(width, height),
+            "-r", str(fps),
+            "-i", "-",
+        ]
+        if audio is not None:
+            command += ["-i", audio, "-map", "0:v:0", "-map", "1:a:0", "-c:a", "aac"]
+        command += ["-c:v", codec, "-pix_fmt", pix_fmt]
+        if crf is not None:
+            command += ["-crf", str(crf)]
+        if preset:
+            command += ["-preset", preset]
+        if width % 2 or height % 2:
+            # yuv420p needs even dimensions
+            command += ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2"]
+        command += ["-strict", "-2", path]
+
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, shell=False)
+
+    def write(self, frame):
+        """
+        Writes one BGR frame of the configured size
+        """
+        if frame.shape[1] != self.size[0] or frame.shape[0] != self.size[1]:
+            raise ValueError('Frame of size {}x{} does not match the output size {}x{}'.format(
+                frame.shape[1], frame.shape[0], self.size[0], self.size[1]))
+        try:
+            self.process.stdin.write(frame.astype('uint8', copy=False).tobytes())
+        except BrokenPipeError:
+            self.release()
+
+    def release(self):
+        """
+        Closes the pipe and waits for ffmpeg to finish the output file
+        """
+        # ffmpeg finishes the encode and writes the container once its input is closed
+        with step('mux'):
+            if self.process.stdin is not None and not self.process.stdin.closed:
+                try:
+                    self.process.stdin.close()
+                except BrokenPipeError:
+                    pass
+            returncode = self.process.wait()
+        if returncode != 0:
+            raise RuntimeError('ffmpeg failed to encode {} (exit code {})'.format(self.path, returncode))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # do not leave a half written output behind a failed run
+            self.process.kill()
+            self.process.wait()
+            return False
+        self.release()
+        return False